@@ -0,0 +1,106 @@
+"""
+Generated inputs for the benchmarks: the same pseudo-random text as a PDF, a plain text file
+and an HTML article, in sizes from a short article to a book. Deterministic for a given size,
+so results are comparable across commits
+"""
+import os
+import random
+from typing import Dict, List
+
+# Pages per size
+SIZES = {
+    'small': 2,
+    'medium': 50,
+    'book': 800,
+}
+LINES_PER_PAGE = 45
+
+_LATIN_WORDS = ['reader', 'window', 'quiet', 'evening', 'river', 'letter', 'garden', 'shadow', 'light',
+                'morning', 'story', 'voice', 'journey', 'autumn', 'distant', 'harbor', 'the', 'a', 'of', 'and']
+_CJK_WORDS = ['窗边', '读者', '安静', '傍晚', '河流', '信件', '花园', '影子', '光线', '早晨', '故事',
+              '声音', '旅程', '秋天', '远方', '港口', '我们', '他们', '的', '了']
+
+
+def _page_lines(rnd: random.Random, words: List[str], sep: str) -> List[str]:
+    lines = []
+    for li in range(LINES_PER_PAGE):
+        line = sep.join(rnd.choice(words) for _ in range(rnd.randint(8, 12)))
+        # End a sentence, and now and then a paragraph, the way pdfminer output usually looks
+        if rnd.random() < 0.3:
+            line += '.' if sep else '。'
+        lines.append(line)
+    return lines
+
+
+def make_pages(size: str, cjk: bool = False) -> List[List[str]]:
+    rnd = random.Random(f'{size}-{cjk}')
+    words, sep = (_CJK_WORDS, '') if cjk else (_LATIN_WORDS, ' ')
+    return [_page_lines(rnd, words, sep) for _ in range(SIZES[size])]
+
+
+def write_pdf(out_fn: str, pages: List[List[str]]):
+    # Minimal hand-written PDF 1.4: one Helvetica text block per page, no external dependency.
+    # Standard fonts have no CJK glyphs, so only Latin text goes into PDFs
+    objs = [b'<< /Type /Catalog /Pages 2 0 R >>']
+    kids = ' '.join(f'{3 + 2 * i} 0 R' for i in range(len(pages)))
+    objs.append(f'<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>'.encode())
+    font_obj = 3 + 2 * len(pages)
+    for i, lines in enumerate(pages):
+        body = ' '.join('(%s) Tj T*' % ln.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+                        for ln in lines)
+        content = f'BT /F1 11 Tf 14 TL 72 760 Td {body} ET'.encode('latin-1')
+        objs.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {4 + 2 * i} 0 R '
+                    f'/Resources << /Font << /F1 {font_obj} 0 R >> >> >>'.encode())
+        objs.append(b'<< /Length %d >>\nstream\n' % len(content) + content + b'\nendstream')
+    objs.append(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for i, obj in enumerate(objs):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % (i + 1) + obj + b'\nendobj\n'
+    xref_pos = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objs) + 1)
+    for off in offsets:
+        out += b'%010d 00000 n \n' % off
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objs) + 1, xref_pos)
+    with open(out_fn, 'wb') as fout:
+        fout.write(out)
+
+
+def write_text(out_fn: str, pages: List[List[str]]):
+    # Text as pdfminer would hand it over: line breaks everywhere, a form feed after each page
+    with open(out_fn, 'w', encoding='utf-8') as fout:
+        for lines in pages:
+            fout.write('\n'.join(lines) + '\n\n\f')
+
+
+def write_html(out_fn: str, pages: List[List[str]]):
+    with open(out_fn, 'w', encoding='utf-8') as fout:
+        fout.write('<html><head><meta charset="utf-8"><title>Fixture</title></head><body><article>\n')
+        for lines in pages:
+            fout.write('<p>' + ' '.join(lines) + '</p>\n')
+        fout.write('</article></body></html>\n')
+
+
+def build_fixtures(out_dir: str, sizes: List[str]) -> Dict[str, Dict[str, str]]:
+    """
+    Writes (or reuses) the fixture files; returns {size: {'pdf': fn, 'txt': fn, 'cjk_txt': fn, 'html': fn}}
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    retval = {}
+    for size in sizes:
+        files = {
+            'pdf': os.path.join(out_dir, f'{size}.pdf'),
+            'txt': os.path.join(out_dir, f'{size}.txt'),
+            'cjk_txt': os.path.join(out_dir, f'{size}.cjk.txt'),
+            'html': os.path.join(out_dir, f'{size}.html'),
+        }
+        if not all(os.path.exists(fn) for fn in files.values()):
+            latin, cjk = make_pages(size), make_pages(size, cjk=True)
+            write_pdf(files['pdf'], latin)
+            write_text(files['txt'], latin)
+            write_text(files['cjk_txt'], cjk)
+            write_html(files['html'], cjk)
+        retval[size] = files
+    return retval
@@ -0,0 +1,203 @@
+"""
+Offline benchmarks of the text pipeline, with the stand-in FakeEngine instead of Azure/AWS.
+
+Every (stage, size) pair runs in a fresh process, so peak RSS belongs to that stage alone.
+Results are written as JSON and can be compared with an earlier run:
+
+    python bench/run_bench.py --sizes small medium --out bench_output.json
+    python bench/run_bench.py --sizes small medium --compare bench_output.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.realpath(os.path.join(BENCH_DIR, '..', 'src'))
+sys.path.insert(0, BENCH_DIR)
+
+from fixtures import SIZES, build_fixtures  # noqa: E402
+
+
+def stage_clean(files: dict, opts: dict) -> int:
+    from text_clean import clean_after_pdf_extract
+
+    raw_txt = Path(files['txt']).read_text(encoding='utf-8')
+    clean_after_pdf_extract(raw_txt)
+    return len(raw_txt)
+
+
+def stage_normalize(files: dict, opts: dict) -> int:
+    from text_clean import clean_after_pdf_extract, normalize_text
+
+    src_txt = clean_after_pdf_extract(Path(files['cjk_txt']).read_text(encoding='utf-8'))
+    normalize_text(src_txt, simplify=True)
+    return len(src_txt)
+
+
+def stage_boilerplate(files: dict, opts: dict) -> int:
+    from text_clean import BoilerplateFilter
+
+    # The fixture pages, with a running title, a copyright line and a page number added to each
+    pages = [f'Fixture Book\n{page}\nCopyright Fixture Press\n{i + 1}'
+             for i, page in enumerate(Path(files['txt']).read_text(encoding='utf-8').split('\f')[:-1])]
+    for _ in BoilerplateFilter().filter(pages):
+        pass
+    return sum(len(page) for page in pages)
+
+
+def stage_extract_pdf(files: dict, opts: dict) -> int:
+    import main
+
+    main.APP_CONFIG = {'lang': 'english'}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_txt = main.extract_from_local_pdf(files['pdf'], os.path.join(tmp_dir, 'out.txt'),
+                                              workers=opts['pdf_workers'])
+    return len(out_txt)
+
+
+def stage_extract_html(files: dict, opts: dict) -> int:
+    import main
+
+    main.APP_CONFIG = {'lang': 'chinese-普通'}
+    html_doc = Path(files['html']).read_bytes()
+    main._extract_html(html_doc)
+    return len(html_doc)
+
+
+def stage_chunk(files: dict, opts: dict) -> int:
+    from text_chunk import split_text
+    from text_clean import clean_after_pdf_extract
+
+    src_txt = clean_after_pdf_extract(Path(files['cjk_txt']).read_text(encoding='utf-8'))
+    split_text(src_txt, 16384)
+    return len(src_txt)
+
+
+def stage_convert(files: dict, opts: dict) -> int:
+    from engine_fake import FakeEngine
+    from text_clean import clean_after_pdf_extract
+
+    src_txt = clean_after_pdf_extract(Path(files['cjk_txt']).read_text(encoding='utf-8'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app_config = {
+            'fake': {'latency_ms': opts['latency_ms'], 'chars_per_sec': opts['chars_per_sec'],
+                     'workers': opts['workers']},
+            'output_audio_fn': os.path.join(tmp_dir, 'out.mp3'),
+        }
+        FakeEngine(app_config).convert(src_txt)
+    return len(src_txt)
+
+
+STAGES = {
+    'clean': stage_clean,
+    'normalize': stage_normalize,
+    'boilerplate': stage_boilerplate,
+    'extract_pdf': stage_extract_pdf,
+    'extract_html': stage_extract_html,
+    'chunk': stage_chunk,
+    'convert': stage_convert,
+}
+
+
+def _peak_rss_kb() -> int:
+    # ru_maxrss is in KiB on Linux, bytes on macOS. Children count for the process-pool stages
+    scale = 1024 if sys.platform == 'darwin' else 1
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) // scale
+
+
+def _run_stage(stage: str, files: dict, opts: dict, results: multiprocessing.Queue):
+    sys.path.insert(0, SRC_DIR)
+    try:
+        start_rss = _peak_rss_kb()
+        t0 = time.perf_counter()
+        chars = STAGES[stage](files, opts)
+        elapsed = time.perf_counter() - t0
+        results.put({
+            'seconds': round(elapsed, 4),
+            'chars': chars,
+            'chars_per_sec': round(chars / elapsed, 1) if elapsed else None,
+            'start_rss_kb': start_rss,
+            'peak_rss_kb': _peak_rss_kb(),
+        })
+    except Exception as e:
+        results.put({'error': f'{type(e).__name__}: {e}'})
+
+
+def run(sizes: list, stages: list, opts: dict) -> dict:
+    fixtures = build_fixtures(opts['fixture_dir'], sizes)
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for size in sizes:
+        for stage in stages:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=_run_stage, args=(stage, fixtures[size], opts, queue))
+            proc.start()
+            row = queue.get()
+            proc.join()
+            row = dict(stage=stage, size=size, **row)
+            print(json.dumps(row, ensure_ascii=False), file=sys.stderr)
+            results.append(row)
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'options': opts,
+        'results': results,
+    }
+
+
+def compare(current: dict, baseline: dict):
+    base_rows = {(r['stage'], r['size']): r for r in baseline['results']}
+    print(f"{'stage':<12} {'size':<8} {'seconds':>20} {'peak RSS (KiB)':>24}")
+    for row in current['results']:
+        base = base_rows.get((row['stage'], row['size']))
+        if not base or 'error' in row or 'error' in base:
+            continue
+        print(f"{row['stage']:<12} {row['size']:<8} "
+              f"{base['seconds']:>8.3f} -> {row['seconds']:<8.3f} "
+              f"{base['peak_rss_kb']:>10} -> {row['peak_rss_kb']:<10}")
+
+
+if __name__ == '__main__':
+    cli_parser = argparse.ArgumentParser(description="Offline pipeline benchmarks")
+    cli_parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['small', 'medium'])
+    cli_parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+    cli_parser.add_argument('--out', help="Write the results as JSON to this file")
+    cli_parser.add_argument('--compare', help="Results file of an earlier run to compare against")
+    cli_parser.add_argument('--fixture-dir', default=os.path.join(tempfile.gettempdir(), 'reader_bench_fixtures'))
+    cli_parser.add_argument('--latency-ms', type=float, default=200, help="Simulated per-request latency")
+    cli_parser.add_argument('--chars-per-sec', type=float, default=2000, help="Simulated engine throughput")
+    cli_parser.add_argument('--workers', type=int, default=4)
+    cli_parser.add_argument('--pdf-workers', type=int, default=None)
+    cli_opts = cli_parser.parse_args()
+
+    report = run(cli_opts.sizes, cli_opts.stages, {
+        'fixture_dir': cli_opts.fixture_dir,
+        'latency_ms': cli_opts.latency_ms,
+        'chars_per_sec': cli_opts.chars_per_sec,
+        'workers': cli_opts.workers,
+        'pdf_workers': cli_opts.pdf_workers,
+    })
+    if cli_opts.out:
+        Path(cli_opts.out).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    if cli_opts.compare:
+        compare(report, json.loads(Path(cli_opts.compare).read_text()))
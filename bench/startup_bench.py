@@ -0,0 +1,103 @@
+"""
+CLI startup cost of an extract-only run (`inspect_output: True` on a text file), which never
+synthesizes. Each sample is a fresh interpreter running src/main.py. The 'eager' variant imports
+boto3 and the Azure Speech SDK up front, the way main.py did before engines were loaded lazily:
+
+    python bench/startup_bench.py --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+MAIN_PY = os.path.realpath(os.path.join(BENCH_DIR, '..', 'src', 'main.py'))
+
+SDK_MODULES = ['boto3', 'azure.cognitiveservices.speech']
+
+# Runs main.py as __main__ after (optionally) importing the SDKs, then reports which were loaded
+_LAUNCHER = """
+import importlib, json, os, runpy, sys
+for m in sys.argv[1].split(',') if sys.argv[1] else []:
+    importlib.import_module(m)
+main_py, sdks = sys.argv[2], sys.argv[3].split(',')
+sys.argv = [main_py, '-c', sys.argv[4]]
+sys.path.insert(0, os.path.dirname(main_py))
+try:
+    runpy.run_path(main_py, run_name='__main__')
+except SystemExit:
+    pass
+print(json.dumps({m: m in sys.modules for m in sdks}), file=sys.stderr)
+"""
+
+_CONFIG = """
+text_source:
+  choices: [txt]
+  invocation: txt
+  inspect_output: True
+lang:
+  choices: [english]
+  invocation: english
+txt: {txt_fn}
+output:
+  directory: {out_dir}
+  extracted_text_dir: {out_dir}
+  invocation:
+    theme-word: startup
+engines:
+  english:
+    choices: [aws, azure]
+"""
+
+
+def _run_once(cfg_fn: str, preload: list) -> dict:
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', _LAUNCHER, ','.join(preload), MAIN_PY, ','.join(SDK_MODULES),
+                           cfg_fn], capture_output=True, text=True)
+    elapsed = time.perf_counter() - t0
+    assert proc.returncode == 0, proc.stderr
+    return {'seconds': elapsed, 'loaded': json.loads(proc.stderr.strip().splitlines()[-1])}
+
+
+def run(runs: int) -> dict:
+    retval = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        txt_fn = os.path.join(tmp_dir, 'in.txt')
+        with open(txt_fn, 'w') as fout:
+            fout.write('A short text.\n')
+        cfg_fn = os.path.join(tmp_dir, 'startup.yml')
+        with open(cfg_fn, 'w') as fout:
+            fout.write(_CONFIG.format(txt_fn=txt_fn, out_dir=tmp_dir))
+
+        for variant, preload in [('lazy', []), ('eager', SDK_MODULES)]:
+            # One warm-up, so both variants read the modules from a warm page cache
+            _run_once(cfg_fn, preload)
+            samples = [_run_once(cfg_fn, preload) for _ in range(runs)]
+            seconds = [s['seconds'] for s in samples]
+            retval[variant] = {
+                'median_sec': round(statistics.median(seconds), 4),
+                'min_sec': round(min(seconds), 4),
+                'sdks_loaded': samples[-1]['loaded'],
+            }
+            print(f"{variant:<6} median {retval[variant]['median_sec']:.3f}s  min {retval[variant]['min_sec']:.3f}s  "
+                  f"SDKs loaded: {[m for m, v in retval[variant]['sdks_loaded'].items() if v] or 'none'}",
+                  file=sys.stderr)
+    return retval
+
+
+if __name__ == '__main__':
+    cli_parser = argparse.ArgumentParser(description="Startup time of an extract-only run")
+    cli_parser.add_argument('--runs', type=int, default=10)
+    cli_parser.add_argument('--out', help="Write the results as JSON to this file")
+    cli_opts = cli_parser.parse_args()
+
+    report = run(cli_opts.runs)
+    if cli_opts.out:
+        with open(cli_opts.out, 'w') as fout:
+            json.dump(report, fout, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -3,12 +3,11 @@
 SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
 cd $SCRIPT_DIR
 
+source $HOME/.ssh/speech.env
+export PYTHONLIB=$PYTHONLIB:$PWD/src
+
 dialets="河南 普通 四川 山东 台湾 广东 陕西"
-for d in $dialets
-do
-  date +"[%D %T] Generating output file for $d"
-  perl -pi -e "s/invocation:\s+chinese-.*/invocation: chinese-$d/;s/theme-word:\s*([^\s|\.]+).*/theme-word: \$1.$d/" my.yml
-#  cat my.yml
-  ./read.sh
-  date +"[%D %T] Done"
-done
\ No newline at end of file
+date +"[%D %T] Generating output files for $dialets"
+# One process: the text is extracted once and all dialects are synthesized concurrently
+python ${SCRIPT_DIR}/src/main.py -c ${SCRIPT_DIR}/my.yml --langs $dialets
+date +"[%D %T] Done"
@@ -0,0 +1,362 @@
+"""
+Joins MP3 segments into one file at frame boundaries, without decoding anything.
+
+Every segment loses its ID3 tags and its Xing/Info/VBRI header frame. Silence between segments
+is made of frames with an empty body. The output gets a single Xing (or, for constant bitrate,
+Info) frame up front, holding the frame count, byte count and seek table, so players show the
+right duration and can seek.
+
+Only MPEG Layer III is handled: Azure's Audio24Khz48KBitRateMonoMp3 (MPEG-2, 24 kHz, 48 kbps,
+mono) and Polly's mp3 (MPEG-2 at 22.05 or 24 kHz) are both that.
+
+    python src/audio_assemble.py out.mp3 part1.mp3 part2.mp3 --pause-ms 500
+"""
+import argparse
+import logging
+import mmap
+import os
+import struct
+from array import array
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Layer III bitrates in kbps, by bitrate index. MPEG-2 and 2.5 share a table
+_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# Sample rates by MPEG version bits (0: 2.5, 2: MPEG-2, 3: MPEG-1) and sample rate index
+_SAMPLE_RATES = {
+    0: [11025, 12000, 8000],
+    2: [22050, 24000, 16000],
+    3: [44100, 48000, 32000],
+}
+_MONO = 3
+_XING_FLAGS = 0x07  # frame count, byte count, seek table
+_XING_SIZE = 4 + 4 + 4 + 4 + 100
+# Frame offsets kept for the seek table: one every this many frames
+_OFFSET_STEP = 16
+
+Segment = Union[bytes, bytearray, str]
+
+
+class FrameHeader(NamedTuple):
+    version: int  # the raw version bits, keys of _SAMPLE_RATES
+    bitrate_index: int
+    sample_rate_index: int
+    padding: int
+    protected: bool  # a 16-bit CRC follows the header
+    channel_mode: int
+    raw: bytes
+
+    @property
+    def mpeg1(self) -> bool:
+        return self.version == 3
+
+    @property
+    def bitrate(self) -> int:
+        return _BITRATES[1 if self.mpeg1 else 2][self.bitrate_index] * 1000
+
+    @property
+    def sample_rate(self) -> int:
+        return _SAMPLE_RATES[self.version][self.sample_rate_index]
+
+    @property
+    def samples(self) -> int:
+        return 1152 if self.mpeg1 else 576
+
+    @property
+    def length(self) -> int:
+        return (144 if self.mpeg1 else 72) * self.bitrate // self.sample_rate + self.padding
+
+    @property
+    def side_info_size(self) -> int:
+        if self.mpeg1:
+            return 17 if self.channel_mode == _MONO else 32
+        return 9 if self.channel_mode == _MONO else 17
+
+    def stream_format(self) -> Tuple[int, int, int]:
+        # What has to stay the same for segments to play back as one stream
+        return self.version, self.sample_rate_index, self.channel_mode == _MONO
+
+    def describe(self) -> str:
+        return (f"MPEG-{'1' if self.mpeg1 else ('2' if self.version == 2 else '2.5')} Layer III, "
+                f"{self.sample_rate} Hz, {self.bitrate // 1000} kbps, {'mono' if self.channel_mode == _MONO else 'stereo'}")
+
+
+def parse_header(buf, pos: int) -> Optional[FrameHeader]:
+    """
+    The Layer III frame header at buf[pos], or None if there is none
+    """
+    if pos + 4 > len(buf):
+        return None
+    b0, b1, b2, b3 = buf[pos], buf[pos + 1], buf[pos + 2], buf[pos + 3]
+    if b0 != 0xFF or b1 & 0xE0 != 0xE0:
+        return None
+    version = (b1 >> 3) & 3
+    layer = (b1 >> 1) & 3
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 3
+    # Reserved values, free format (bitrate index 0) and layers other than III are not for us
+    if version == 1 or layer != 1 or bitrate_index in [0, 15] or sample_rate_index == 3:
+        return None
+    return FrameHeader(version, bitrate_index, sample_rate_index, (b2 >> 1) & 1, not (b1 & 1), b3 >> 6,
+                       bytes([b0, b1, b2, b3]))
+
+
+def _id3v2_size(buf, pos: int) -> int:
+    # 'ID3', version, flags, then a 28-bit "syncsafe" size; bit 4 of the flags adds a 10-byte footer
+    if buf[pos:pos + 3] != b'ID3' or pos + 10 > len(buf):
+        return 0
+    size = 0
+    for b in buf[pos + 6:pos + 10]:
+        size = (size << 7) | (b & 0x7F)
+    return 10 + size + (10 if buf[pos + 5] & 0x10 else 0)
+
+
+def is_info_frame(buf, pos: int, hdr: FrameHeader) -> bool:
+    """
+    Whether the frame at pos is an encoder's Xing/Info or VBRI header rather than audio
+    """
+    tag_pos = pos + 4 + (2 if hdr.protected else 0) + hdr.side_info_size
+    return buf[tag_pos:tag_pos + 4] in [b'Xing', b'Info'] or buf[pos + 36:pos + 40] == b'VBRI'
+
+
+def iter_frames(buf) -> Iterator[Tuple[int, FrameHeader]]:
+    """
+    (offset, header) of the audio frames in buf (bytes or mmap), in order. ID3v2 tags, a trailing
+    ID3v1 tag, header frames and junk between frames are skipped. After junk, a frame only counts
+    if another one follows it, so stray 0xFF bytes are not mistaken for a header
+    """
+    end = len(buf)
+    if end >= 128 and buf[end - 128:end - 125] == b'TAG':
+        end -= 128
+    # A stream repeats a handful of distinct headers; parse each only once
+    known = {}
+    pos = 0
+    synced = False
+    while pos < end:
+        raw = buf[pos:pos + 4]
+        hdr = known.get(raw) if synced else None
+        if hdr is not None and pos + hdr.length <= end:
+            yield pos, hdr
+            pos += hdr.length
+            continue
+
+        tag_size = _id3v2_size(buf, pos)
+        if tag_size:
+            pos += tag_size
+            synced = False
+            continue
+
+        hdr = parse_header(buf, pos)
+        if hdr is not None and pos + hdr.length <= end:
+            nxt = pos + hdr.length
+            nxt_hdr = parse_header(buf, nxt) if nxt < end else None
+            if synced or nxt >= end or (nxt_hdr is not None and nxt_hdr.stream_format() == hdr.stream_format()):
+                # Encoders put their info frame first
+                if synced or not is_info_frame(buf, pos, hdr):
+                    yield pos, hdr
+                known[raw] = hdr
+                pos = nxt
+                synced = True
+                continue
+
+        # Lost sync: go looking for the next header
+        synced = False
+        found = buf.find(b'\xff', pos + 1, end)
+        if found < 0:
+            break
+        pos = found
+
+
+def is_mp3(buf) -> bool:
+    # Any audio frame at all; other output formats (wav, ogg, raw PCM) go through untouched
+    return next(iter_frames(buf), None) is not None
+
+
+def mp3_duration_sec(fn: str) -> Optional[float]:
+    # Length of an MP3 file by its frames; None when it holds none
+    if os.path.getsize(fn) == 0:
+        return None
+    with open(fn, 'rb') as fin, mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        duration = 0.0
+        for _, hdr in iter_frames(mm):
+            duration += hdr.samples / hdr.sample_rate
+    return duration or None
+
+
+def silent_frame(like: FrameHeader, bitrate_index: Optional[int] = None) -> bytes:
+    """
+    A frame in the format of `like` that decodes to silence: no CRC, no padding, all-zero side info
+    (so no bits of audio data and no bit reservoir), and a zero body
+    """
+    hdr = bytearray(like.raw)
+    hdr[1] |= 1
+    bitrate_index = like.bitrate_index if bitrate_index is None else bitrate_index
+    hdr[2] = (bitrate_index << 4) | (like.sample_rate_index << 2) | (hdr[2] & 1)
+    return bytes(hdr) + bytes(parse_header(hdr, 0).length - 4)
+
+
+def _xing_frame(like: FrameHeader, tag: bytes, frames: int, total_bytes: int, toc: bytes) -> bytes:
+    # A silent frame carrying the Xing/Info tag after its side info. It takes the first bitrate,
+    # at or above the stream's, whose frame is large enough for the tag
+    offset = 4 + like.side_info_size
+    for bitrate_index in range(like.bitrate_index, 15):
+        frame = bytearray(silent_frame(like, bitrate_index))
+        if len(frame) >= offset + _XING_SIZE:
+            frame[offset:offset + _XING_SIZE] = tag + struct.pack('>III', _XING_FLAGS, frames, total_bytes) + toc
+            return bytes(frame)
+    raise ValueError(f'No {like.describe()} frame can hold a Xing header')
+
+
+def _xing_frame_size(like: FrameHeader) -> int:
+    return len(_xing_frame(like, b'Xing', 0, 0, bytes(100)))
+
+
+class Mp3Assembler(object):
+    """
+    Writes MP3 segments (bytes, or file names, which are memory-mapped) to out_fn back to back,
+    frame by frame. Runs of frames go out as memoryview slices of the input, so nothing is copied.
+    Use as a context manager; the output is complete once it is closed
+    """
+
+    def __init__(self, out_fn: str):
+        self.out_fn = out_fn
+        self.frames = 0
+        self.bytes_written = 0
+        self.segments = 0
+        self._fmt: Optional[FrameHeader] = None
+        self._bitrates = set()
+        self._silence = b''
+        self._pending_silence_sec = 0.0
+        self._offsets = array('Q')
+        self._header_size = 0
+        self._fout = open(out_fn, 'wb')
+
+    @property
+    def duration_sec(self) -> float:
+        return self.frames * self._fmt.samples / self._fmt.sample_rate if self._fmt else 0.0
+
+    def __enter__(self) -> 'Mp3Assembler':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(complete=exc_type is None)
+
+    def _count_frame(self, length: int):
+        if self.frames % _OFFSET_STEP == 0:
+            self._offsets.append(self.bytes_written)
+        self.frames += 1
+        self.bytes_written += length
+
+    def _start(self, hdr: FrameHeader):
+        # The first frame fixes the stream's format. Room for the Xing frame is kept up front
+        self._fmt = hdr
+        self._silence = silent_frame(hdr)
+        self._header_size = _xing_frame_size(hdr)
+        self._fout.write(bytes(self._header_size))
+        self.bytes_written += self._header_size
+        logger.debug(f'Assembling {hdr.describe()} into {self.out_fn}')
+
+    def add_silence(self, sec: float):
+        # Whole frames, so the pause is rounded to the frame duration (24 ms at 24 kHz)
+        self._pending_silence_sec += sec
+        if self._fmt is None:
+            return
+        frame_sec = self._fmt.samples / self._fmt.sample_rate
+        cnt = int(round(self._pending_silence_sec / frame_sec))
+        self._pending_silence_sec -= cnt * frame_sec
+        for _ in range(cnt):
+            self._count_frame(len(self._silence))
+        if cnt:
+            self._fout.write(self._silence * cnt)
+            self._bitrates.add(self._fmt.bitrate_index)
+
+    def add(self, segment: Segment):
+        if isinstance(segment, str):
+            if os.path.getsize(segment) == 0:
+                return
+            with open(segment, 'rb') as fin, mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                self._add_buffer(mm)
+        else:
+            self._add_buffer(segment)
+
+    def _add_buffer(self, buf):
+        self.segments += 1
+        seen = set()
+        with memoryview(buf) as view:
+            run_start = run_end = None
+            for pos, hdr in iter_frames(buf):
+                if hdr.raw not in seen:
+                    # Once per distinct header, not per frame
+                    seen.add(hdr.raw)
+                    self._bitrates.add(hdr.bitrate_index)
+                    if self._fmt is None:
+                        self._start(hdr)
+                        # Silence asked for before the format was known
+                        self.add_silence(0)
+                    elif hdr.stream_format() != self._fmt.stream_format():
+                        logger.warning(f'Segment {self.segments} is {hdr.describe()}, unlike the '
+                                       f'{self._fmt.describe()} before it; players may not cope')
+
+                if pos != run_end:
+                    # Skipped something (a tag, an info frame, junk): flush the run so far
+                    if run_start is not None:
+                        self._fout.write(view[run_start:run_end])
+                    run_start = pos
+                run_end = pos + hdr.length
+                self._count_frame(hdr.length)
+            if run_start is not None:
+                self._fout.write(view[run_start:run_end])
+
+    def _toc(self) -> bytes:
+        # Byte position, as a fraction of the file in 1/256ths, at each percent of the duration
+        total = max(1, self.bytes_written)
+        toc = bytearray(100)
+        for i in range(100):
+            frame = self.frames * i // 100
+            pos = self._offsets[min(len(self._offsets) - 1, frame // _OFFSET_STEP)] if self._offsets else 0
+            toc[i] = min(255, pos * 256 // total)
+        return bytes(toc)
+
+    def close(self, complete: bool = True):
+        if self._fout.closed:
+            return
+        if complete and self._fmt is not None:
+            tag = b'Info' if len(self._bitrates) == 1 else b'Xing'
+            xing = _xing_frame(self._fmt, tag, self.frames, self.bytes_written, self._toc())
+            self._fout.seek(0)
+            self._fout.write(xing)
+        self._fout.close()
+        if complete and self._fmt is not None:
+            logger.debug(f'{self.out_fn}: {self.segments} segments, {self.frames} frames, '
+                         f'{self.duration_sec:.1f}s, {self.bytes_written} bytes')
+
+
+def assemble(out_fn: str, segments, pause_sec: float = 0.0) -> Mp3Assembler:
+    """
+    Joins the segments (bytes or file names) into out_fn, with pause_sec of silence between them
+    """
+    with Mp3Assembler(out_fn) as asm:
+        for i, segment in enumerate(segments):
+            if i and pause_sec:
+                asm.add_silence(pause_sec)
+            asm.add(segment)
+    return asm
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format="%(asctime)s  %(levelname)s %(message)s", level=logging.DEBUG)
+    cli_parser = argparse.ArgumentParser(description="Join MP3 files at frame boundaries, without re-encoding")
+    cli_parser.add_argument('out_fn')
+    cli_parser.add_argument('segment_fns', nargs='+')
+    cli_parser.add_argument('--pause-ms', type=int, default=0, help="Silence between the files")
+    cli_opts = cli_parser.parse_args()
+
+    Path(os.path.realpath(os.path.dirname(cli_opts.out_fn))).mkdir(parents=True, exist_ok=True)
+    result = assemble(cli_opts.out_fn, cli_opts.segment_fns, cli_opts.pause_ms / 1000)
+    print(f'{cli_opts.out_fn}: {result.frames} frames, {result.duration_sec:.1f}s')
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class SegmentCache(object):
+    """
+    Content-addressed, size-limited on-disk store of synthesized audio segments.
+    One file per segment, named after its key; the file mtime doubles as the LRU timestamp
+    so the recency order survives between runs
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_served = 0
+        self._lock = threading.Lock()
+        self._entries: Dict[str, int] = OrderedDict()
+        self._total_bytes = 0
+
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        found = []
+        for entry in os.scandir(cache_dir):
+            if entry.is_file() and entry.name.endswith('.seg'):
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name[:-4], st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+
+    @staticmethod
+    def make_key(txt: str, voice_sig: dict) -> str:
+        txt_hash = hashlib.sha256(txt.encode('utf-8')).hexdigest()
+        sig = json.dumps(voice_sig, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(f'{sig}\n{txt_hash}'.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.seg')
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+
+        try:
+            data = Path(self._path(key)).read_bytes()
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            # Removed behind our back (e.g. by another process evicting)
+            with self._lock:
+                self._total_bytes -= self._entries.pop(key, 0)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self.bytes_served += len(data)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+
+        tmp_fn = f'{self._path(key)}.{threading.get_ident()}.tmp'
+        with open(tmp_fn, 'wb') as fout:
+            fout.write(data)
+        os.replace(tmp_fn, self._path(key))
+
+        with self._lock:
+            self._total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            while self._total_bytes > self.max_bytes:
+                old_key, old_size = self._entries.popitem(last=False)
+                self._total_bytes -= old_size
+                self.evictions += 1
+                try:
+                    os.remove(self._path(old_key))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes_served': self.bytes_served,
+                'entries': len(self._entries),
+                'total_bytes': self._total_bytes,
+            }
+
+
+_caches: Dict[str, SegmentCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_segment_cache(app_config: dict) -> Optional[SegmentCache]:
+    # Engines in the same process share one cache instance per directory
+    cache_cfg = app_config.get('cache') or {}
+    if not cache_cfg.get('directory'):
+        return None
+
+    cache_dir = os.path.realpath(os.path.expanduser(cache_cfg['directory']))
+    max_bytes = int(float(cache_cfg.get('max_mb') or 2048) * 1024 * 1024)
+    with _caches_lock:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = SegmentCache(os.path.join(cache_dir, 'segments'), max_bytes)
+            logger.debug(f"Audio segment cache at {cache_dir}, limit {max_bytes} bytes")
+        return _caches[cache_dir]
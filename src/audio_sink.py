@@ -0,0 +1,69 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class OrderedAudioWriter(object):
+    """
+    Appends audio to the output file (or stdout, for out_fn '-') while synthesis is still running.
+    Segments arrive in any order and in pieces; pieces of the segment at the head of the line go
+    out immediately, everything else is held until all earlier segments are finished
+    """
+
+    def __init__(self, out_fn: str):
+        self.out_fn = out_fn
+        self.start_time = time.monotonic()
+        self.time_to_first_audio: Optional[float] = None
+        self.bytes_written = 0
+
+        self._lock = threading.Lock()
+        self._next = 0
+        self._pending: Dict[int, List[bytes]] = defaultdict(list)
+        self._finished: Set[int] = set()
+
+        if out_fn == '-':
+            self._fout = sys.stdout.buffer
+        else:
+            Path(os.path.realpath(os.path.dirname(out_fn))).mkdir(parents=True, exist_ok=True)
+            self._fout = open(out_fn, 'wb')
+
+    def _emit(self, data: bytes):
+        if not data:
+            return
+        if self.time_to_first_audio is None:
+            self.time_to_first_audio = time.monotonic() - self.start_time
+            logger.info(f"Time to first audio: {self.time_to_first_audio:.2f}s")
+        self._fout.write(data)
+        self._fout.flush()
+        self.bytes_written += len(data)
+
+    def write(self, index: int, data: bytes):
+        with self._lock:
+            if index == self._next:
+                self._emit(data)
+            else:
+                self._pending[index].append(data)
+
+    def finish(self, index: int):
+        with self._lock:
+            self._finished.add(index)
+            while self._next in self._finished:
+                self._finished.discard(self._next)
+                self._next += 1
+                for data in self._pending.pop(self._next, []):
+                    self._emit(data)
+
+    def close(self):
+        with self._lock:
+            if self._pending or self._finished:
+                logger.warning(f"Output is incomplete: audio after segment {self._next - 1} was never written")
+            if self._fout is not sys.stdout.buffer:
+                self._fout.close()
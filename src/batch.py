@@ -0,0 +1,379 @@
+"""
+Batch conversion: many documents from one manifest, on top of the settings of my.yml.
+
+    python src/main.py -c my.yml --batch books.yml [--batch-jobs 2] [--extract-workers 4]
+
+The manifest is YAML (a list, or a mapping with a 'documents' list) or JSONL (one object per
+line). Every document names one source, 'pdf', 'url' or 'txt', and may override 'lang',
+'engine', 'theme-word' and 'pages':
+
+    documents:
+      - pdf: ~/Downloads/book1.pdf
+      - pdf: ~/Downloads/book2.pdf
+        pages: 12-40
+        theme-word: book2_part1
+      - url: https://example.com/article
+        lang: chinese-四川
+        engine: azure
+
+PDF pages of all documents are extracted on one process pool, in batches taken from a shared
+queue, so no process sits idle while any document still has pages left. Web pages and text files
+are read on threads. A document is handed to synthesis (threads, with warm engines and one
+shared pool of requests) as soon as its text is ready, so synthesis of the first documents
+overlaps the extraction of the later ones. Documents with byte-identical sources are extracted
+once, and synthesized once if their voice settings match too; the others get copies
+"""
+import copy
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import yaml
+
+from daemon import EnginePool
+from engine_registry import engine_names
+from extract_cache import file_fingerprint, get_extract_cache
+from instrument import span
+from main import _parse_dir, extract_text, finish_pdf_text, pdf_cache_key, what_engine_to_use
+from pdf_extract import count_pages, extract_page_batch, parse_page_range, split_page_batches
+from plan import record_run
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+SOURCE_KEYS = ['pdf', 'url', 'txt']
+FINAL_STATES = ['done', 'failed']
+
+
+def load_manifest(manifest_fn: str) -> List[dict]:
+    text = Path(manifest_fn).read_text(encoding='utf-8')
+    if manifest_fn.endswith(('.jsonl', '.ndjson')):
+        entries = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        loaded = yaml.safe_load(text) or []
+        entries = loaded.get('documents') or [] if isinstance(loaded, dict) else loaded
+    for i, entry in enumerate(entries, 1):
+        assert isinstance(entry, dict), f"Entry {i} of {manifest_fn} is not a mapping"
+        sources = [k for k in SOURCE_KEYS if entry.get(k)]
+        assert len(sources) == 1, f"Entry {i} of {manifest_fn} needs exactly one of {', '.join(SOURCE_KEYS)}"
+    return entries
+
+
+def _default_theme(kind: str, source) -> str:
+    if kind == 'url':
+        parts = urlsplit(source if isinstance(source, str) else source[0])
+        name = parts.path.rstrip('/').rsplit('/', 1)[-1] or parts.netloc
+    else:
+        name = Path(source).stem
+    return re.sub(r'[^\w.-]+', '_', os.path.splitext(name)[0]) or kind
+
+
+def config_for_document(app_config: dict, entry: dict) -> dict:
+    conf = copy.deepcopy(app_config)
+    kind = next(k for k in SOURCE_KEYS if entry.get(k))
+    for k in SOURCE_KEYS + ['pages']:
+        conf.pop(k, None)
+    conf[kind] = entry[kind] if kind == 'url' else _parse_dir(str(entry[kind]))
+    if entry.get('pages'):
+        conf['pages'] = entry['pages']
+
+    lang = entry.get('lang')
+    if lang and lang != conf['lang']:
+        conf['lang'] = lang
+        conf['lang_prefix'] = lang.split('-')[0]
+        assert conf['engines'].get(conf['lang_prefix']), f"Cannot find matching Engine for '{lang}'"
+        # The locale/voice pinned in the config file belong to its own 'lang', not to this one
+        conf['azure'] = dict(conf.get('azure') or {}, locale=None, voice_name=None)
+    if entry.get('engine'):
+        conf['engines'] = dict(conf['engines'], invocation=entry['engine'])
+
+    theme = str(entry.get('theme-word') or _default_theme(kind, conf[kind]))
+    conf['invocation-theme-word'] = theme
+    conf['output_extracted_txt_fn'] = os.path.join(os.path.dirname(app_config['output_extracted_txt_fn']),
+                                                   theme + '.extracted.txt')
+    conf['output_audio_fn'] = os.path.join(os.path.dirname(app_config['output_audio_fn']), theme + '.mp3')
+    return conf
+
+
+class _Doc(object):
+    def __init__(self, index: int, conf: dict):
+        self.index = index
+        self.conf = conf
+        self.name = conf['invocation-theme-word']
+        self.kind = next(k for k in SOURCE_KEYS if conf.get(k))
+        self.source = conf[self.kind]
+        self.state = 'queued'
+        self.detail = ''
+        self.error: Optional[str] = None
+        self.fingerprint: Optional[str] = None
+        self.text: Optional[str] = None
+        self.page_texts: List[Optional[List[str]]] = []
+        self.batches_done = 0
+        self.pages_total = 0
+        self.pages_done = 0
+        # Documents waiting on this one's extraction, or its audio
+        self.extract_followers: List['_Doc'] = []
+        self.output_followers: List['_Doc'] = []
+        self.times: Dict[str, float] = {}
+        self.metrics = {}
+
+    def seconds(self, start: str, end: str) -> Optional[float]:
+        if start in self.times and end in self.times:
+            return self.times[end] - self.times[start]
+        return None
+
+
+class BatchRunner(object):
+    def __init__(self, app_config: dict, entries: List[dict], extract_workers: Optional[int] = None,
+                 synth_jobs: int = 2, concurrency: int = 8, report_every_sec: float = 10):
+        assert app_config.get('output_audio_fn') not in [None, '-'], "Batch runs need an output directory"
+        self.extract_workers = extract_workers or os.cpu_count() or 1
+        self.synth_jobs = synth_jobs
+        self.concurrency = concurrency
+        self.report_every_sec = report_every_sec
+        self.extract_only = bool(app_config.get('inspect_extract_txt'))
+
+        self.docs: List[_Doc] = []
+        names = set()
+        for i, entry in enumerate(entries, 1):
+            conf = config_for_document(app_config, entry)
+            if conf['invocation-theme-word'] in names:
+                # Two documents must not write the same output files
+                conf = config_for_document(app_config, dict(entry, **{'theme-word': f"{conf['invocation-theme-word']}.{i}"}))
+            names.add(conf['invocation-theme-word'])
+            self.docs.append(_Doc(i, conf))
+
+        self._pending: Dict[Future, Tuple[str, _Doc, int]] = {}
+        self._output_leaders: Dict[str, _Doc] = {}
+        self._lock = threading.Lock()
+
+    def _set_state(self, doc: _Doc, state: str, detail: str = ''):
+        with self._lock:
+            doc.state = state
+            doc.detail = detail
+            doc.times[state] = time.monotonic()
+        logger.info(f"[{doc.index}/{len(self.docs)}] {doc.name}: {state}{' (' + detail + ')' if detail else ''}")
+
+    def _submit(self, pool, step: str, doc: _Doc, fn: Callable, *args, part: int = 0):
+        self._pending[pool.submit(fn, *args)] = (step, doc, part)
+
+    # Keys for deduplication
+
+    def _extract_key(self, doc: _Doc) -> str:
+        if doc.kind == 'url':
+            content = json.dumps(doc.source)
+        else:
+            doc.fingerprint = file_fingerprint(doc.source)
+            content = doc.fingerprint
+        return json.dumps([doc.kind, content, str(doc.conf.get('pages') or ''), doc.conf.get('normalize_text', True),
+                           doc.conf.get('strip_boilerplate', True), doc.conf['lang']])
+
+    @staticmethod
+    def _output_key(doc: _Doc, extract_key: str) -> str:
+        # Everything that shapes the audio: the text, and the settings of every engine that may be involved
+        conf = doc.conf
+        return json.dumps([extract_key, what_engine_to_use(conf), conf['engines'], conf.get('output_paragraph_pause_ms'),
+                           {name: conf.get(name) for name in engine_names()}], sort_keys=True, default=str)
+
+    # Steps
+
+    def _start(self, doc: _Doc):
+        self._set_state(doc, 'extracting')
+        if doc.kind != 'pdf':
+            self._submit(self.io_pool, 'extracted', doc, extract_text, doc.conf)
+            return
+
+        ex_cache = get_extract_cache(doc.conf)
+        cached, _ = ex_cache.get(self._pdf_cache_key(doc)) if ex_cache else (None, {})
+        if cached is not None:
+            logger.info(f'{doc.name}: PDF file is unchanged, reusing the previous extraction')
+            self._submit(self.io_pool, 'extracted', doc, self._save_text, doc, cached)
+        else:
+            self._submit(self.cpu_pool, 'counted', doc, count_pages, doc.source)
+
+    def _counted(self, doc: _Doc, page_cnt: int):
+        pages = doc.conf.get('pages')
+        page_numbers = parse_page_range(pages, page_cnt) if pages else list(range(page_cnt))
+        batches = split_page_batches(page_numbers, self.extract_workers)
+        doc.page_texts = [None] * len(batches)
+        doc.pages_total = len(page_numbers)
+        doc.detail = f'0/{doc.pages_total} pages'
+        for i, batch in enumerate(batches):
+            self._submit(self.cpu_pool, 'batch', doc, extract_page_batch, doc.source, batch, part=i)
+
+    def _batch_done(self, doc: _Doc, part: int, page_texts: List[str]):
+        doc.page_texts[part] = page_texts
+        doc.batches_done += 1
+        doc.pages_done += len(page_texts)
+        with self._lock:
+            doc.detail = f'{doc.pages_done}/{doc.pages_total} pages'
+        if doc.batches_done == len(doc.page_texts):
+            page_texts = [page for batch in doc.page_texts for page in batch]
+            doc.page_texts = []
+            self._submit(self.io_pool, 'extracted', doc, self._finish_pdf, doc, page_texts)
+
+    def _finish_pdf(self, doc: _Doc, page_texts: List[str]) -> str:
+        text = finish_pdf_text(page_texts, doc.conf.get('normalize_text', True), doc.conf.get('strip_boilerplate', True))
+        ex_cache = get_extract_cache(doc.conf)
+        if ex_cache:
+            ex_cache.put(self._pdf_cache_key(doc), text)
+        return self._save_text(doc, text)
+
+    @staticmethod
+    def _pdf_cache_key(doc: _Doc) -> str:
+        return pdf_cache_key(doc.source, doc.conf.get('pages'), doc.conf.get('normalize_text', True), doc.fingerprint,
+                             strip_boilerplate=doc.conf.get('strip_boilerplate', True))
+
+    @staticmethod
+    def _save_text(doc: _Doc, text: str) -> str:
+        with span('write_extracted_txt', doc=doc.name, chars=len(text)), \
+                open(doc.conf['output_extracted_txt_fn'], 'w') as fout:
+            fout.write(text)
+        return text
+
+    def _extracted(self, doc: _Doc, text: str):
+        for member in [doc] + doc.extract_followers:
+            if member is not doc:
+                self._save_text(member, text)
+            member.metrics['chars'] = len(text)
+            self._set_state(member, 'extracted', f'{len(text)} chars' + (f', same source as {doc.name}'
+                                                                         if member is not doc else ''))
+            if self.extract_only:
+                self._set_state(member, 'done')
+                continue
+
+            leader = self._output_leaders.get(member.output_key)
+            if leader is not None:
+                leader.output_followers.append(member)
+                self._set_state(member, 'waiting', f'same audio as {leader.name}')
+                continue
+            self._output_leaders[member.output_key] = member
+            member.text = text
+            self._set_state(member, 'queued for synthesis')
+            self._submit(self.synth_pool, 'synthesized', member, self._synthesize, member)
+
+    def _synthesize(self, doc: _Doc) -> dict:
+        self._set_state(doc, 'synthesizing')
+        key, eng = self.engines.checkout(doc.conf)
+        try:
+            with span('convert', doc=doc.name, engine=type(eng).__name__, chars=len(doc.text)), \
+                    record_run(doc.conf, eng, doc.text) as run:
+                run['ok'] = eng.convert(doc.text)
+            return dict(eng.metrics)
+        finally:
+            self.engines.checkin(key, eng)
+            doc.text = None
+
+    def _synthesized(self, doc: _Doc, metrics: dict):
+        doc.metrics.update(metrics)
+        self._set_state(doc, 'done', doc.conf['output_audio_fn'])
+        for follower in doc.output_followers:
+            shutil.copyfile(doc.conf['output_audio_fn'], follower.conf['output_audio_fn'])
+            follower.metrics.update(metrics)
+            self._set_state(follower, 'done', f"copy of {doc.name}, {follower.conf['output_audio_fn']}")
+
+    def _fail(self, doc: _Doc, e: BaseException):
+        logger.error(f'{doc.name} FAILED: {type(e).__name__}: {e}', exc_info=not isinstance(e, AssertionError))
+        doc.error = f'{type(e).__name__}: {e}'
+        self._set_state(doc, 'failed', doc.error)
+        doc.text = None
+        for follower in doc.extract_followers + doc.output_followers:
+            if follower.state not in FINAL_STATES:
+                follower.error = f'same source as {doc.name}, which failed'
+                self._set_state(follower, 'failed', follower.error)
+
+    # Progress
+
+    def _report(self):
+        with self._lock:
+            counts = {}
+            for doc in self.docs:
+                counts[doc.state] = counts.get(doc.state, 0) + 1
+            active = [f'{d.name}: {d.state}{" " + d.detail if d.detail else ""}' for d in self.docs
+                      if d.state in ['extracting', 'synthesizing']]
+        logger.info(f"Progress: {', '.join(f'{v} {k}' for k, v in sorted(counts.items()))}"
+                    + ''.join(f'\n    {line}' for line in active))
+
+    def summary(self, wall_sec: float) -> str:
+        lines = [f"{'#':>3}  {'document':<28} {'state':<8} {'extract s':>9} {'synth s':>8} {'chars':>9}  output"]
+        extract_total = synth_total = 0.0
+        for doc in self.docs:
+            ex_sec = doc.seconds('extracting', 'extracted')
+            syn_sec = doc.seconds('synthesizing', 'done')
+            extract_total += ex_sec or 0
+            synth_total += syn_sec or 0
+            lines.append(f"{doc.index:>3}  {doc.name[:28]:<28} {doc.state:<8} "
+                         f"{'-' if ex_sec is None else f'{ex_sec:.1f}':>9} {'-' if syn_sec is None else f'{syn_sec:.1f}':>8} "
+                         f"{doc.metrics.get('chars', '-'):>9}  {doc.error or doc.conf['output_audio_fn']}")
+        lines.append(f"Wall time {wall_sec:.1f}s; extraction {extract_total:.1f}s and synthesis {synth_total:.1f}s "
+                     f"summed over documents")
+        return '\n'.join(lines)
+
+    def run(self) -> List[_Doc]:
+        t0 = time.monotonic()
+        with ProcessPoolExecutor(max_workers=self.extract_workers) as self.cpu_pool, \
+                ThreadPoolExecutor(max_workers=4, thread_name_prefix='extract') as self.io_pool, \
+                ThreadPoolExecutor(max_workers=self.synth_jobs, thread_name_prefix='synth') as self.synth_pool, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as request_pool:
+            # Chunk requests of all documents share one bounded pool; engines stay warm between documents
+            self.engines = EnginePool(request_pool)
+
+            extract_leaders: Dict[str, _Doc] = {}
+            for doc in self.docs:
+                try:
+                    extract_key = self._extract_key(doc)
+                    doc.output_key = self._output_key(doc, extract_key)
+                except Exception as e:
+                    self._fail(doc, e)
+                    continue
+                leader = extract_leaders.get(extract_key)
+                if leader is not None:
+                    leader.extract_followers.append(doc)
+                    self._set_state(doc, 'waiting', f'same source as {leader.name}')
+                    continue
+                extract_leaders[extract_key] = doc
+                self._start(doc)
+
+            steps = {
+                'counted': lambda doc, part, result: self._counted(doc, result),
+                'batch': self._batch_done,
+                'extracted': lambda doc, part, result: self._extracted(doc, result),
+                'synthesized': lambda doc, part, result: self._synthesized(doc, result),
+            }
+            last_report = time.monotonic()
+            while self._pending:
+                done, _ = wait(list(self._pending), timeout=self.report_every_sec, return_when=FIRST_COMPLETED)
+                if time.monotonic() - last_report >= self.report_every_sec:
+                    self._report()
+                    last_report = time.monotonic()
+                for f in done:
+                    step, doc, part = self._pending.pop(f)
+                    if doc.state == 'failed':
+                        continue
+                    try:
+                        steps[step](doc, part, f.result())
+                    except Exception as e:
+                        self._fail(doc, e)
+
+        logger.info('Batch finished\n' + self.summary(time.monotonic() - t0))
+        return self.docs
+
+
+def run_batch(app_config: dict, manifest_fn: str, extract_workers: Optional[int] = None, synth_jobs: int = 2,
+              concurrency: int = 8) -> int:
+    """
+    Converts every document of the manifest. Returns the number of documents that failed
+    """
+    entries = load_manifest(manifest_fn)
+    logger.info(f'{len(entries)} documents in {manifest_fn}')
+    docs = BatchRunner(app_config, entries, extract_workers=extract_workers, synth_jobs=synth_jobs,
+                       concurrency=concurrency).run()
+    return sum(1 for doc in docs if doc.state == 'failed')
@@ -0,0 +1,468 @@
+"""
+Long-running synthesis server. Engines are built once and kept warm between jobs, so back-to-back
+jobs skip interpreter start-up, SDK imports and client set-up.
+
+    python src/daemon.py --port 8765 --output-dir ~/Desktop     # or: --socket /tmp/reader.sock
+    python src/main.py -c my.yml --submit http://127.0.0.1:8765
+
+Every request carries 'Authorization: Bearer <token>', the token the daemon writes to
+~/.reader_daemon.token (mode 600) when it starts, or READER_DAEMON_TOKEN when that is set. Requests
+with an Origin header (i.e. from a web page) are refused, and POSTs must be application/json. A job
+may only set the config keys in JOB_KEYS and write inside the daemon's --output-dir.
+
+API (JSON over HTTP, on TCP or a Unix socket):
+    POST /jobs               {"config": <dict from process_config>, "priority": 0} -> {"id": ...}
+    GET  /jobs               all jobs
+    GET  /jobs/<id>          one job: state, output file names, error, metrics
+    GET  /jobs/<id>/events   the job's state changes as newline-delimited JSON, until it ends
+"""
+import argparse
+import hmac
+import http.client
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import secrets
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from engine_base import VoiceEngine
+from engine_registry import engine_names, make_engine
+from instrument import span
+from main import extract_text, iter_extract_text, what_engine_to_use
+from plan import record_run
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+FINAL_STATES = ['done', 'failed']
+TOKEN_FN = os.path.join(os.path.expanduser('~'), '.reader_daemon.token')
+TOKEN_ENV = 'READER_DAEMON_TOKEN'
+# Config keys a submitted job may set, besides the engine sections. Anything else (e.g. 'cache') is
+# the daemon's own business and is dropped
+JOB_KEYS = ['url', 'pdf', 'txt', 'pages', 'follow_next_page', 'max_pages', 'url_workers', 'url_per_host',
+            'pdf_workers', 'lang', 'lang_prefix', 'region', 'engines', 'normalize_text', 'strip_boilerplate',
+            'inspect_extract_txt', 'invocation-theme-word', 'output_extracted_txt_fn', 'output_audio_fn',
+            'output_streaming', 'output_pipeline', 'output_paragraph_pause_ms', 'resume']
+# Engine settings a submitted job may not set: commands run on this machine, and the URLs the
+# daemon's credentials are sent to. The daemon takes them from its environment or the engine's
+# defaults instead (e.g. GCP_ACCESS_TOKEN_CMD)
+JOB_ENGINE_KEYS_DENIED = ['access_token_cmd', 'endpoint', 'long_audio_endpoint']
+# Region names end up in service host names: a plain name only, e.g. 'eastus' or 'us-west-2'
+REGION_RE = re.compile(r'[a-z0-9][a-z0-9-]*')
+
+
+def load_token(token_fn: str = TOKEN_FN) -> Optional[str]:
+    if os.getenv(TOKEN_ENV):
+        return os.getenv(TOKEN_ENV)
+    if os.path.exists(token_fn):
+        with open(token_fn) as fin:
+            return fin.read().strip()
+    return None
+
+
+def _new_token(token_fn: str) -> str:
+    token = secrets.token_urlsafe(32)
+    # Readable by this user only, from the moment it exists
+    fd = os.open(token_fn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as fout:
+        fout.write(token + '\n')
+    os.chmod(token_fn, 0o600)
+    return token
+
+
+def _inside(fn: str, directory: str) -> bool:
+    fn = os.path.realpath(os.path.expanduser(fn))
+    return os.path.commonpath([fn, directory]) == directory
+
+
+class Job(object):
+    def __init__(self, job_id: str, app_config: dict, priority: int):
+        self.id = job_id
+        self.app_config = app_config
+        self.priority = priority
+        self.state = 'queued'
+        self.error: Optional[str] = None
+        self.metrics = {}
+        self.times = {'submitted': time.time()}
+        self.version = 0
+        self.changed = threading.Condition()
+
+    def set_state(self, state: str, **kwargs):
+        with self.changed:
+            self.state = state
+            self.times[state] = time.time()
+            for k, v in kwargs.items():
+                setattr(self, k, v)
+            self.version += 1
+            self.changed.notify_all()
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'state': self.state,
+            'priority': self.priority,
+            'theme': self.app_config.get('invocation-theme-word'),
+            'output_audio_fn': self.app_config.get('output_audio_fn'),
+            'output_extracted_txt_fn': self.app_config.get('output_extracted_txt_fn'),
+            'error': self.error,
+            'metrics': self.metrics,
+            'times': self.times,
+        }
+
+
+class EnginePool(object):
+    """
+    Warm engines, keyed by everything that goes into building one. A job checks an engine out for
+    its whole run (engines hold per-job state), so there are at most as many per key as workers
+    """
+
+    def __init__(self, shared_executor: ThreadPoolExecutor):
+        self.shared_executor = shared_executor
+        self._idle: Dict[str, List[VoiceEngine]] = {}
+        self._lock = threading.Lock()
+        self.built = 0
+        self.reused = 0
+
+    @staticmethod
+    def _key(use_eng: str, app_config: dict) -> str:
+        sections = {use_eng: app_config.get(use_eng)}
+        if use_eng == 'shard':
+            # The lanes are built from their own sections: a new voice or key there needs new lanes
+            lanes = (app_config.get('shard') or {}).get('engines') or \
+                app_config['engines'][app_config['lang_prefix']]['choices']
+            sections.update({name: app_config.get(name) for name in lanes})
+        return json.dumps([use_eng, app_config['lang'], sections, app_config.get('engines'), app_config.get('cache'),
+                           app_config.get('region')], sort_keys=True, default=str)
+
+    def checkout(self, app_config: dict) -> Tuple[str, VoiceEngine]:
+        use_eng = what_engine_to_use(app_config)
+        key = EnginePool._key(use_eng, app_config)
+        with self._lock:
+            idle = self._idle.get(key)
+            eng = idle.pop() if idle else None
+            if eng is not None:
+                self.reused += 1
+        if eng is not None:
+            eng.rebind(app_config)
+            return key, eng
+
+        with span('engine_setup', engine=use_eng):
+            eng = make_engine(use_eng, app_config)
+        # Chunk requests of all jobs share one bounded pool
+        eng.executor = self.shared_executor
+        with self._lock:
+            self.built += 1
+        return key, eng
+
+    def checkin(self, key: str, eng: VoiceEngine):
+        with self._lock:
+            self._idle.setdefault(key, []).append(eng)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'built': self.built, 'reused': self.reused, 'idle': sum(len(v) for v in self._idle.values())}
+
+
+class SynthesisServer(object):
+    def __init__(self, output_dir: str, workers: int = 2, concurrency: int = 8, cache: Optional[dict] = None):
+        self.output_dir = os.path.realpath(os.path.expanduser(output_dir))
+        self.cache = cache
+        self.jobs: Dict[str, Job] = {}
+        self._queue: queue.PriorityQueue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._shared_executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.engines = EnginePool(self._shared_executor)
+        self._workers = [threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+                         for i in range(workers)]
+        for t in self._workers:
+            t.start()
+
+    def job_config(self, submitted: dict) -> dict:
+        """
+        The config a submitted job runs with: the allowed keys only, output files inside the output
+        directory, and the daemon's own cache settings
+        """
+        assert isinstance(submitted, dict), "The job config must be an object"
+        allowed = set(JOB_KEYS) | set(engine_names())
+        dropped = sorted(k for k in submitted if k not in allowed)
+        if dropped:
+            logger.info(f"Ignoring job config keys {', '.join(dropped)}")
+        app_config = {k: v for k, v in submitted.items() if k in allowed}
+        for name in engine_names():
+            if isinstance(app_config.get(name), dict):
+                app_config[name] = dict(app_config[name])
+                for k in JOB_ENGINE_KEYS_DENIED:
+                    if app_config[name].pop(k, None):
+                        logger.warning(f"Ignoring '{name}/{k}' of the job, the daemon's environment decides it")
+        regions = [app_config.get('region')]
+        if isinstance(app_config.get('aws'), dict):
+            regions.append(app_config['aws'].get('region_name'))
+        for region in regions:
+            assert region is None or (isinstance(region, str) and REGION_RE.fullmatch(region)), \
+                f"'{region}' is not a region name"
+
+        assert app_config.get('output_audio_fn') not in [None, '-'], "Jobs need an output audio file"
+        for key in ['output_audio_fn', 'output_extracted_txt_fn']:
+            fn = app_config.get(key)
+            assert isinstance(fn, str) and _inside(fn, self.output_dir), \
+                f"'{key}' must be inside the daemon's output directory {self.output_dir}"
+            app_config[key] = os.path.realpath(os.path.expanduser(fn))
+        if self.cache:
+            app_config['cache'] = self.cache
+        return app_config
+
+    def submit(self, app_config: dict, priority: int = 0) -> Job:
+        app_config = self.job_config(app_config)
+        seq = next(self._seq)
+        job = Job(f'{int(time.time())}-{seq}', app_config, priority)
+        self.jobs[job.id] = job
+        # Higher priority first, then first come first served
+        self._queue.put((-priority, seq, job))
+        logger.info(f"Queued job {job.id} ({app_config.get('invocation-theme-word')}), priority {priority}")
+        return job
+
+    def _work(self):
+        while True:
+            _, _, job = self._queue.get()
+            try:
+                self._run(job)
+            except Exception as e:
+                logger.exception(f'Job {job.id} failed')
+                job.set_state('failed', error=f'{type(e).__name__}: {e}')
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job: Job):
+        app_config = job.app_config
+        if app_config.get('output_pipeline') and not app_config.get('inspect_extract_txt'):
+            # Extraction and synthesis overlap, so there is no separate extracting state
+            job.set_state('synthesizing')
+            key, eng = self.engines.checkout(app_config)
+            try:
+                with span('convert_pipeline', job=job.id, engine=type(eng).__name__), record_run(app_config, eng) as run:
+                    run['ok'] = eng.convert_pipeline(iter_extract_text(app_config))
+            finally:
+                self.engines.checkin(key, eng)
+            job.set_state('done', metrics=dict(eng.metrics))
+            return
+
+        job.set_state('extracting')
+        with span('extract', job=job.id):
+            src_txt = extract_text(app_config)
+        if app_config.get('inspect_extract_txt', False):
+            job.set_state('done')
+            return
+
+        job.set_state('synthesizing', metrics={'chars': len(src_txt)})
+        key, eng = self.engines.checkout(app_config)
+        try:
+            with span('convert', job=job.id, engine=type(eng).__name__, chars=len(src_txt)), \
+                    record_run(app_config, eng, src_txt) as run:
+                run['ok'] = eng.convert(src_txt)
+        finally:
+            self.engines.checkin(key, eng)
+        job.set_state('done', metrics=dict(job.metrics, **eng.metrics))
+
+    def events(self, job: Job, timeout: float = 30) -> Iterator[dict]:
+        # The current state right away, then every change until the job ends. A heartbeat repeats
+        # the state after `timeout` seconds without news, so idle connections are noticed
+        version = -1
+        while True:
+            with job.changed:
+                job.changed.wait_for(lambda: job.version != version, timeout=timeout)
+                version = job.version
+                snapshot = job.to_dict()
+            yield snapshot
+            if snapshot['state'] in FINAL_STATES:
+                return
+
+    def stats(self) -> dict:
+        return {'queued': self._queue.qsize(), 'jobs': len(self.jobs), 'engines': self.engines.stats()}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'ReaderDaemon/1.0'
+
+    def _reply(self, status: int, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _job(self, job_id: str) -> Optional[Job]:
+        job = self.server.synth.jobs.get(job_id)
+        if job is None:
+            self._reply(404, {'error': f'No job {job_id}'})
+        return job
+
+    def _refuse(self) -> bool:
+        # Web pages can reach a local port too: no browser requests, and nothing without the token
+        if self.headers.get('Origin') is not None:
+            self._reply(403, {'error': 'Requests from web pages are not accepted'})
+            return True
+        auth = self.headers.get('Authorization') or ''
+        if not hmac.compare_digest(auth.encode('utf-8'), f'Bearer {self.server.token}'.encode('utf-8')):
+            self._reply(401, {'error': 'Missing or wrong token'})
+            return True
+        return False
+
+    def do_POST(self):
+        if self._refuse():
+            return
+        if (self.headers.get('Content-Type') or '').split(';')[0].strip().lower() != 'application/json':
+            return self._reply(415, {'error': 'Jobs must be sent as application/json'})
+        if self.path.rstrip('/') != '/jobs':
+            return self._reply(404, {'error': f'Unknown path {self.path}'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+            job = self.server.synth.submit(body['config'], int(body.get('priority') or 0))
+        except (AssertionError, KeyError, ValueError) as e:
+            return self._reply(400, {'error': f'{type(e).__name__}: {e}'})
+        self._reply(202, job.to_dict())
+
+    def do_GET(self):
+        if self._refuse():
+            return
+        parts = [p for p in self.path.split('/') if p]
+        synth = self.server.synth
+        if parts == ['health']:
+            return self._reply(200, synth.stats())
+        if parts == ['jobs']:
+            return self._reply(200, [j.to_dict() for j in list(synth.jobs.values())])
+        if len(parts) == 2 and parts[0] == 'jobs':
+            job = self._job(parts[1])
+            return job and self._reply(200, job.to_dict())
+        if len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+            job = self._job(parts[1])
+            if job is None:
+                return
+            # No Content-Length: the stream ends when the job does and the connection closes
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+            self.end_headers()
+            for event in synth.events(job):
+                self.wfile.write(json.dumps(event, ensure_ascii=False).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            return
+        self._reply(404, {'error': f'Unknown path {self.path}'})
+
+    def address_string(self) -> str:
+        # Unix socket peers have no host/port
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, fmt: str, *args):
+        logger.debug(f'{self.address_string()} {fmt % args}')
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('unix', 0)
+
+
+def serve(synth: SynthesisServer, port: Optional[int] = None, socket_fn: Optional[str] = None,
+          token_fn: str = TOKEN_FN):
+    token = os.getenv(TOKEN_ENV) or _new_token(token_fn)
+    if socket_fn:
+        if os.path.exists(socket_fn):
+            os.remove(socket_fn)
+        httpd = _UnixHTTPServer(socket_fn, _Handler)
+        os.chmod(socket_fn, 0o600)
+        logger.info(f'Listening on unix:{socket_fn}')
+    else:
+        # Local only: jobs name files on this machine
+        httpd = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        logger.info(f'Listening on http://127.0.0.1:{port}')
+    logger.info(f'Clients authenticate with the token in {TOKEN_ENV if os.getenv(TOKEN_ENV) else token_fn}, '
+                f'jobs write inside {synth.output_dir}')
+    httpd.synth = synth
+    httpd.token = token
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        if socket_fn and os.path.exists(socket_fn):
+            os.remove(socket_fn)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_fn: str, timeout: Optional[float] = None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_fn = socket_fn
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_fn)
+
+
+def _connect(addr: str) -> http.client.HTTPConnection:
+    # addr: 'http://host:port' or 'unix:/path/to/socket'
+    if addr.startswith('unix:'):
+        return _UnixHTTPConnection(addr[len('unix:'):])
+    host_port = addr.split('://', 1)[-1].rstrip('/')
+    return http.client.HTTPConnection(host_port)
+
+
+def submit_job(addr: str, app_config: dict, priority: int = 0, token: Optional[str] = None) -> Iterator[dict]:
+    """
+    Client side: queues the job on the server at addr, then yields its state changes until it ends.
+    The token defaults to the one the daemon on this machine wrote (load_token)
+    """
+    token = token or load_token()
+    assert token, f"No daemon token: start the daemon first, or set {TOKEN_ENV}"
+    auth = {'Authorization': f'Bearer {token}'}
+    conn = _connect(addr)
+    payload = json.dumps({'config': app_config, 'priority': priority}, ensure_ascii=False).encode('utf-8')
+    conn.request('POST', '/jobs', payload, headers=dict(auth, **{'Content-Type': 'application/json; charset=utf-8'}))
+    response = conn.getresponse()
+    body = json.loads(response.read())
+    if response.status != 202:
+        raise RuntimeError(f"Server at {addr} refused the job: {body.get('error')}")
+    conn.close()
+
+    conn = _connect(addr)
+    conn.request('GET', f"/jobs/{body['id']}/events", headers=auth)
+    response = conn.getresponse()
+    try:
+        for line in response:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format="%(asctime)s  %(levelname)s %(threadName)s %(message)s", level=logging.INFO
+    )
+    cli_parser = argparse.ArgumentParser(description="Serve synthesis jobs, keeping engines warm")
+    where = cli_parser.add_mutually_exclusive_group(required=True)
+    where.add_argument('--port', type=int, help="Listen on 127.0.0.1:PORT")
+    where.add_argument('--socket', dest='socket_fn', help="Listen on this Unix socket")
+    cli_parser.add_argument('--output-dir', required=True,
+                            help="Jobs may only write their extracted text and audio inside this directory")
+    cli_parser.add_argument('--cache-dir', help="Segment and extraction cache for all jobs (see 'cache:' in my.yml)")
+    cli_parser.add_argument('--token-file', default=TOKEN_FN,
+                            help=f"Where to write the token clients must send (ignored when {TOKEN_ENV} is set)")
+    cli_parser.add_argument('--workers', type=int, default=2, help="Jobs running at the same time")
+    cli_parser.add_argument('--concurrency', type=int, default=8,
+                            help="Max number of synthesis requests in flight, shared by all jobs")
+    cli_opts = cli_parser.parse_args()
+
+    serve(SynthesisServer(cli_opts.output_dir, workers=cli_opts.workers, concurrency=cli_opts.concurrency,
+                          cache={'directory': cli_opts.cache_dir} if cli_opts.cache_dir else None),
+          port=cli_opts.port, socket_fn=cli_opts.socket_fn, token_fn=cli_opts.token_file)
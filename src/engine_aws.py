@@ -3,18 +3,48 @@ import logging
 import os
 import pprint
 import time
+from contextlib import closing, contextmanager
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Tuple
 
 import boto3
+import botocore.exceptions
+from botocore.config import Config
 
 from engine_base import VoiceEngine
+from instrument import span
+from rate_limit import TransientError, get_rate_limiter, parse_retry_after
+from text_chunk import escaped_len, split_text
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+_TRANSIENT_CODES = {'ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded',
+                    'ServiceUnavailable', 'ServiceFailureException', 'SlowDown', 'RequestTimeout'}
+
+
+@contextmanager
+def _aws_errors():
+    # Throttling, server-side and connection failures become TransientError, for the rate limiter to retry
+    try:
+        yield
+    except botocore.exceptions.ClientError as e:
+        meta = e.response.get('ResponseMetadata', {})
+        code = e.response.get('Error', {}).get('Code')
+        if code in _TRANSIENT_CODES or meta.get('HTTPStatusCode', 0) >= 500:
+            raise TransientError(str(e), parse_retry_after(meta.get('HTTPHeaders', {}).get('retry-after'))) from e
+        raise
+    except (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError) as e:
+        raise TransientError(str(e)) from e
+
 
 class AwsPolly(VoiceEngine):
+    # Billed characters allowed in one synthesize_speech (synchronous) call
+    max_sync_chars = 3000
+    # Billed characters allowed in one start_speech_synthesis_task call
+    max_task_chars = 100000
+    chunk_measure = staticmethod(escaped_len)
+
     def __init__(self, app_config: dict):
         super().__init__(app_config, 'aws')
 
@@ -23,9 +53,12 @@ class AwsPolly(VoiceEngine):
             call_param[x] = self._get_key_val(x)
 
         session = boto3.Session(**call_param)
-        self.polly_client = session.client('polly')
+        # Retries are done by the shared rate limiter, so botocore makes a single attempt
+        client_cfg = Config(retries={'max_attempts': 0})
+        self.polly_client = session.client('polly', config=client_cfg)
+        self.limiter = get_rate_limiter(self.app_config, 'aws')
 
-        self.s3_client = session.client('s3')
+        self.s3_client = session.client('s3', config=client_cfg)
         self.s3_bucket = self._get_key_val('s3_bucket')
         assert self.s3_bucket, "Cannot find s3_bucket"
 
@@ -34,58 +67,196 @@ class AwsPolly(VoiceEngine):
         self.lang = self._get_key_val('language_code', 'en-US')
         self.voice_id = self._get_key_val('voice_id', 'Matthew')
 
-    def convert(self, src_txt: str) -> bool:
-        logger.debug("Submitting a new async conversion task ...")
-        esc_txt=html.escape(src_txt)
-        ssml_txt = f"""<speak>
+        aws_cfg = self.app_config['aws']
+        # auto: synchronous streaming when the text fits one request, S3 task otherwise
+        # stream: always synchronous, in parallel chunks; task: always the S3 task
+        self.mode = aws_cfg.get('mode') or 'auto'
+        assert self.mode in ['auto', 'stream', 'task'], f"Unknown 'aws/mode' value {self.mode}"
+        self.workers = int(aws_cfg.get('workers') or 4)
+        self.poll_min_sec = float(aws_cfg.get('poll_min_sec') or 2)
+        self.poll_max_sec = float(aws_cfg.get('poll_max_sec') or 30)
+        self.poll_deadline_sec = float(aws_cfg.get('poll_deadline_min') or 30) * 60
+
+    def rebind(self, app_config: dict):
+        super().rebind(app_config)
+        self.s3_key_path = self._get_key_val('s3_key_path', self.app_config['invocation-theme-word'])
+
+    def chunk_limit(self) -> int:
+        # Polly counts escaped characters, never more than the escaped UTF-8 bytes, so the limit also holds
+        # under the default measure (the shard engine's)
+        return AwsPolly.max_sync_chars
+
+    def _voice_signature(self) -> dict:
+        return dict(super()._voice_signature(), voice=self.voice_id, locale=self.lang,
+                    audio_format='mp3', polly_engine='neural')
+
+    def _build_ssml(self, esc_txt: str) -> str:
+        return f"""<speak>
     <prosody rate="{self.rate}">
 {esc_txt}
     </prosody>
 </speak>"""
-        response = self.polly_client.start_speech_synthesis_task(
-            Engine='neural',
-            LanguageCode=self.lang,
-            OutputFormat='mp3',
-            OutputS3BucketName=self.s3_bucket,
-            OutputS3KeyPrefix=self.s3_key_path,
-            Text=ssml_txt,
-            TextType='ssml',
-            VoiceId=self.voice_id,
-        )
 
+    def _streams(self, src_txt: str) -> bool:
+        return self.mode == 'stream' or self.app_config.get('output_streaming') or \
+            (self.mode == 'auto' and escaped_len(src_txt) <= AwsPolly.max_sync_chars)
+
+    def convert(self, src_txt: str) -> bool:
+        if self._streams(src_txt):
+            return self.convert_stream(src_txt)
+
+        return self.convert_task(src_txt)
+
+    def plan_requests(self, src_txt: str) -> List[str]:
+        return super().plan_requests(src_txt) if self._streams(src_txt) else [src_txt]
+
+    def plan_warnings(self, src_txt: str, requests: List[str], synth_sec: Optional[float]) -> List[str]:
+        if self._streams(src_txt):
+            return []
+        warnings = []
+        billed = self.request_billed_chars(src_txt)
+        if billed > AwsPolly.max_task_chars:
+            warnings.append(f"{billed} billed characters are more than the {AwsPolly.max_task_chars} one Polly task "
+                            f"takes; set 'aws/mode: stream'")
+        if synth_sec and synth_sec > self.poll_deadline_sec:
+            warnings.append(f"the task is expected to take {synth_sec / 60:.0f} min, polling gives up after "
+                            f"{self.poll_deadline_sec / 60:.0f} min ('aws/poll_deadline_min')")
+        return warnings
+
+    def convert_stream(self, src_txt: str) -> bool:
+        chunks = split_text(src_txt, AwsPolly.max_sync_chars, measure=self.chunk_measure)
+        local_fn = self._synthesize_chunks(chunks, self._synthesize_chunk, self.workers, self._stream_chunk)
+        logger.info(f'Successfully synthesized {len(chunks)} chunks into {local_fn}')
+        return True
+
+    def _synthesize_chunk(self, chunk: str) -> bytes:
+        def _request() -> bytes:
+            with span('polly.synthesize_speech', cat='engine', chars=len(chunk)) as sp, _aws_errors():
+                with closing(self._request_speech(chunk)['AudioStream']) as stream:
+                    audio = stream.read()
+                sp['bytes'] = len(audio)
+            return audio
+
+        return self.limiter.call(_request, chars=len(chunk), what='polly.synthesize_speech')
+
+    def _stream_chunk(self, chunk: str, emit):
+        # Only the request is retried: once audio has been handed on, a failure is final
+        response = self.limiter.call(lambda: self._request_speech(chunk), chars=len(chunk),
+                                     what='polly.synthesize_speech')
+        with span('polly.synthesize_speech_stream', cat='engine', chars=len(chunk)) as sp:
+            sp['bytes'] = 0
+            with closing(response['AudioStream']) as stream:
+                for block in stream.iter_chunks(chunk_size=16 * 1024):
+                    sp['bytes'] += len(block)
+                    emit(block)
+
+    def _request_speech(self, chunk: str) -> dict:
+        with _aws_errors():
+            response = self.polly_client.synthesize_speech(
+                Engine='neural',
+                LanguageCode=self.lang,
+                OutputFormat='mp3',
+                Text=self._build_ssml(html.escape(chunk)),
+                TextType='ssml',
+                VoiceId=self.voice_id,
+            )
         if response['ResponseMetadata']['HTTPStatusCode'] != 200:
-            raise RuntimeError("AWS call 'start_speech_synthesis_task' failed. "
+            raise RuntimeError("AWS call 'synthesize_speech' failed. "
                                "See response for details\n" + pprint.pformat(response, indent=2))
+        return response
 
-        task_id = response['SynthesisTask']['TaskId']
-        s3_fn_loc = response['SynthesisTask']['OutputUri']
-        # e.g. 'https://s3.us-west-2.amazonaws.com/web20221005-audio-files2/newyorker_test1.bec2ba2e-cce9-486c-aa8d-f84e440d28ed.mp3'
+    def convert_task(self, src_txt: str) -> bool:
+        if self._load_cached_output(src_txt):
+            return True
+
+        manifest = self._open_manifest(src_txt)
+        task = manifest.task if manifest else None
+        if task and task.get('engine') == 'aws' and self._reattachable(task['task_id']):
+            logger.info(f"Re-attaching to Polly task {task['task_id']}")
+            task_id, s3_fn_loc = task['task_id'], task['output_uri']
+        else:
+            task_id, s3_fn_loc = self._start_task(src_txt)
+            if manifest:
+                manifest.set_task(engine='aws', task_id=task_id, output_uri=s3_fn_loc)
 
         bucket_tok = f"/{self.s3_bucket}/"
         _pos = s3_fn_loc.find(bucket_tok)
         real_s3_key = s3_fn_loc[_pos + len(bucket_tok):]
         logger.debug("Start waiting for task to complete...")
-        for cnt in range(5):
-            local_fn = self.wait_and_check(wait_for_sec=30, task_id=task_id, s3_path=real_s3_key)
+        deadline = time.monotonic() + self.poll_deadline_sec
+        delay = self.poll_min_sec
+        while time.monotonic() + delay < deadline:
+            local_fn = self.wait_and_check(wait_for_sec=delay, task_id=task_id, s3_path=real_s3_key)
             if local_fn:
                 logger.info(f'Successfully downloaded file to {local_fn}')
+                self._save_output_to_cache(src_txt)
+                if manifest:
+                    manifest.finish()
                 return True
+            delay = min(delay * 1.5, self.poll_max_sec)
 
-        logger.info(f"""Timeout waiting for the Conversion task to complete. 
-You will have to manually download the output file. Here are the artifacts:
+        logger.info(f"""Timeout waiting for the Conversion task to complete.
+Run again with --resume to pick it up once it is done. Here are the artifacts:
 - Task ID = {task_id}
 - S3 file = {s3_fn_loc}
 """)
         return False
 
-    def wait_and_check(self, wait_for_sec: int, task_id: str, s3_path: str) -> Optional[str]:
-        time.sleep(wait_for_sec)
-        response = self.polly_client.get_speech_synthesis_task(TaskId=task_id)
+    def _start_task(self, src_txt: str) -> Tuple[str, str]:
+        logger.debug("Submitting a new async conversion task ...")
+        with span('ssml_build', chars=len(src_txt)):
+            ssml_txt = self._build_ssml(html.escape(src_txt))
+
+        def _request() -> dict:
+            with span('polly.start_speech_synthesis_task', cat='engine', chars=len(src_txt)), _aws_errors():
+                return self.polly_client.start_speech_synthesis_task(
+                    Engine='neural',
+                    LanguageCode=self.lang,
+                    OutputFormat='mp3',
+                    OutputS3BucketName=self.s3_bucket,
+                    OutputS3KeyPrefix=self.s3_key_path,
+                    Text=ssml_txt,
+                    TextType='ssml',
+                    VoiceId=self.voice_id,
+                )
+
+        response = self.limiter.call(_request, chars=len(src_txt), what='polly.start_speech_synthesis_task')
+
+        if response['ResponseMetadata']['HTTPStatusCode'] != 200:
+            raise RuntimeError("AWS call 'start_speech_synthesis_task' failed. "
+                               "See response for details\n" + pprint.pformat(response, indent=2))
+
+        # OutputUri e.g. 'https://s3.us-west-2.amazonaws.com/web20221005-audio-files2/newyorker_test1.bec2ba2e-cce9-486c-aa8d-f84e440d28ed.mp3'
+        return response['SynthesisTask']['TaskId'], response['SynthesisTask']['OutputUri']
+
+    def _get_task(self, task_id: str) -> dict:
+        def _request() -> dict:
+            with span('polly.get_speech_synthesis_task', cat='engine', task_id=task_id) as sp, _aws_errors():
+                retval = self.polly_client.get_speech_synthesis_task(TaskId=task_id)
+                sp['status'] = retval.get('SynthesisTask', {}).get('TaskStatus')
+            return retval
+
+        response = self.limiter.call(_request, what='polly.get_speech_synthesis_task')
         if response['ResponseMetadata']['HTTPStatusCode'] != 200:
             raise RuntimeError("AWS call 'get_speech_synthesis_task' failed. "
                                "See response for details\n" + pprint.pformat(response, indent=2))
+        return response['SynthesisTask']
 
-        status = response['SynthesisTask']['TaskStatus']
+    def _reattachable(self, task_id: str) -> bool:
+        # A task from the previous run is only worth waiting for if Polly still has it, and it did not fail
+        try:
+            status = self._get_task(task_id)['TaskStatus']
+        except Exception as e:
+            logger.warning(f'Cannot look up Polly task {task_id} ({e}), starting a new one')
+            return False
+        if status == 'failed':
+            logger.warning(f'Polly task {task_id} failed, starting a new one')
+            return False
+        return True
+
+    def wait_and_check(self, wait_for_sec: float, task_id: str, s3_path: str) -> Optional[str]:
+        time.sleep(wait_for_sec)
+        status = self._get_task(task_id)['TaskStatus']
         if status == 'failed':
             raise RuntimeError(f"SynthesisTask id={task_id} has a 'failed' status. "
                                f"You need to go to AWS Console's 'Polly S3 synthesis tasks' "
@@ -98,7 +269,12 @@ You will have to manually download the output file. Here are the artifacts:
             if os.path.exists(local_fn):
                 os.remove(local_fn)
 
-            self.s3_client.download_file(self.s3_bucket, s3_path, local_fn)
+            def _download():
+                with span('s3.download_file', cat='engine', key=s3_path) as sp, _aws_errors():
+                    self.s3_client.download_file(self.s3_bucket, s3_path, local_fn)
+                    sp['bytes'] = os.path.getsize(local_fn) if os.path.exists(local_fn) else 0
+
+            self.limiter.call(_download, what='s3.download_file')
             if os.path.exists(local_fn):
                 return local_fn
             else:
@@ -1,18 +1,62 @@
 import html
 import logging
 import os
+import re
+import threading
 from pathlib import Path
+from typing import List, Optional
 
 import azure.cognitiveservices.speech as speechsdk
 import requests
 
 from engine_base import VoiceEngine
+from instrument import span
+from rate_limit import TransientError, get_rate_limiter
+from text_chunk import escaped_len, split_text
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# Hangul, kana and Han characters, which count as two billed characters each
+_DOUBLE_BILLED = re.compile('[\u1100-\u11ff\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+
+_TRANSIENT_CANCELLATIONS = {
+    speechsdk.CancellationErrorCode.TooManyRequests,
+    speechsdk.CancellationErrorCode.ConnectionFailure,
+    speechsdk.CancellationErrorCode.ServiceTimeout,
+    speechsdk.CancellationErrorCode.ServiceError,
+    speechsdk.CancellationErrorCode.ServiceUnavailable,
+}
+
+
+def _raise_for_result(result: speechsdk.SpeechSynthesisResult):
+    if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
+        return
+    err_info = result.cancellation_details
+    msg = f"Speech synthesis FAILED. Error is:\n{err_info.error_details}"
+    if err_info.error_code in _TRANSIENT_CANCELLATIONS:
+        raise TransientError(msg)
+    raise RuntimeError(msg)
+
+
+class _PushCallback(speechsdk.audio.PushAudioOutputStreamCallback):
+    # Hands audio over as the SDK pushes it, instead of once the whole request is done
+    def __init__(self, emit):
+        super().__init__()
+        self.emit = emit
+
+    def write(self, audio_buffer: memoryview) -> int:
+        self.emit(audio_buffer.tobytes())
+        return audio_buffer.nbytes
+
+    def close(self):
+        pass
+
 
 class AzureBob(VoiceEngine):
+    # Size limit of a single real-time synthesis request
+    max_request_bytes = 65536
+
     locale_mapping = {
         'english': ('zh-US', ['en-US-MichelleNeural', 'en-US-EricNeural']),
         'chinese-普通': ('zh-CN', ['zh-CN-YunfengNeural']),
@@ -73,28 +117,27 @@ class AzureBob(VoiceEngine):
         }
         self._resolve_locale_voice()
 
-    def convert(self, src_txt: str) -> bool:
-        if (len(str.encode(src_txt))) > 65536:
-            raise ValueError("Azure engine has an implementation-imposed size limit of 65536 bytes. "
-                             "Please edit the input file and try again")
-
-        local_fn = self.app_config['output_audio_fn']
-        Path(os.path.realpath(os.path.dirname(local_fn))).mkdir(parents=True, exist_ok=True)
-        if os.path.exists(local_fn):
-            os.remove(local_fn)
+        self.chunked = bool(self.app_config['azure'].get('chunked', False))
+        self.chunk_bytes = int(self.app_config['azure'].get('chunk_bytes') or 16384)
+        self.workers = int(self.app_config['azure'].get('workers') or 4)
+        assert 0 < self.chunk_bytes <= AzureBob.max_request_bytes, \
+            f"'chunk_bytes' needs to be between 1 and {AzureBob.max_request_bytes}"
+        self._local = threading.local()
+        self._task_cfg = None
+        self.limiter = get_rate_limiter(self.app_config, 'azure')
 
-        task_cfg = speechsdk.SpeechConfig(subscription=self.api_key, region=self.region)
-        task_cfg.speech_synthesis_voice_name = self.voice_name
-        audio_format = speechsdk.SpeechSynthesisOutputFormat[self.audio_format]
-        task_cfg.set_speech_synthesis_output_format(audio_format)
+    def _speech_config(self) -> speechsdk.SpeechConfig:
+        # Built once per engine; synthesizers only read it
+        if self._task_cfg is None:
+            task_cfg = speechsdk.SpeechConfig(subscription=self.api_key, region=self.region)
+            task_cfg.speech_synthesis_voice_name = self.voice_name
+            audio_format = speechsdk.SpeechSynthesisOutputFormat[self.audio_format]
+            task_cfg.set_speech_synthesis_output_format(audio_format)
+            self._task_cfg = task_cfg
+        return self._task_cfg
 
-        audio_cfg = speechsdk.audio.AudioOutputConfig(filename=local_fn)
-
-        task_inst = speechsdk.SpeechSynthesizer(speech_config=task_cfg, audio_config=audio_cfg)
-
-        # result = task_inst.speak_text_async(src_txt).get()
-        esc_txt = html.escape(src_txt)
-        ssml_txt = f"""<speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" xml:lang="en-US">
+    def _build_ssml(self, esc_txt: str) -> str:
+        return f"""<speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" xml:lang="en-US">
     <voice name="{self.voice_name}">
         <prosody pitch="{self.pitch}" rate="{self.rate}">
 {esc_txt}
@@ -102,12 +145,99 @@ class AzureBob(VoiceEngine):
     </voice>
 </speak>"""
 
-        result = task_inst.speak_ssml_async(ssml_txt).get()
-        if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
+    def _voice_signature(self) -> dict:
+        return dict(super()._voice_signature(), voice=self.voice_name, locale=self.locale,
+                    audio_format=self.audio_format)
+
+    def convert(self, src_txt: str) -> bool:
+        if self.chunked or self.app_config.get('output_streaming'):
+            return self.convert_chunked(src_txt)
+
+        if (len(str.encode(src_txt))) > AzureBob.max_request_bytes:
+            raise ValueError(f"Azure engine has an implementation-imposed size limit of "
+                             f"{AzureBob.max_request_bytes} bytes. "
+                             f"Please edit the input file, or set 'azure/chunked: True', and try again")
+
+        if self._load_cached_output(src_txt):
             return True
 
-        err_info = result.cancellation_details
-        raise RuntimeError(f"Speech synthesis FAILED. Error is:\n{err_info.error_details}")
+        local_fn = self.app_config['output_audio_fn']
+        Path(os.path.realpath(os.path.dirname(local_fn))).mkdir(parents=True, exist_ok=True)
+
+        # Same (reused) synthesizer as the chunked path; the audio comes back in memory
+        audio = self._synthesize_chunk(src_txt)
+        with span('write_audio', bytes=len(audio)), open(local_fn + '.part', 'wb') as fout:
+            fout.write(audio)
+        os.replace(local_fn + '.part', local_fn)
+        self._save_output_to_cache(src_txt)
+        return True
+
+    def chunk_limit(self) -> int:
+        # Every chunk becomes its own SSML document, so the wrapper counts against the byte budget too
+        overhead = len(self._build_ssml('').encode('utf-8'))
+        assert self.chunk_bytes > overhead, f"'chunk_bytes' must be larger than the {overhead} bytes of SSML wrapper"
+        return self.chunk_bytes - overhead
+
+    def request_billed_chars(self, txt: str) -> int:
+        # Azure bills every CJK character twice
+        return escaped_len(txt) + len(txt) - len(_DOUBLE_BILLED.sub('', txt))
+
+    def plan_requests(self, src_txt: str) -> List[str]:
+        if self.chunked or self.app_config.get('output_streaming'):
+            return super().plan_requests(src_txt)
+        return [src_txt]
+
+    def plan_warnings(self, src_txt: str, requests: List[str], synth_sec: Optional[float]) -> List[str]:
+        if len(requests) == 1 and len(str.encode(src_txt)) > AzureBob.max_request_bytes \
+                and not (self.chunked or self.app_config.get('output_streaming')):
+            return [f"{len(str.encode(src_txt))} bytes are more than the {AzureBob.max_request_bytes} of one "
+                    f"request, convert() would refuse the text; set 'azure/chunked: True'"]
+        return []
+
+    def convert_chunked(self, src_txt: str) -> bool:
+        chunks = split_text(src_txt, self.chunk_limit())
+        local_fn = self._synthesize_chunks(chunks, self._synthesize_chunk, self.workers, self._stream_chunk)
+        logger.info(f'Successfully synthesized {len(chunks)} chunks into {local_fn}')
+        return True
+
+    def _stream_chunk(self, chunk: str, emit):
+        emitted = []
+
+        def _emit(data: bytes):
+            emitted.append(len(data))
+            emit(data)
+
+        def _request():
+            stream = speechsdk.audio.PushAudioOutputStream(_PushCallback(_emit))
+            task_inst = speechsdk.SpeechSynthesizer(speech_config=self._speech_config(),
+                                                    audio_config=speechsdk.audio.AudioOutputConfig(stream=stream))
+            with span('azure.speak_ssml_stream', cat='engine', chars=len(chunk)):
+                result = task_inst.speak_ssml_async(self._build_ssml(html.escape(chunk))).get()
+            try:
+                _raise_for_result(result)
+            except TransientError as e:
+                # Once audio has been handed on, trying again would repeat it
+                if emitted:
+                    raise RuntimeError(str(e)) from e
+                raise
+
+        self.limiter.call(_request, chars=len(chunk), what='azure.speak_ssml_stream')
+
+    def _synthesize_chunk(self, chunk: str) -> bytes:
+        # Synthesizers are not shared between threads: each pool worker keeps its own
+        task_inst = getattr(self._local, 'synthesizer', None)
+        if task_inst is None:
+            task_inst = speechsdk.SpeechSynthesizer(speech_config=self._speech_config(), audio_config=None)
+            self._local.synthesizer = task_inst
+
+        def _request() -> bytes:
+            with span('azure.speak_ssml', cat='engine', chars=len(chunk)) as sp:
+                result = task_inst.speak_ssml_async(self._build_ssml(html.escape(chunk))).get()
+                sp['bytes'] = len(result.audio_data or b'')
+            _raise_for_result(result)
+            return result.audio_data
+
+        return self.limiter.call(_request, chars=len(chunk), what='azure.speak_ssml')
 
 
 def eng_test_basic():
@@ -1,26 +1,133 @@
+import asyncio
+import html
 import json
 import logging
 import ntpath
 import os
-import time
+import shutil
+import zipfile
 from datetime import datetime, timezone
 from pathlib import Path
 from pprint import pformat
-from typing import Optional, Tuple, Dict
+from typing import Optional, Tuple, Dict, List
 
 import requests
 
-from src.engine_azure import AzureBob
+from engine_azure import AzureBob
+from instrument import span
+from job_manifest import JobManifest
+from rate_limit import TransientError, parse_retry_after
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
 class AzureBobAsync(AzureBob):
+    """
+    Client for Azure's long-audio (batch) synthesis API. Any number of scripts can be in flight at
+    once: each job is a coroutine that submits, polls its Location endpoint and streams the result
+    zip to disk, with the blocking HTTP calls handed to worker threads
+    """
+
+    def __init__(self, app_config: dict):
+        super().__init__(app_config)
+
+        azure_cfg = self.app_config['azure']
+        self.long_audio_url = azure_cfg.get('long_audio_endpoint') or \
+            f'https://{self.region}.customvoice.api.speech.microsoft.com/api/texttospeech/v3.0/longaudiosynthesis'
+        self.poll_min_sec = float(azure_cfg.get('poll_min_sec') or 5)
+        self.poll_max_sec = float(azure_cfg.get('poll_max_sec') or 120)
+        self.poll_deadline_sec = float(azure_cfg.get('poll_deadline_min') or 180) * 60
+        self.http_timeout = (10, 120)
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def convert(self, src_txt: str) -> bool:
+        # Same SSML document the real-time path sends, so speed/pitch settings carry over
+        script = self._build_ssml(html.escape(src_txt)).encode('utf-8')
+        job = (f"{self.app_config.get('invocation-theme-word') or 'script'}.txt", script)
+        manifest = self._open_manifest(src_txt)
+        asyncio.run(self.convert_long_many([(job, self.app_config['output_audio_fn'])], [manifest]))
+        return True
+
+    def plan_requests(self, src_txt: str) -> List[str]:
+        # The whole text is one long audio job
+        return [src_txt]
+
+    def plan_warnings(self, src_txt: str, requests: List[str], synth_sec: Optional[float]) -> List[str]:
+        if synth_sec and synth_sec > self.poll_deadline_sec:
+            return [f"the job is expected to take {synth_sec / 60:.0f} min, polling gives up after "
+                    f"{self.poll_deadline_sec / 60:.0f} min ('azure/poll_deadline_min')"]
+        return []
 
     # Need to pick the right Speech_Key
     def convert_long(self, src_fn: str) -> bool:
-        url = f'https://{self.region}.customvoice.api.speech.microsoft.com/api/texttospeech/v3.0/longaudiosynthesis'
+        with open(src_fn, 'rb') as fin:
+            job = (ntpath.basename(src_fn), fin.read())
+        manifest = self._open_manifest(job[1].decode('utf-8', errors='replace'))
+        asyncio.run(self.convert_long_many([(job, self.app_config['output_audio_fn'])], [manifest]))
+        return True
+
+    async def convert_long_many(self, jobs: List[Tuple[Tuple[str, bytes], str]],
+                                manifests: Optional[List[Optional[JobManifest]]] = None) -> List[str]:
+        """
+        jobs: ((script file name, script content), output audio file name) pairs.
+        manifests: optional, one per job, to record (and with --resume, re-attach to) the remote job.
+        Returns the output audio file names in the same order
+        """
+        manifests = manifests or [None] * len(jobs)
+        return list(await asyncio.gather(*(self._run_job(script, out_fn, manifest)
+                                           for (script, out_fn), manifest in zip(jobs, manifests))))
+
+    async def _run_job(self, script: Tuple[str, bytes], out_fn: str, manifest: Optional[JobManifest] = None) -> str:
+        task = manifest.task if manifest else None
+        ask_endpt = None
+        if task and task.get('engine') == 'azure_long_audio':
+            try:
+                # Raises if the job failed or the service no longer knows it
+                await asyncio.to_thread(self.check_status, task['location'])
+                ask_endpt = task['location']
+                logger.info(f'Re-attaching to long audio job {ask_endpt}')
+            except RuntimeError as e:
+                logger.warning(f"Cannot re-attach to {task['location']} ({e}), submitting again")
+
+        if ask_endpt is None:
+            ask_endpt = await asyncio.to_thread(self._submit, script)
+            if manifest:
+                manifest.set_task(engine='azure_long_audio', location=ask_endpt)
+        task_id = await self._wait_for_job(ask_endpt)
+
+        zip_fn = out_fn[:-3] + 'zip'
+        await asyncio.to_thread(self._download_result, task_id, zip_fn)
+        await asyncio.to_thread(self._extract_audio, zip_fn, out_fn)
+        logger.info(f'Successfully downloaded file to {out_fn}')
+        if manifest:
+            manifest.finish()
+        return out_fn
+
+    def _http(self, method: str, url: str, what: str, chars: int = 0, **kwargs) -> requests.Response:
+        # Every call goes through the shared rate limiter; 429s, 5xx and dropped connections are retried
+        def _once() -> requests.Response:
+            with span(what, cat='engine', chars=chars) as sp:
+                try:
+                    response = self.session.request(method, url, timeout=self.http_timeout, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    raise TransientError(str(e)) from e
+                sp['http_status'] = response.status_code
+            if response.status_code in [200, 202]:
+                return response
+
+            msg = f"Azure call to {url} failed. See response for details\n" + pformat(response.reason, indent=2)
+            if response.status_code == 429 or response.status_code >= 500:
+                raise TransientError(msg, parse_retry_after(response.headers.get('Retry-After')))
+            raise RuntimeError(msg)
+
+        return self.limiter.call(_once, chars=chars, what=what)
+
+    def _submit(self, script: Tuple[str, bytes]) -> str:
         voice_identities = [
             {
                 'voicename': self.voice_name
@@ -39,85 +146,100 @@ class AzureBobAsync(AzureBob):
             'concatenateresult': True,
         }
 
-        filename = ntpath.basename(src_fn)
+        filename, content = script
         files = {
-            'script': (filename, open(src_fn, 'rb'), 'text/plain')
+            'script': (filename, content, 'text/plain')
         }
 
-        logger.debug("Submitting a new async synthesize task ...")
-        response = requests.post(url, payload, headers=self.header, files=files)
-        if response.status_code not in [200, 202]:
-            raise RuntimeError(f"Azure call to {url} failed. "
-                               "See response for details\n" + pformat(response.reason, indent=2))
+        logger.debug(f"Submitting a new async synthesize task for {filename} ...")
+        response = self._http('POST', self.long_audio_url, 'azure.long_audio.submit', chars=len(content),
+                              data=payload, headers=self.header, files=files)
         ask_endpt = response.headers['Location']
         logger.debug(f"Remote endpoint replied with an inquery endpoint {ask_endpt}")
-
-        last_resp_dict = {}
-        for cnt in range(60):
-            local_fn, last_resp_dict = self.wait_and_check(wait_for_sec=30, query_endpoint=ask_endpt)
-            if local_fn:
-                logger.info(f'Successfully downloaded file to {local_fn}')
-                return True
-
-        logger.info(f"""Timeout waiting for the Synthesize task to complete. 
-You will have to manually download the output file. Here are the artifacts:
-- Task ID = {last_resp_dict.get('id')}
-- Last status = {last_resp_dict.get('status')}
+        return ask_endpt
+
+    def _next_delay(self, delay: float, status: str, retry_after: Optional[str]) -> float:
+        # The server's own hint wins, within the polling bounds. Otherwise a queued job backs off quickly
+        # (it may wait a long time for a slot) while a running one is checked more often, as it is getting close
+        hint = parse_retry_after(retry_after)
+        if hint is not None:
+            delay = hint
+        else:
+            delay *= 2.0 if status == 'NOTSTARTED' else 1.5
+        return min(max(delay, self.poll_min_sec), self.poll_max_sec)
+
+    async def _wait_for_job(self, ask_endpt: str) -> str:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.poll_deadline_sec
+        delay = self.poll_min_sec
+        resp_dict = {}
+        while loop.time() + delay < deadline:
+            logger.debug(f"Waiting for {delay:.1f} seconds ...")
+            await asyncio.sleep(delay)
+            status, resp_dict, retry_after = await asyncio.to_thread(self.check_status, ask_endpt)
+            if status == 'SUCCEEDED':
+                return resp_dict['id']
+            delay = self._next_delay(delay, status, retry_after)
+
+        raise TimeoutError(f"""Timeout waiting for the Synthesize task to complete.
+Run again with --resume to pick it up once it is done. Here are the artifacts:
+- Task ID = {resp_dict.get('id')}
+- Last status = {resp_dict.get('status')}
 - Inquire endpoint = {ask_endpt}
 """)
 
-        return True
-
-    def wait_and_check(self, wait_for_sec: int, query_endpoint: str) -> Tuple[Optional[str], Dict]:
-        logger.debug(f"Waiting for {wait_for_sec} seconds ...")
-        time.sleep(wait_for_sec)
-        response = requests.get(query_endpoint, headers=self.header)
-        if response.status_code not in [200, 202]:
-            raise RuntimeError(f"Azure call to {query_endpoint} failed. "
-                               "See response for details\n" + pformat(response.reason, indent=2))
-
+    def check_status(self, query_endpoint: str) -> Tuple[str, Dict, Optional[str]]:
+        response = self._http('GET', query_endpoint, 'azure.long_audio.poll', headers=self.header)
         resp_dict = json.loads(response.text)
         task_id = resp_dict.get('id')
-        status = resp_dict.get('status').upper()
+        status = (resp_dict.get('status') or '').upper()
         assert task_id and status, f'Unexpected response from {query_endpoint}: cannot find key "id" and/or "status"'
-        logger.debug(f"Latest status is {status}")
-
-        if status in ['NOTSTARTED', 'RUNNING']:
-            return None, resp_dict
+        logger.debug(f"Latest status of {task_id} is {status}")
 
         if status == 'FAILED':
             raise RuntimeError(f"Azure Task id={task_id} failed. "
-                               "See response for details\n{response.text}")
-
-        if status == 'SUCCEEDED':
-            url = f'https://{self.region}.customvoice.api.speech.microsoft.com/api/texttospeech/v3.0/longaudiosynthesis/{task_id}/files'
-            response = requests.get(url, headers=self.header)
-            if response.status_code not in [200, 202]:
-                raise RuntimeError(f"Azure call to {url} failed. "
-                                   "See response for details\n" + pformat(response.reason, indent=2))
-
-            result_dict = json.loads(response.text)
-            # logger.debug(f'Result is contained in this replay: \n{response.text}\n')
-
-            for v in result_dict['values']:
-                if v['kind'] != 'LongAudioSynthesisResult':
-                    continue
-
-                result_url = v['links']['contentUrl']
-                logger.debug(f'Result is can be downloaded from "{result_url}"')
-
-                local_fn = self.app_config['output_audio_fn']
-                local_fn = local_fn[:-3] + 'zip'
-                Path(os.path.realpath(os.path.dirname(local_fn))).mkdir(parents=True, exist_ok=True)
-                if os.path.exists(local_fn):
-                    os.remove(local_fn)
-
-                response = requests.get(result_url)
-                open(local_fn, "wb").write(response.content)
-
-                return local_fn, resp_dict
-
-        return None, resp_dict
+                               f"See response for details\n{response.text}")
+
+        return status, resp_dict, response.headers.get('Retry-After')
+
+    def _download_result(self, task_id: str, zip_fn: str) -> str:
+        url = f'{self.long_audio_url}/{task_id}/files'
+        response = self._http('GET', url, 'azure.long_audio.files', headers=self.header)
+
+        result_dict = json.loads(response.text)
+        for v in result_dict['values']:
+            if v['kind'] != 'LongAudioSynthesisResult':
+                continue
+
+            result_url = v['links']['contentUrl']
+            logger.debug(f'Result is can be downloaded from "{result_url}"')
+
+            Path(os.path.realpath(os.path.dirname(zip_fn))).mkdir(parents=True, exist_ok=True)
+            # Only the request is retried; a download that breaks off fails the job (--resume re-attaches)
+            with span('azure.long_audio.download') as sp, \
+                    self._http('GET', result_url, 'azure.long_audio.download_request', stream=True) as response:
+                sp['bytes'] = 0
+                with open(zip_fn + '.part', 'wb') as fout:
+                    for block in response.iter_content(chunk_size=1 << 20):
+                        fout.write(block)
+                        sp['bytes'] += len(block)
+            os.replace(zip_fn + '.part', zip_fn)
+            return zip_fn
+
+        raise RuntimeError(f"Azure Task id={task_id} succeeded but lists no LongAudioSynthesisResult file")
+
+    @staticmethod
+    def _extract_audio(zip_fn: str, out_fn: str):
+        # With 'concatenateresult' the zip holds a single audio file next to some json reports
+        with span('unzip_audio', zip_fn=zip_fn), zipfile.ZipFile(zip_fn) as zf:
+            members = [m for m in zf.infolist() if not m.is_dir() and not m.filename.endswith('.json')]
+            assert members, f"No audio file found inside {zip_fn}"
+            audio = max(members, key=lambda m: m.file_size)
+            with zf.open(audio) as fin, open(out_fn + '.part', 'wb') as fout:
+                shutil.copyfileobj(fin, fout, 1 << 20)
+
+        os.replace(out_fn + '.part', out_fn)
+        os.remove(zip_fn)
 
 
 # if __name__ == '__main__':
@@ -1,12 +1,67 @@
+import logging
 import os
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from audio_assemble import Mp3Assembler, is_mp3
+from audio_cache import SegmentCache, get_segment_cache
+from audio_sink import OrderedAudioWriter
+from instrument import TRACER, span
+from job_manifest import JobManifest
+from pipeline import bounded_map, prefetch
+from text_chunk import escaped_len, escaped_utf8_len, iter_chunks_from, split_text
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Engine hook for streaming output: synthesizes one chunk, handing audio to the callback as it arrives
+StreamFn = Callable[[str, Callable[[bytes], None]], None]
 
 
 class VoiceEngine(object):
+    # How chunk_limit() is measured
+    chunk_measure = staticmethod(escaped_utf8_len)
+
     def __init__(self, app_config: dict, eng: str):
         self.app_config = app_config
         self.eng = eng
         self._calc_tone_change()
+        self.cache = get_segment_cache(app_config)
+        # When set, chunk requests go to this (shared) pool instead of one owned by each conversion
+        self.executor: Optional[Executor] = None
+        self.metrics = {}
+
+    def rebind(self, app_config: dict):
+        # Points a warm engine (clients already built) at the next job. Only per-job settings such as
+        # the output file names may differ from the config the engine was built with
+        self.app_config = app_config
+        self.metrics = {}
+
+    def chunk_limit(self) -> int:
+        # Size of the largest chunk one request takes, by chunk_measure (by default: escaped UTF-8 bytes).
+        # Engines that can synthesize single chunks (_synthesize_chunk) say how much they take
+        raise NotImplementedError(f'{type(self).__name__} does not synthesize single chunks')
+
+    def _build_ssml(self, esc_txt: str) -> str:
+        # Body of one request around the escaped text; engines that send SSML wrap it in their markup
+        return esc_txt
+
+    def plan_requests(self, src_txt: str) -> List[str]:
+        # The text of every request convert() would send, for --plan. No request is made
+        try:
+            return split_text(src_txt, self.chunk_limit(), measure=self.chunk_measure)
+        except NotImplementedError:
+            return [src_txt]
+
+    def request_billed_chars(self, txt: str) -> int:
+        # Characters the provider bills for txt: the escaped text, the SSML markup around it is free
+        return escaped_len(txt)
+
+    def plan_warnings(self, src_txt: str, requests: List[str], synth_sec: Optional[float]) -> List[str]:
+        # What would make convert() fail on this text, given the predicted synthesis time if there is one
+        return []
 
     def _get_key_val(self, key: str, def_val: str = None) -> str:
         val = self.app_config[self.eng].get(key, None) or os.getenv(key.upper(), None) or def_val
@@ -24,6 +79,248 @@ class VoiceEngine(object):
         else:
             self.pitch = "100%"
 
+    def _voice_signature(self) -> dict:
+        # Everything besides the text that changes the audio coming back. Engines add their voice settings
+        return {'engine': self.eng, 'rate': self.rate, 'pitch': self.pitch}
+
+    def _cached(self, synth_fn: Callable[[str], bytes]) -> Callable[[str], bytes]:
+        if self.cache is None:
+            return synth_fn
+
+        voice_sig = self._voice_signature()
+
+        def _synth_or_load(chunk: str) -> bytes:
+            key = SegmentCache.make_key(chunk, voice_sig)
+            audio = self.cache.get(key)
+            if audio is None:
+                audio = synth_fn(chunk)
+                self.cache.put(key, audio)
+            return audio
+
+        return _synth_or_load
+
+    def _load_cached_output(self, src_txt: str) -> bool:
+        # For engines that synthesize the whole text in one go: reuse a previous identical run
+        if self.cache is None:
+            return False
+        audio = self.cache.get(SegmentCache.make_key(src_txt, self._voice_signature()))
+        if audio is None:
+            return False
+
+        local_fn = self.app_config['output_audio_fn']
+        Path(os.path.realpath(os.path.dirname(local_fn))).mkdir(parents=True, exist_ok=True)
+        Path(local_fn).write_bytes(audio)
+        logger.info(f'Reused cached audio for unchanged text, written to {local_fn}')
+        return True
+
+    def _save_output_to_cache(self, src_txt: str):
+        if self.cache is None:
+            return
+        audio = Path(self.app_config['output_audio_fn']).read_bytes()
+        self.cache.put(SegmentCache.make_key(src_txt, self._voice_signature()), audio)
+
+    def _open_manifest(self, content: str) -> Optional[JobManifest]:
+        return JobManifest.open(self.app_config, content, self._voice_signature(),
+                                resume=bool(self.app_config.get('resume')))
+
+    @staticmethod
+    def _checkpointed(synth_fn: Callable[[str], bytes],
+                      manifest: Optional[JobManifest]) -> Callable[[int, str], bytes]:
+        # Chunks finished by an earlier, interrupted run are read back instead of synthesized again
+        def _synth_or_resume(index: int, chunk: str) -> bytes:
+            audio = manifest.load_segment(index) if manifest else None
+            if audio is None:
+                audio = synth_fn(chunk)
+                if manifest:
+                    manifest.save_segment(index, audio)
+            return audio
+
+        return _synth_or_resume
+
+    def _synthesize_chunks(self, chunks: List[str], synth_fn: Callable[[str], bytes], workers: int,
+                           stream_fn: Optional[StreamFn] = None) -> str:
+        # Runs synth_fn over the chunks on a bounded pool and writes the audio back in chunk order
+        local_fn = self.app_config['output_audio_fn']
+        if local_fn != '-':
+            Path(os.path.realpath(os.path.dirname(local_fn))).mkdir(parents=True, exist_ok=True)
+
+        manifest = self._open_manifest('\x00'.join(chunks))
+        if manifest:
+            manifest.set_chunks(chunks)
+        self.metrics.update(chunks=len(chunks), chars=sum(len(c) for c in chunks))
+
+        own_pool = ThreadPoolExecutor(max_workers=workers) if self.executor is None else None
+        pool = self.executor or own_pool
+        logger.info(f"Synthesizing {len(chunks)} chunks into {local_fn} ...")
+        try:
+            if self.app_config.get('output_streaming'):
+                self._stream_chunks(chunks, synth_fn, stream_fn, pool, local_fn, manifest)
+            else:
+                synth_one = self._checkpointed(self._cached(synth_fn), manifest)
+                self._assemble(zip(chunks, pool.map(synth_one, range(len(chunks)), chunks)), local_fn)
+        finally:
+            if own_pool:
+                own_pool.shutdown(cancel_futures=True)
+        if manifest:
+            manifest.finish()
+
+        if self.cache is not None:
+            logger.info(f"Segment cache stats: {self.cache.stats()}")
+        return local_fn
+
+    def _assemble(self, results: Iterable[Tuple[str, bytes]], local_fn: str):
+        # (chunk, audio) pairs in order. MP3 segments are joined frame by frame into one stream with a single
+        # Xing header, with 'paragraph_pause_ms' of silence between a chunk that ends a paragraph and the next.
+        # Other formats are appended as is
+        pause_sec = float(self.app_config.get('output_paragraph_pause_ms') or 0) / 1000
+        part_fn = local_fn + '.part'
+        asm = None
+        fout = None
+        try:
+            pause = False
+            for cnt, (chunk, audio) in enumerate(results, 1):
+                if asm is None and fout is None:
+                    if is_mp3(audio):
+                        asm = Mp3Assembler(part_fn)
+                    else:
+                        fout = open(part_fn, 'wb')
+                with span('write_audio', bytes=len(audio)):
+                    if asm is not None:
+                        if pause:
+                            asm.add_silence(pause_sec)
+                        asm.add(audio)
+                    else:
+                        fout.write(audio)
+                pause = bool(pause_sec) and chunk.rstrip(' \t').endswith('\n')
+                logger.debug(f"Chunk {cnt} written, {len(audio)} bytes")
+            if asm is None and fout is None:
+                fout = open(part_fn, 'wb')
+        finally:
+            for out in [asm, fout]:
+                if out is not None:
+                    out.close()
+        if asm is not None:
+            self.metrics['audio_sec'] = asm.duration_sec
+            logger.info(f"Joined {asm.segments} segments into {asm.frames} frames, {asm.duration_sec:.1f}s of audio")
+        os.replace(part_fn, local_fn)
+
+    def convert_pipeline(self, texts: Iterable[str]) -> bool:
+        """
+        Synthesizes text while it is still being extracted (see main.iter_extract_text): chunks are cut
+        and sent off as the text arrives, and the audio is written in order as it comes back. Only a
+        window of chunks and their audio is held at any time, whatever the size of the document.
+        Engines that cannot synthesize single chunks are handed the whole text instead
+        """
+        try:
+            limit = self.chunk_limit()
+        except NotImplementedError:
+            logger.info(f'{type(self).__name__} needs the whole text up front, collecting it first')
+            return self.convert(''.join(texts))
+
+        workers = int(getattr(self, 'workers', None) or 4)
+        # Chunking runs ahead on its own thread, so extraction goes on while requests are out
+        chunks = prefetch(iter_chunks_from(texts, limit, self.chunk_measure), size=2 * workers, name='chunker')
+        local_fn = self._synthesize_stream(chunks, self._synthesize_chunk, workers)
+        logger.info(f"Successfully synthesized {self.metrics['chunks']} chunks into {local_fn}")
+        return True
+
+    def _synthesize_stream(self, chunks: Iterable[str], synth_fn: Callable[[str], bytes], workers: int) -> str:
+        local_fn = self.app_config['output_audio_fn']
+        if local_fn != '-':
+            Path(os.path.realpath(os.path.dirname(local_fn))).mkdir(parents=True, exist_ok=True)
+        if self.app_config.get('resume'):
+            # A manifest is tied to the whole text, which is not known until the end
+            logger.warning('--resume does not apply to pipeline runs; unchanged chunks still come from the cache')
+
+        synth_one = self._cached(synth_fn)
+        self.metrics.update(chunks=0, chars=0)
+
+        def _synth_pair(chunk: str) -> Tuple[str, bytes]:
+            return chunk, synth_one(chunk)
+
+        def _counted() -> Iterator[Tuple[str]]:
+            for chunk in chunks:
+                self.metrics['chunks'] += 1
+                self.metrics['chars'] += len(chunk)
+                yield chunk,
+
+        own_pool = ThreadPoolExecutor(max_workers=workers) if self.executor is None else None
+        pool = self.executor or own_pool
+        logger.info(f"Synthesizing into {local_fn} as the text comes in ...")
+        try:
+            results = bounded_map(pool, _synth_pair, _counted(), window=2 * workers)
+            if self.app_config.get('output_streaming'):
+                writer = OrderedAudioWriter(local_fn)
+                try:
+                    for index, (_, audio) in enumerate(results):
+                        writer.write(index, audio)
+                        writer.finish(index)
+                finally:
+                    writer.close()
+                self.metrics['time_to_first_audio_sec'] = writer.time_to_first_audio
+                TRACER.counter('time_to_first_audio_sec', value=writer.time_to_first_audio)
+            else:
+                self._assemble(results, local_fn)
+        finally:
+            if own_pool:
+                own_pool.shutdown(cancel_futures=True)
+
+        if self.cache is not None:
+            logger.info(f"Segment cache stats: {self.cache.stats()}")
+        return local_fn
+
+    def _stream_chunks(self, chunks: List[str], synth_fn: Callable[[str], bytes], stream_fn: Optional[StreamFn],
+                       pool: Executor, local_fn: str, manifest: Optional[JobManifest] = None):
+        # Audio is appended to the output as soon as everything before it is written,
+        # so a player can start on the file while later chunks are still being synthesized
+        writer = OrderedAudioWriter(local_fn)
+        voice_sig = self._voice_signature()
+
+        def _run_one(index: int, chunk: str):
+            key = SegmentCache.make_key(chunk, voice_sig) if self.cache is not None else None
+            audio = manifest.load_segment(index) if manifest else None
+            if audio is None and key:
+                audio = self.cache.get(key)
+            if audio is not None:
+                writer.write(index, audio)
+            else:
+                if stream_fn is None:
+                    audio = synth_fn(chunk)
+                    writer.write(index, audio)
+                else:
+                    pieces = []
+
+                    def _emit(data: bytes):
+                        pieces.append(data)
+                        writer.write(index, data)
+
+                    stream_fn(chunk, _emit)
+                    audio = b''.join(pieces)
+                if key:
+                    self.cache.put(key, audio)
+                if manifest:
+                    manifest.save_segment(index, audio)
+            writer.finish(index)
+
+        futures = []
+        try:
+            futures = [pool.submit(_run_one, i, c) for i, c in enumerate(chunks)]
+            for f in futures:
+                f.result()
+        except BaseException:
+            # Chunks still running would go on writing: drop those not started, let the others end first
+            for f in futures:
+                f.cancel()
+            wait(futures)
+            raise
+        finally:
+            writer.close()
+
+        self.metrics['time_to_first_audio_sec'] = writer.time_to_first_audio
+        TRACER.counter('time_to_first_audio_sec', value=writer.time_to_first_audio)
+        logger.info(f"Streamed {writer.bytes_written} bytes of audio, "
+                    f"first audio after {writer.time_to_first_audio or 0:.2f}s")
+
     @abstractmethod
     def convert(self, src_txt: str) -> bool:
         pass
@@ -0,0 +1,59 @@
+import logging
+import time
+
+from engine_base import VoiceEngine
+from instrument import span
+from text_chunk import split_text
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# One MPEG-2 Layer III frame, 24 kHz / 48 kbps / mono (same shape as Azure's default
+# Audio24Khz48KBitRateMonoMp3): 4 header bytes and an all-zero body, which decodes to 24 ms of silence
+SILENT_FRAME = b'\xff\xf3\x64\xc0' + bytes(140)
+FRAME_SEC = 576 / 24000
+
+
+class FakeEngine(VoiceEngine):
+    """
+    Offline stand-in for the cloud engines, for benchmarks and dry runs. It returns deterministic
+    silent MP3 audio after a simulated delay of `latency_ms` plus len(chunk) / `chars_per_sec`.
+    Settings come from the 'fake:' section of the config
+    """
+    chunk_measure = staticmethod(len)
+
+    def __init__(self, app_config: dict):
+        app_config.setdefault('fake', {})
+        super().__init__(app_config, 'fake')
+
+        fake_cfg = self.app_config['fake']
+        self.latency_sec = float(fake_cfg.get('latency_ms') or 0) / 1000
+        self.chars_per_sec = float(fake_cfg.get('chars_per_sec') or 0)
+        # How long the audio of one character lasts, at speed 1.0
+        self.audio_sec_per_char = float(fake_cfg.get('audio_sec_per_char') or 0.2)
+        self.chunk_chars = int(fake_cfg.get('chunk_chars') or 3000)
+        self.workers = int(fake_cfg.get('workers') or 4)
+        self.speed = float(fake_cfg.get('speed') or 1.0)
+
+    def chunk_limit(self) -> int:
+        return self.chunk_chars
+
+    def convert(self, src_txt: str) -> bool:
+        chunks = split_text(src_txt, self.chunk_chars, measure=self.chunk_measure)
+        local_fn = self._synthesize_chunks(chunks, self._synthesize_chunk, self.workers, self._stream_chunk)
+        logger.info(f'Successfully synthesized {len(chunks)} chunks into {local_fn}')
+        return True
+
+    def _synthesize_chunk(self, chunk: str) -> bytes:
+        delay = self.latency_sec + (len(chunk) / self.chars_per_sec if self.chars_per_sec else 0)
+        with span('fake.synthesize', cat='engine', chars=len(chunk)) as sp:
+            if delay:
+                time.sleep(delay)
+            frame_cnt = max(1, round(len(chunk) * self.audio_sec_per_char / self.speed / FRAME_SEC))
+            sp['bytes'] = frame_cnt * len(SILENT_FRAME)
+        return SILENT_FRAME * frame_cnt
+
+    def _stream_chunk(self, chunk: str, emit):
+        audio = self._synthesize_chunk(chunk)
+        for pos in range(0, len(audio), 16 * 1024):
+            emit(audio[pos:pos + 16 * 1024])
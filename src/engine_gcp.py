@@ -1,52 +1,183 @@
-# NOT active
-# Run: GOOGLE_APPLICATION_CREDENTIALS=/Users/bing.wu/.ssh/personal_gcp_svc_acct.json gcloud auth application-default print-access-token | pbcopy
-import base64
+import binascii
+import json
 import logging
+import math
+import os
+import shlex
+import subprocess
+import threading
+from typing import Optional
 
 import requests
 
+from engine_base import VoiceEngine
+from instrument import span
+from rate_limit import TransientError, get_rate_limiter, parse_retry_after
+from text_chunk import split_text
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-TEST_SIG = "ya29.c.b0AUFJQsFQ9y25m6MpXmzDH2Vj1MalANmwhpv7Yy50sYzSXUS3jqngcYqvO1Vzbui3cVZfO8kLLvgU_GC81Qu5RgsKP8aDpemCtg9fUc6Mk3p9N-sziXiix1zLl5cFxESQttBGYgGip1-dg4a0N0OPkJh2ANpseAvhAFSIRYIWJBYhuF73JYI8hIsWVqx91xruILjPjKN2BZK7PYv7m9ZWr_Zak0KSRc4........................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................"
-GCP_T2S_HEADER = {
-    "Content-Type": "application/json; charset=utf-8",
-    "Authorization": 'Bearer ' + TEST_SIG,
-}
-
-
-def gcp_text2speech(src_txt: str, out_fn: str) -> Any:
-    payload = {
-        "audioConfig": {
-            "audioEncoding": "LINEAR16",
-            "pitch": 0,
-            "speakingRate": 0.94
-        },
-        "input": {
-            "text": src_txt[:5000]
-        },
-        "voice": {
-            # "languageCode": "en-US",
-            "languageCode": "zh-guoyu",
-            "name": "en-US-Wavenet-D",
-            # "name": "en-US-Neural2-F",
-        }
+ENDPOINT = 'https://texttospeech.googleapis.com/v1/text:synthesize'
+
+
+def _utf8_len(txt: str) -> int:
+    return len(txt.encode('utf-8'))
+
+
+def _audio_content(body: bytes) -> bytes:
+    # The base64 audio is by far the largest part of the response: decode it from a view of the raw
+    # body, instead of having the JSON parser copy it into a str first
+    key = body.find(b'"audioContent"')
+    start = body.find(b'"', body.find(b':', key) + 1) + 1 if key >= 0 else 0
+    end = body.find(b'"', start) if start else -1
+    if end < 0 or body.find(b'\\', start, end) >= 0:
+        # Not the plain layout the service sends: take the slow road
+        return binascii.a2b_base64(json.loads(body)['audioContent'])
+    with memoryview(body) as view:
+        return binascii.a2b_base64(view[start:end])
+
+
+class GcpTts(VoiceEngine):
+    """
+    Google Cloud Text-to-Speech through its REST endpoint. The text is cut into requests of at most
+    5000 bytes, sent concurrently over one pooled keep-alive session. MP3 (or OGG_OPUS) output, so the
+    pieces are joined without transcoding. Settings come from the 'gcp:' section of the config
+    """
+    # Bytes of input one synthesize request takes
+    max_request_bytes = 5000
+    chunk_measure = staticmethod(_utf8_len)
+
+    locale_mapping = {
+        'english': 'en-US',
+        'chinese-普通': 'cmn-CN',
+        'chinese-台湾': 'cmn-TW',
+        'chinese-广东': 'yue-HK',
     }
-    resp = requests.post(url='https://texttospeech.googleapis.com/v1/text:synthesize',
-                         json=payload,
-                         headers=GCP_T2S_HEADER
-                         )
-    if resp.status_code != 200:
-        err_dict = resp.json().get('error', {})
-        msg = (
-            f"Remote GCP synthesize call failed. The error is '{err_dict['code']}', "
-            f"message is '{err_dict['message']}'"
-        )
-        logger.error(msg)
-        raise RuntimeError(msg)
-
-    ret_data = resp.json()["audioContent"]
-    with open(out_fn, 'wb') as fout:
-        fout.write(bytearray(base64.b64decode(ret_data)))
-
-    return True
+    encodings = {'MP3': '.mp3', 'OGG_OPUS': '.ogg'}
+
+    def __init__(self, app_config: dict):
+        app_config.setdefault('gcp', {})
+        super().__init__(app_config, 'gcp')
+
+        gcp_cfg = self.app_config['gcp']
+        self.endpoint = gcp_cfg.get('endpoint') or ENDPOINT
+        self.language_code = gcp_cfg.get('language_code') or GcpTts.locale_mapping.get(self.app_config['lang'])
+        assert self.language_code, f"No GCP language for '{self.app_config['lang']}', set 'gcp/language_code'"
+        # Without a name, the service picks a voice for the language
+        self.voice_name = gcp_cfg.get('voice_name')
+        self.audio_encoding = gcp_cfg.get('audio_encoding') or 'MP3'
+        assert self.audio_encoding in GcpTts.encodings, \
+            f"'gcp/audio_encoding' must be one of {', '.join(GcpTts.encodings)}, so chunks can be joined"
+        self.sample_rate = int(gcp_cfg.get('sample_rate_hertz') or 0)
+        self.workers = int(gcp_cfg.get('workers') or 4)
+        self.http_timeout = (10, 120)
+        self._use_output_extension()
+
+        # An API key, a fixed access token, or a command printing one (run again when the token expires),
+        # e.g. 'gcloud auth print-access-token'. The command runs without a shell
+        self.api_key = gcp_cfg.get('api_key') or os.getenv('GOOGLE_API_KEY')
+        token_cmd = gcp_cfg.get('access_token_cmd') or os.getenv('GCP_ACCESS_TOKEN_CMD')
+        self.token_cmd = shlex.split(token_cmd) if isinstance(token_cmd, str) else token_cmd
+        self._token = gcp_cfg.get('access_token')
+        assert self.api_key or self._token or self.token_cmd, \
+            "Missing GCP credentials: set 'gcp/api_key', 'gcp/access_token' or 'gcp/access_token_cmd'"
+        self._token_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(self.workers, 4))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.limiter = get_rate_limiter(self.app_config, 'gcp')
+
+    def rebind(self, app_config: dict):
+        super().rebind(app_config)
+        self._use_output_extension()
+
+    def _use_output_extension(self):
+        out_fn = self.app_config.get('output_audio_fn')
+        ext = GcpTts.encodings[self.audio_encoding]
+        if out_fn and out_fn != '-' and out_fn.endswith('.mp3') and ext != '.mp3':
+            self.app_config['output_audio_fn'] = out_fn[:-4] + ext
+
+    def _calc_tone_change(self):
+        # speakingRate is a factor already; pitch is in semitones, 12 per doubling of the frequency
+        gcp_cfg = self.app_config[self.eng]
+        self.rate = float(gcp_cfg.get('speed') or 1.0)
+        self.pitch = round(12 * math.log2(float(gcp_cfg.get('pitch') or 1.0)), 2)
+
+    def _voice_signature(self) -> dict:
+        return dict(super()._voice_signature(), voice=self.voice_name, locale=self.language_code,
+                    audio_format=self.audio_encoding, sample_rate=self.sample_rate)
+
+    def chunk_limit(self) -> int:
+        return GcpTts.max_request_bytes
+
+    def request_billed_chars(self, txt: str) -> int:
+        # Plain text input: every character, white space included
+        return len(txt)
+
+    def _build_ssml(self, esc_txt: str) -> str:
+        # Requests carry plain text; --plan sizes them by this
+        return esc_txt
+
+    def convert(self, src_txt: str) -> bool:
+        chunks = split_text(src_txt, self.chunk_limit(), measure=self.chunk_measure)
+        local_fn = self._synthesize_chunks(chunks, self._synthesize_chunk, self.workers)
+        logger.info(f'Successfully synthesized {len(chunks)} chunks into {local_fn}')
+        return True
+
+    def _auth(self, stale: Optional[str] = None) -> dict:
+        if self.api_key:
+            return {'params': {'key': self.api_key}}
+        with self._token_lock:
+            if self.token_cmd and (self._token is None or 'Bearer ' + self._token == stale):
+                self._token = subprocess.run(self.token_cmd, check=True, capture_output=True,
+                                             text=True).stdout.strip()
+            return {'headers': {'Authorization': 'Bearer ' + self._token}}
+
+    def _payload(self, chunk: str) -> dict:
+        voice = {'languageCode': self.language_code}
+        if self.voice_name:
+            voice['name'] = self.voice_name
+        audio_config = {'audioEncoding': self.audio_encoding, 'speakingRate': self.rate, 'pitch': self.pitch}
+        if self.sample_rate:
+            audio_config['sampleRateHertz'] = self.sample_rate
+        return {'input': {'text': chunk}, 'voice': voice, 'audioConfig': audio_config}
+
+    def _synthesize_chunk(self, chunk: str) -> bytes:
+        body = json.dumps(self._payload(chunk), ensure_ascii=False).encode('utf-8')
+
+        def _request() -> bytes:
+            auth = self._auth()
+            with span('gcp.synthesize', cat='engine', chars=len(chunk)) as sp:
+                try:
+                    resp = self._post(body, auth)
+                    if resp.status_code == 401 and self.token_cmd:
+                        # The access token ran out: fetch a new one and try once more
+                        resp = self._post(body, self._auth(stale=auth['headers']['Authorization']))
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    raise TransientError(str(e)) from e
+                sp['http_status'] = resp.status_code
+                if resp.status_code == 200:
+                    audio = _audio_content(resp.content)
+                    sp['bytes'] = len(audio)
+                    return audio
+
+            try:
+                err_dict = resp.json().get('error', {})
+            except ValueError:
+                err_dict = {}
+            msg = (f"Remote GCP synthesize call failed. The error is '{err_dict.get('code', resp.status_code)}', "
+                   f"message is '{err_dict.get('message', resp.reason)}'")
+            if resp.status_code == 429 or resp.status_code >= 500:
+                raise TransientError(msg, parse_retry_after(resp.headers.get('Retry-After')))
+            logger.error(msg)
+            raise RuntimeError(msg)
+
+        return self.limiter.call(_request, chars=len(chunk), what='gcp.synthesize')
+
+    def _post(self, body: bytes, auth: dict) -> requests.Response:
+        headers = dict(auth.get('headers') or {}, **{'Content-Type': 'application/json; charset=utf-8'})
+        return self.session.post(self.endpoint, data=body, headers=headers, params=auth.get('params'),
+                                 timeout=self.http_timeout)
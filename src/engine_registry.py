@@ -0,0 +1,54 @@
+import importlib
+import logging
+from typing import Dict, List, Type
+
+from engine_base import VoiceEngine
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Engine name -> 'module:Class'. A module (and the cloud SDK it imports) is only loaded once its
+# engine is picked, so runs that never synthesize don't pay for boto3 or the Azure Speech SDK
+_ENGINES: Dict[str, str] = {
+    'aws': 'engine_aws:AwsPolly',
+    'azure': 'engine_azure:AzureBob',
+    'azure_long_audio': 'engine_azure_async:AzureBobAsync',
+    'gcp': 'engine_gcp:GcpTts',
+    'fake': 'engine_fake:FakeEngine',
+    'shard': 'engine_shard:ShardedEngine',
+}
+_loaded: Dict[str, Type[VoiceEngine]] = {}
+
+
+def register_engine(name: str, target: str):
+    """
+    Makes an engine available under `name`. target: 'module:Class', importable from sys.path
+    """
+    assert ':' in target, f"Engine target must look like 'module:Class', got '{target}'"
+    _ENGINES[name] = target
+    _loaded.pop(name, None)
+
+
+def engine_names() -> List[str]:
+    return sorted(_ENGINES)
+
+
+def load_engine_class(name: str) -> Type[VoiceEngine]:
+    if name not in _loaded:
+        # A 'module:Class' spec works as a name too, for engines that were never registered
+        target = _ENGINES.get(name) or (name if ':' in name else None)
+        assert target, f"Unknown Engine specification {name}, choose from {', '.join(engine_names())}"
+        module_name, cls_name = target.split(':', 1)
+        cls = getattr(importlib.import_module(module_name), cls_name)
+        assert issubclass(cls, VoiceEngine), f"{target} is not a VoiceEngine"
+        _loaded[name] = cls
+    return _loaded[name]
+
+
+def make_engine(use_eng: str, app_config: dict) -> VoiceEngine:
+    if use_eng == 'azure' and (app_config.get('azure') or {}).get('long_audio'):
+        use_eng = 'azure_long_audio'
+
+    cls = load_engine_class(use_eng)
+    logger.info(f'Using {use_eng} engine ({cls.__name__})')
+    return cls(app_config)
@@ -0,0 +1,221 @@
+import copy
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Optional, TypeVar
+
+from engine_base import VoiceEngine
+from engine_registry import make_engine
+from text_chunk import split_text
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+T = TypeVar('T')
+
+# Voices that sound alike across providers, so a book read by both does not change speaker mid-way
+MATCHING_VOICES = [
+    {'aws': 'Matthew', 'azure': 'en-US-EricNeural'},
+    {'aws': 'Joanna', 'azure': 'en-US-MichelleNeural'},
+]
+
+
+class _Lane(object):
+    # One sub-engine, with what has been measured about it so far
+    def __init__(self, name: str, engine: VoiceEngine):
+        self.name = name
+        self.engine = engine
+        # Latency and size of the latest requests
+        self.samples = deque(maxlen=200)
+        # Concurrent requests the engine is meant to take; more are only sent when all lanes are full
+        self.slots = int(getattr(engine, 'workers', None) or 4)
+        self.inflight = 0
+        self.inflight_chars = 0
+        self.failures = 0
+        self.down = False
+        self.stats = {'chunks': 0, 'chars': 0, 'errors': 0, 'hedges_sent': 0, 'hedges_won': 0}
+
+    def mean_sec_per_char(self) -> Optional[float]:
+        return sum(s for s, _ in self.samples) / max(1, sum(c for _, c in self.samples)) if self.samples else None
+
+    def latency_limit(self, pct: float, chars: int) -> float:
+        # Requests cost a fixed overhead plus time per character: the percentile of the raw latencies,
+        # stretched only for chunks longer than usual
+        ordered = sorted(s for s, _ in self.samples)
+        mean_chars = sum(c for _, c in self.samples) / len(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] * max(1.0, chars / max(1.0, mean_chars))
+
+
+class ShardedEngine(VoiceEngine):
+    """
+    Spreads the chunks of one text over all engines listed for the language (e.g. aws and azure for
+    English). Each chunk goes to the engine expected to finish it first, judging by its measured
+    seconds per character and the work it already has in flight. A chunk running longer than the
+    hedge percentile of its engine gets a duplicate request on another engine, and the first answer
+    wins. An engine failing `failover_after` times in a row is dropped for the rest of the run.
+    Settings come from the 'shard:' section of the config
+    """
+
+    def __init__(self, app_config: dict):
+        app_config.setdefault('shard', {})
+        super().__init__(app_config, 'shard')
+
+        shard_cfg = self.app_config['shard']
+        self.hedge_percentile = float(shard_cfg.get('hedge_percentile') or 95)
+        self.hedge_min_samples = int(shard_cfg.get('hedge_min_samples') or 8)
+        # Before enough samples are in, a chunk is hedged after this long
+        self.hedge_after_sec = float(shard_cfg.get('hedge_after_sec') or 30)
+        self.failover_after = int(shard_cfg.get('failover_after') or 3)
+
+        names = shard_cfg.get('engines') or self.app_config['engines'][self.app_config['lang_prefix']]['choices']
+        assert len(names) > 1, "Sharding needs at least two engines"
+        sub_config = self._matched_voices(names)
+        self.lanes = [_Lane(name, make_engine(name, sub_config)) for name in names]
+        self.workers = int(shard_cfg.get('workers') or sum(lane.slots for lane in self.lanes))
+        self._lock = threading.Lock()
+
+    def rebind(self, app_config: dict):
+        # The lanes follow, with the same voice matching. Their engine sections are part of the daemon's
+        # pool key, so a warm sharded engine only ever comes back for the same lane settings
+        super().rebind(app_config)
+        sub_config = self._matched_voices([lane.name for lane in self.lanes])
+        for lane in self.lanes:
+            lane.engine.rebind(sub_config)
+            lane.down = False
+            lane.failures = 0
+            lane.stats = {k: 0 for k in lane.stats}
+
+    def _matched_voices(self, names: List[str]) -> dict:
+        # An engine left on its default voice gets the counterpart of the voice picked for another one.
+        # With no voice picked anywhere, all of them get the first pair
+        conf = copy.copy(self.app_config)
+        voice_keys = {'aws': 'voice_id', 'azure': 'voice_name'}
+        names = [n for n in names if n in voice_keys]
+        chosen = {n: (conf.get(n) or {}).get(voice_keys[n]) for n in names}
+        pair = next((p for p in MATCHING_VOICES if any(chosen[n] and p[n] == chosen[n] for n in names)), None)
+        if pair is None and not any(chosen.values()):
+            pair = MATCHING_VOICES[0]
+        for n in names:
+            if pair and not chosen[n]:
+                conf[n] = dict(conf.get(n) or {}, **{voice_keys[n]: pair[n]})
+                logger.info(f'Using voice {pair[n]} on {n}, to match the other engine')
+        return conf
+
+    def _voice_signature(self) -> dict:
+        return dict(super()._voice_signature(), lanes=[lane.engine._voice_signature() for lane in self.lanes])
+
+    def chunk_limit(self) -> int:
+        return min(lane.engine.chunk_limit() for lane in self.lanes)
+
+    def convert(self, src_txt: str) -> bool:
+        chunks = split_text(src_txt, self.chunk_limit())
+        local_fn = self._with_attempts(lambda: self._synthesize_chunks(chunks, self._synthesize_chunk, self.workers))
+        logger.info(f'Successfully synthesized {len(chunks)} chunks into {local_fn}')
+        return True
+
+    def convert_pipeline(self, texts: Iterable[str]) -> bool:
+        return self._with_attempts(lambda: super(ShardedEngine, self).convert_pipeline(texts))
+
+    def _with_attempts(self, run: Callable[[], T]) -> T:
+        # Room for a hedge next to every primary request
+        self._attempts = ThreadPoolExecutor(max_workers=2 * self.workers, thread_name_prefix='shard')
+        try:
+            retval = run()
+        finally:
+            self._attempts.shutdown(wait=False, cancel_futures=True)
+
+        self.metrics['lanes'] = {lane.name: dict(lane.stats, down=lane.down) for lane in self.lanes}
+        for lane in self.lanes:
+            logger.info(f"[{lane.name}] {lane.stats['chunks']} chunks, {lane.stats['chars']} chars, "
+                        f"{lane.stats['errors']} errors, hedges sent/won {lane.stats['hedges_sent']}/"
+                        f"{lane.stats['hedges_won']}{', DOWN' if lane.down else ''}")
+        return retval
+
+    def _pick_lane(self, chars: int, exclude: set) -> Optional[_Lane]:
+        # A lane with a free slot first, so every engine runs at its own concurrency and the chunks split
+        # by throughput. Among those, the earliest expected finish at the lane's measured speed.
+        # Lanes without measurements yet are assumed to be as fast as the fastest known one
+        with self._lock:
+            lanes = [lane for lane in self.lanes if not lane.down and lane not in exclude]
+            if not lanes:
+                return None
+            known = [lane.mean_sec_per_char() for lane in lanes if lane.samples]
+            default_speed = min(known) if known else 1.0
+            lane = min([l for l in lanes if l.inflight < l.slots] or lanes,
+                       key=lambda l: (l.inflight_chars / l.slots + chars) * (l.mean_sec_per_char() or default_speed))
+            lane.inflight += 1
+            lane.inflight_chars += chars
+            return lane
+
+    def _hedge_after(self, lane: _Lane, chars: int) -> float:
+        with self._lock:
+            if len(lane.samples) < self.hedge_min_samples:
+                return self.hedge_after_sec
+            return lane.latency_limit(self.hedge_percentile, chars)
+
+    def _attempt(self, lane: _Lane, chunk: str) -> bytes:
+        t0 = time.perf_counter()
+        try:
+            audio = lane.engine._synthesize_chunk(chunk)
+        except Exception:
+            with self._lock:
+                lane.inflight -= 1
+                lane.inflight_chars -= len(chunk)
+                lane.stats['errors'] += 1
+                lane.failures += 1
+                if lane.failures >= self.failover_after and not lane.down:
+                    lane.down = True
+                    logger.warning(f'[{lane.name}] failed {lane.failures} times in a row, '
+                                   f'sending everything to the other engines')
+            raise
+
+        with self._lock:
+            lane.inflight -= 1
+            lane.inflight_chars -= len(chunk)
+            lane.failures = 0
+            lane.samples.append((time.perf_counter() - t0, len(chunk)))
+        return audio
+
+    def _synthesize_chunk(self, chunk: str) -> bytes:
+        attempts: Dict[Future, _Lane] = {}
+        tried = set()
+        primary = hedge_future = None
+        hedged = False
+        last_error = None
+        while True:
+            if not attempts:
+                # First try, or every earlier one failed: fail over to an engine not tried yet
+                primary = self._pick_lane(len(chunk), exclude=tried)
+                if primary is None:
+                    raise RuntimeError(f'All engines failed on a chunk, last error: {last_error}')
+                tried.add(primary)
+                attempts[self._attempts.submit(self._attempt, primary, chunk)] = primary
+                hedged = False
+
+            timeout = None if hedged else self._hedge_after(primary, len(chunk))
+            done, _ = wait(list(attempts), timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # Running late: a duplicate on another engine, whichever answers first wins
+                hedged = True
+                lane = self._pick_lane(len(chunk), exclude=tried)
+                if lane is not None:
+                    tried.add(lane)
+                    with self._lock:
+                        lane.stats['hedges_sent'] += 1
+                    hedge_future = self._attempts.submit(self._attempt, lane, chunk)
+                    attempts[hedge_future] = lane
+                continue
+
+            for f in done:
+                lane = attempts.pop(f)
+                if f.exception() is None:
+                    with self._lock:
+                        lane.stats['chunks'] += 1
+                        lane.stats['chars'] += len(chunk)
+                        if f is hedge_future:
+                            lane.stats['hedges_won'] += 1
+                    return f.result()
+                last_error = f.exception()
+                logger.warning(f'[{lane.name}] chunk failed: {last_error}')
@@ -0,0 +1,58 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Optional, Tuple
+
+from text_clean import CLEAN_RULES_VERSION
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class ExtractCache(object):
+    """
+    Cleaned text from previous extractions, one '<key>.txt' per source plus a '<key>.json' with
+    whatever is needed to tell whether the source changed (e.g. HTTP validators)
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        # The cleaning rules are part of every key: changing them invalidates all old extractions
+        sig = json.dumps([CLEAN_RULES_VERSION] + list(parts), ensure_ascii=False)
+        return hashlib.sha256(sig.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Tuple[Optional[str], dict]:
+        txt_fn = os.path.join(self.cache_dir, key + '.txt')
+        meta_fn = os.path.join(self.cache_dir, key + '.json')
+        if not os.path.exists(txt_fn) or not os.path.exists(meta_fn):
+            return None, {}
+        return Path(txt_fn).read_text(encoding='utf-8'), json.loads(Path(meta_fn).read_text())
+
+    def put(self, key: str, text: str, meta: Optional[dict] = None):
+        for suffix, content in [('.txt', text), ('.json', json.dumps(meta or {}))]:
+            fn = os.path.join(self.cache_dir, key + suffix)
+            with open(fn + '.tmp', 'w', encoding='utf-8') as fout:
+                fout.write(content)
+            os.replace(fn + '.tmp', fn)
+
+
+def get_extract_cache(app_config: dict) -> Optional[ExtractCache]:
+    # Lives next to the audio segments, under the same 'cache:' section of the config
+    cache_cfg = app_config.get('cache') or {}
+    if not cache_cfg.get('directory'):
+        return None
+    return ExtractCache(os.path.join(os.path.realpath(os.path.expanduser(cache_cfg['directory'])), 'extracts'))
+
+
+def file_fingerprint(in_file: str) -> str:
+    digest = hashlib.sha256()
+    with open(in_file, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
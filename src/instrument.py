@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class Tracer(object):
+    """
+    Collects timed spans (config load, extraction, cleaning, every engine request and poll, file
+    writes) and keeps a latency histogram per engine call. The export is in Chrome's trace event
+    format, so it opens in chrome://tracing or https://ui.perfetto.dev
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+        self.events: List[dict] = []
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+
+    def _now_us(self) -> float:
+        return (time.perf_counter() - self._t0) * 1e6
+
+    @contextmanager
+    def span(self, name: str, cat: str = 'app', **args):
+        """
+        Times the enclosed block. The yielded dict ends up as the span's args, so the block can add
+        what it learns along the way (bytes received, retries, status ...)
+        """
+        start = self._now_us()
+        try:
+            yield args
+        except Exception as e:
+            args['error'] = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            dur = self._now_us() - start
+            event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': round(start, 1), 'dur': round(dur, 1),
+                     'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+            with self._lock:
+                self.events.append(event)
+                if cat == 'engine':
+                    self.latencies[name].append(dur / 1e6)
+
+    def counter(self, name: str, **values):
+        with self._lock:
+            self.events.append({'name': name, 'ph': 'C', 'ts': round(self._now_us(), 1),
+                                'pid': os.getpid(), 'args': values})
+
+    def histograms(self) -> Dict[str, dict]:
+        # Per engine call: percentiles plus counts in power-of-two buckets (upper bound in seconds)
+        retval = {}
+        with self._lock:
+            latencies = {k: sorted(v) for k, v in self.latencies.items()}
+        for name, values in latencies.items():
+            buckets = defaultdict(int)
+            for v in values:
+                bound = 0.001
+                while bound < v:
+                    bound *= 2
+                buckets[f'{bound:g}'] += 1
+            retval[name] = {
+                'count': len(values),
+                'p50': values[len(values) // 2],
+                'p90': values[min(len(values) - 1, int(len(values) * 0.9))],
+                'p99': values[min(len(values) - 1, int(len(values) * 0.99))],
+                'max': values[-1],
+                'buckets_sec': dict(buckets),
+            }
+        return retval
+
+    def write_chrome_trace(self, out_fn: str):
+        with self._lock:
+            events = list(self.events)
+        trace = {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'latency_histograms': self.histograms()},
+        }
+        with open(out_fn, 'w') as fout:
+            json.dump(trace, fout, ensure_ascii=False, default=str)
+        logger.info(f'Wrote {len(events)} trace events to {out_fn}')
+
+
+TRACER = Tracer()
+span = TRACER.span
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+MANIFEST_VERSION = 1
+
+
+def _sha256(txt: str) -> str:
+    return hashlib.sha256(txt.encode('utf-8')).hexdigest()
+
+
+def _write_atomic(fn: str, data: bytes):
+    with open(fn + '.part', 'wb') as fout:
+        fout.write(data)
+    os.replace(fn + '.part', fn)
+
+
+class JobManifest(object):
+    """
+    Progress of one conversion, saved next to the output audio as <output name>.manifest.json, so
+    an interrupted run can be picked up with --resume: the status and audio segment of every chunk,
+    or the remote task (Polly task ID, Azure long-audio Location URL) to re-attach to
+    """
+    # A segment file is written before its chunk is marked done, so the manifest itself only needs
+    # saving now and then; a stale one loses nothing
+    save_interval_sec = 1.0
+
+    def __init__(self, fn: str, data: dict):
+        self.fn = fn
+        self.data = data
+        self.segment_dir = fn[:-len('.manifest.json')] + '.segments'
+        self.resumed = 0
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+
+    @staticmethod
+    def path_for(app_config: dict) -> Optional[str]:
+        audio_fn = app_config.get('output_audio_fn')
+        if not audio_fn or audio_fn == '-':
+            return None
+        # Next to the audio and named after it: the extracted text may be the user's own source file
+        # (txt sources), and several outputs (--langs) can share one extracted text
+        name = os.path.splitext(os.path.basename(audio_fn))[0]
+        return os.path.join(os.path.dirname(os.path.realpath(audio_fn)), name + '.manifest.json')
+
+    @classmethod
+    def open(cls, app_config: dict, content: str, voice_sig: dict, resume: bool) -> Optional['JobManifest']:
+        """
+        With resume, continues the manifest of an earlier run if it was for the same text and voice.
+        Otherwise (or if there is none) starts a new one. None when the output cannot be checkpointed
+        """
+        fn = cls.path_for(app_config)
+        if fn is None:
+            return None
+
+        content_sha = _sha256(content)
+        voice = json.loads(json.dumps(voice_sig, sort_keys=True))
+        if resume and os.path.exists(fn):
+            data = json.loads(Path(fn).read_text())
+            if data.get('version') == MANIFEST_VERSION and data.get('content_sha256') == content_sha \
+                    and data.get('voice') == voice:
+                logger.info(f'Resuming from {fn}')
+                return cls(fn, data)
+            logger.warning(f'{fn} belongs to a different text or voice, starting over')
+        elif resume:
+            logger.warning(f'Nothing to resume, {fn} does not exist')
+
+        Path(os.path.dirname(fn)).mkdir(parents=True, exist_ok=True)
+        manifest = cls(fn, {
+            'version': MANIFEST_VERSION,
+            'content_sha256': content_sha,
+            'voice': voice,
+            'output_audio_fn': app_config['output_audio_fn'],
+            'status': 'running',
+            'chunks': [],
+            'task': None,
+        })
+        # Segments of an older run are not ours
+        shutil.rmtree(manifest.segment_dir, ignore_errors=True)
+        manifest.save(force=True)
+        return manifest
+
+    def save(self, force: bool = False):
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_save < JobManifest.save_interval_sec:
+                return
+            self._last_save = now
+            data = json.dumps(self.data, ensure_ascii=False, indent=1).encode('utf-8')
+            _write_atomic(self.fn, data)
+
+    # Chunked conversions
+
+    def set_chunks(self, chunks: List[str]):
+        # Entries of a resumed run are kept where index and text still match
+        old = {(c['index'], c['sha256']): c for c in self.data['chunks']}
+        entries = []
+        for index, chunk in enumerate(chunks):
+            sha = _sha256(chunk)
+            entries.append(old.get((index, sha)) or {'index': index, 'sha256': sha, 'chars': len(chunk),
+                                                     'status': 'pending'})
+        self.data['chunks'] = entries
+        self.save(force=True)
+
+    def _segment_fn(self, index: int) -> str:
+        # The text hash in the name ties the segment to its chunk, whatever the manifest says
+        return os.path.join(self.segment_dir, f"{index:06d}.{self.data['chunks'][index]['sha256'][:16]}.seg")
+
+    def load_segment(self, index: int) -> Optional[bytes]:
+        seg_fn = self._segment_fn(index)
+        if not os.path.exists(seg_fn):
+            return None
+        with self._lock:
+            self.data['chunks'][index].update(status='done', segment_fn=seg_fn)
+            self.resumed += 1
+        return Path(seg_fn).read_bytes()
+
+    def save_segment(self, index: int, audio: bytes):
+        seg_fn = self._segment_fn(index)
+        Path(self.segment_dir).mkdir(parents=True, exist_ok=True)
+        _write_atomic(seg_fn, audio)
+        with self._lock:
+            self.data['chunks'][index].update(status='done', segment_fn=seg_fn)
+        self.save()
+
+    # Remote (long-running) tasks
+
+    @property
+    def task(self) -> Optional[dict]:
+        return self.data.get('task')
+
+    def set_task(self, **task):
+        self.data['task'] = dict(self.data.get('task') or {}, **task)
+        self.save(force=True)
+
+    def finish(self):
+        # The output file is complete; the segments are not needed any more
+        if self.resumed:
+            logger.info(f'Resumed {self.resumed} of {len(self.data["chunks"])} chunks from the previous run')
+        self.data['status'] = 'done'
+        for entry in self.data['chunks']:
+            entry.pop('segment_fn', None)
+        shutil.rmtree(self.segment_dir, ignore_errors=True)
+        self.save(force=True)
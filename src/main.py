@@ -1,15 +1,24 @@
 import argparse
+import atexit
+import copy
+import hashlib
 import logging
 import os.path
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, List, Optional
 
-import chinese_converter
 import yaml
 
-from engine_aws import AwsPolly
-from engine_azure import AzureBob
+from engine_registry import load_engine_class, make_engine
+from extract_cache import ExtractCache, file_fingerprint, get_extract_cache
+from instrument import TRACER, span
+from pdf_extract import count_pages, iter_page_texts_parallel, parse_page_range
+from plan import format_plan, plan_conversion, record_run
+from text_clean import BoilerplateFilter, iter_clean_pages, iter_normalize, normalize_text
+from web_fetch import PageFetcher, find_next_page
 
 logger = logging.getLogger(__name__)
 # logger.setLevel(logging.INFO)
@@ -43,6 +52,8 @@ def process_config(cfg_fn: str) -> dict:
 
     if conf['text_source'].get('inspect_output', False):
         conf['inspect_extract_txt'] = True
+    conf['normalize_text'] = bool(conf['text_source'].get('normalize', True))
+    conf['strip_boilerplate'] = bool(conf['text_source'].get('strip_boilerplate', True))
 
     conf.pop('text_source', None)
 
@@ -55,78 +66,335 @@ def process_config(cfg_fn: str) -> dict:
                                       conf['invocation-theme-word'] + '.extracted.txt'
     conf['output_audio_fn'] = _parse_dir(output_dict['directory']) + os.sep + \
                               output_dict['invocation']['theme-word'] + '.mp3'
+    conf['output_streaming'] = bool(output_dict.get('streaming', False))
+    conf['output_pipeline'] = bool(output_dict.get('pipeline', False))
+    conf['output_paragraph_pause_ms'] = int(output_dict.get('paragraph_pause_ms') or 0)
     conf.pop('output', None)
 
     return conf
 
 
-def what_engine_to_use():
-    if APP_CONFIG.get('engines').get('invocation', None):
-        return APP_CONFIG['engines']['invocation']
+def what_engine_to_use(app_config: Optional[dict] = None) -> str:
+    app_config = app_config or APP_CONFIG
+    if app_config.get('engines').get('invocation', None):
+        return app_config['engines']['invocation']
+
+    this_lang = app_config['lang_prefix']
+    lang_engines = app_config['engines'][this_lang]
+    # 'shard: True' uses all the choices at once, see engine_shard
+    if lang_engines.get('shard') and len(lang_engines['choices']) > 1:
+        return 'shard'
+    return lang_engines['choices'][0]
+
+
+def resolve_langs(app_config: dict, langs: List[str]) -> List[str]:
+    # Accepts full 'lang' choices ('chinese-四川'), bare dialect names ('四川'), or 'all'.
+    # 'all' means every Azure mapping in the same language as the configured 'lang'
+    locale_mapping = load_engine_class('azure').locale_mapping
+    if langs == ['all']:
+        return [k for k in locale_mapping if k.split('-')[0] == app_config['lang_prefix']]
+
+    retval = []
+    for lang in langs:
+        if lang not in locale_mapping and f'chinese-{lang}' in locale_mapping:
+            lang = f'chinese-{lang}'
+        assert lang in locale_mapping, f"Unknown language/dialect '{lang}'"
+        retval.append(lang)
+    return retval
 
-    this_lang = APP_CONFIG['lang_prefix']
-    return APP_CONFIG['engines'][this_lang]['choices'][0]
 
+def config_for_lang(app_config: dict, lang: str) -> dict:
+    conf = copy.deepcopy(app_config)
+    conf['lang'] = lang
+    conf['lang_prefix'] = lang.split('-')[0]
+    assert conf['engines'].get(conf['lang_prefix']), f"Cannot find matching Engine for '{lang}'"
 
-def clean_after_pdf_extract(in_text: str) -> str:
-    # Cleaning some known edge cases:
-    cleaned_txt = ''
-    txt_len = len(in_text)
-    for ci in range(txt_len):
-        c = in_text[ci]
-        if c == '\f':
-            continue
+    # The locale/voice pinned in the config file belong to its own 'lang', not to this one.
+    # Chunked mode routes every request through the shared pool, which is what bounds concurrency
+    conf['azure'] = dict(conf.get('azure') or {}, locale=None, voice_name=None, chunked=True)
 
-        if c == '\n':
-            # Skip the first line return only
-            if ci < txt_len - 1 and in_text[ci + 1] == '\n':
-                cleaned_txt += '\n'
-            elif cleaned_txt[-1] == '\n':
-                continue
-            else:
-                cleaned_txt += ' '
-            continue
+    dialect = lang.split('-', 1)[-1]
+    conf['invocation-theme-word'] = f"{app_config['invocation-theme-word']}.{dialect}"
+    conf['output_audio_fn'] = os.path.join(os.path.dirname(app_config['output_audio_fn']),
+                                           conf['invocation-theme-word'] + '.mp3')
+    return conf
 
-        cleaned_txt += c
 
-    return cleaned_txt
+def convert_langs(app_config: dict, langs: List[str], src_txt: str, concurrency: int) -> None:
+    # All languages run at the same time; their chunk requests share one bounded pool
+    configs = [config_for_lang(app_config, lang) for lang in langs]
+    failed = []
+    with ThreadPoolExecutor(max_workers=concurrency) as shared_pool:
+        def _convert_one(conf: dict) -> str:
+            eng = make_engine(what_engine_to_use(conf), conf)
+            eng.executor = shared_pool
+            with record_run(conf, eng, src_txt) as run:
+                run['ok'] = eng.convert(src_txt)
+            return conf['output_audio_fn']
+
+        with ThreadPoolExecutor(max_workers=len(configs)) as lang_pool:
+            futures = {lang_pool.submit(_convert_one, conf): conf['lang'] for conf in configs}
+            for f in as_completed(futures):
+                try:
+                    logger.info(f"[{futures[f]}] Done, output file is {f.result()}")
+                except Exception as e:
+                    logger.error(f"[{futures[f]}] FAILED: {e}")
+                    failed.append(futures[f])
+
+    if failed:
+        raise RuntimeError(f"Conversion failed for: {', '.join(failed)}")
+
+
+def _extract_html(html_doc: bytes, app_config: Optional[dict] = None) -> str:
+    import trafilatura
 
+    app_config = app_config or APP_CONFIG
 
-def extract_from_url(url: str, out_fn: str) -> str:
-    import trafilatura
+    with span('trafilatura', bytes=len(html_doc)):
+        retval = trafilatura.extract(html_doc) or ''
 
-    downloaded = trafilatura.fetch_url(url)
-    retval = trafilatura.extract(downloaded)
-    logger.info('Successfully downloaded content from URL')
+    # The python extraction package defaults to traditional; simplifying is part of the normalization pass
+    simplify = app_config['lang'].startswith('chinese')
+    normalize = app_config.get('normalize_text', True)
+    if simplify or normalize:
+        with span('normalize', chars=len(retval), simplify=simplify):
+            retval = normalize_text(retval, simplify=simplify, spacing=normalize)
+    return retval
 
-    if APP_CONFIG['lang'].startswith('chinese'):
-        # The python extraction package defaults to traditional:
-        retval = chinese_converter.to_simplified(retval)
 
-    with open(out_fn, 'w') as fout:
+def _fetch_page(fetcher: PageFetcher, ex_cache: Optional[ExtractCache], url: str, lang: str,
+                normalize: bool = True) -> dict:
+    # Conditional GET against the validators of the last run. Unchanged pages (a 304, or the same
+    # bytes when the server sends no validators) come back with the cached text already filled in
+    key = ExtractCache.make_key('url', url, lang, normalize)
+    cached_txt, meta = ex_cache.get(key) if ex_cache else (None, {})
+
+    headers = {}
+    if cached_txt is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    response = fetcher.get(url, headers=headers)
+    body_hash = hashlib.sha256(response.content).hexdigest() if response.status_code == 200 else None
+    if cached_txt is not None and (response.status_code == 304 or body_hash == meta.get('body_sha256')):
+        logger.info(f'Content at {url} is unchanged, reusing the previous extraction')
+        return {'url': url, 'key': key, 'text': cached_txt, 'next_url': meta.get('next_url')}
+
+    if response.status_code != 200:
+        raise RuntimeError(f"Download of {url} failed with HTTP {response.status_code}: {response.reason}")
+    return {
+        'url': url, 'key': key, 'html': response.content, 'next_url': find_next_page(response.content, url),
+        'meta': {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified'),
+                 'body_sha256': body_hash},
+    }
+
+
+def _extract_page(ex_cache: Optional[ExtractCache], page: dict, app_config: dict) -> str:
+    if page.get('text') is not None:
+        return page['text']
+
+    retval = _extract_html(page['html'], app_config)
+    if ex_cache:
+        ex_cache.put(page['key'], retval, dict(page['meta'], next_url=page['next_url']))
+    return retval
+
+
+def _iter_url_texts(urls: List[str], follow_next: bool, max_pages: int, workers: int, per_host: int,
+                    app_config: dict) -> Iterator[str]:
+    # The extracted text of every page, in the original order, each as soon as it and the pages before it are in
+    fetcher = PageFetcher(workers=workers, per_host=per_host)
+    ex_cache = get_extract_cache(app_config)
+    lang = app_config['lang']
+    normalize = app_config.get('normalize_text', True)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        if not follow_next:
+            futures = deque(pool.submit(lambda u: _extract_page(
+                ex_cache, _fetch_page(fetcher, ex_cache, u, lang, normalize), app_config), u) for u in urls)
+        else:
+            # The next page is only known once the current one is in, so downloads are sequential
+            # per article while the extraction of pages already downloaded runs in the background
+            futures = deque()
+            for page_url in urls:
+                seen = set()
+                while page_url and page_url not in seen and len(seen) < max_pages:
+                    seen.add(page_url)
+                    page = _fetch_page(fetcher, ex_cache, page_url, lang, normalize)
+                    futures.append(pool.submit(_extract_page, ex_cache, page, app_config))
+                    page_url = page['next_url']
+                    while futures and futures[0].done():
+                        yield futures.popleft().result()
+
+        while futures:
+            yield futures.popleft().result()
+
+
+def extract_from_url(url, out_fn: str, follow_next: bool = False, max_pages: int = 20,
+                     workers: int = 8, per_host: int = 4, app_config: Optional[dict] = None) -> str:
+    """
+    url: one URL or a list of them. With follow_next, each URL is treated as the first page of an
+    article and its rel="next" links are followed, up to max_pages pages per article.
+    Pages are downloaded over one pooled session and extracted as they arrive; the texts are
+    joined in the original order
+    """
+    app_config = app_config or APP_CONFIG
+    urls = [url] if isinstance(url, str) else list(url)
+    texts = list(_iter_url_texts(urls, follow_next, max_pages, workers, per_host, app_config))
+
+    retval = '\n\n'.join(t for t in texts if t)
+    logger.info(f'Successfully downloaded content from {len(texts)} page(s)')
+
+    with span('write_extracted_txt', chars=len(retval)), open(out_fn, 'w') as fout:
         fout.write(retval)
     logger.info(f'Saved link content to text file at {out_fn}')
 
     return retval
 
 
-def extract_from_local_pdf(in_file: str, out_fn: str) -> str:
-    from pdfminer.high_level import extract_text
+def pdf_cache_key(in_file: str, pages: Optional[str], normalize: bool, fingerprint: Optional[str] = None,
+                  strip_boilerplate: bool = True) -> str:
+    return ExtractCache.make_key('pdf', fingerprint or file_fingerprint(in_file), str(pages or ''), normalize,
+                                 strip_boilerplate)
+
+
+def finish_pdf_text(page_texts: List[str], normalize: bool, strip_boilerplate: bool = True) -> str:
+    # Page texts as pdfminer produced them, to the text that is saved and synthesized
+    with span('clean', chars=sum(len(p) for p in page_texts)) as sp:
+        if strip_boilerplate:
+            boilerplate = BoilerplateFilter()
+            retval = ''.join(iter_clean_pages(boilerplate.filter(page_texts)))
+            sp['boilerplate_chars'] = boilerplate.removed_chars
+            logger.info(boilerplate.summary())
+        else:
+            retval = ''.join(iter_clean_pages(page_texts))
+    if normalize:
+        with span('normalize', chars=len(retval)):
+            retval = normalize_text(retval)
+    return retval
 
-    raw_txt = extract_text(pdf_file=in_file)
-    # with open(out_fn + '.raw', 'w') as fout:
-    #     fout.write(raw_txt)
 
-    retval = clean_after_pdf_extract(raw_txt)
+def extract_from_local_pdf(in_file: str, out_fn: str, pages: Optional[str] = None,
+                           workers: Optional[int] = None, app_config: Optional[dict] = None) -> str:
+    app_config = app_config or APP_CONFIG
+    normalize = app_config.get('normalize_text', True)
+    strip_boilerplate = app_config.get('strip_boilerplate', True)
+    ex_cache = get_extract_cache(app_config)
+    key = pdf_cache_key(in_file, pages, normalize, strip_boilerplate=strip_boilerplate) if ex_cache else None
+    retval, _ = ex_cache.get(key) if ex_cache else (None, {})
+    if retval is not None:
+        logger.info('PDF file is unchanged, reusing the previous extraction')
+    else:
+        page_numbers = parse_page_range(pages, count_pages(in_file)) if pages else None
+        with span('pdfminer', file=in_file) as sp:
+            page_texts = list(iter_page_texts_parallel(in_file, page_numbers, workers))
+            sp['pages'] = len(page_texts)
+        retval = finish_pdf_text(page_texts, normalize, strip_boilerplate)
+        del page_texts
+        if ex_cache:
+            ex_cache.put(key, retval)
     logger.info('Successfully extracted contents from the PDF file')
 
-    with open(out_fn, 'w') as fout:
+    with span('write_extracted_txt', chars=len(retval)), open(out_fn, 'w') as fout:
         fout.write(retval)
     logger.info(f'Saved PDF content to text file at {out_fn}')
 
     return retval
 
 
+def extract_text(app_config: dict) -> str:
+    # Runs the configured text source; the extracted text is also saved to 'output_extracted_txt_fn'
+    extracted_txt_fn = app_config['output_extracted_txt_fn']
+    if app_config.get('url', None):
+        return extract_from_url(url=app_config['url'], out_fn=extracted_txt_fn,
+                                follow_next=bool(app_config.get('follow_next_page', False)),
+                                max_pages=int(app_config.get('max_pages') or 20),
+                                workers=int(app_config.get('url_workers') or 8),
+                                per_host=int(app_config.get('url_per_host') or 4),
+                                app_config=app_config)
+
+    elif app_config.get('pdf', None):
+        return extract_from_local_pdf(in_file=_parse_dir(app_config['pdf']), out_fn=extracted_txt_fn,
+                                      pages=app_config.get('pages'), workers=app_config.get('pdf_workers'),
+                                      app_config=app_config)
+
+    elif app_config.get('txt', None):
+        src_fn = app_config['txt']
+        app_config['output_extracted_txt_fn'] = src_fn
+        logger.info(f'Picked up text file from {src_fn}')
+        return Path(_parse_dir(src_fn)).read_text()
+
+    assert False, "Unknown Text Source type: " + str(app_config.get('txt'))
+
+
+def iter_extract_text(app_config: dict) -> Iterator[str]:
+    """
+    extract_text for pipeline runs: the text comes out in pieces (web pages, PDF pages, blocks of a
+    file) while the rest is still being extracted, and is saved to 'output_extracted_txt_fn' on the
+    way. PDF text is not looked up in or added to the extraction cache, which deals in whole texts
+    """
+    boilerplate = None
+    if app_config.get('url', None):
+        urls = [app_config['url']] if isinstance(app_config['url'], str) else list(app_config['url'])
+        page_texts = _iter_url_texts(urls, follow_next=bool(app_config.get('follow_next_page', False)),
+                                     max_pages=int(app_config.get('max_pages') or 20),
+                                     workers=int(app_config.get('url_workers') or 8),
+                                     per_host=int(app_config.get('url_per_host') or 4),
+                                     app_config=app_config)
+
+        def _joined() -> Iterator[str]:
+            first = True
+            for txt in page_texts:
+                if txt:
+                    yield txt if first else '\n\n' + txt
+                    first = False
+
+        texts = _joined()
+
+    elif app_config.get('pdf', None):
+        in_file = _parse_dir(app_config['pdf'])
+        pages = app_config.get('pages')
+        page_numbers = parse_page_range(pages, count_pages(in_file)) if pages else None
+        page_texts = iter_page_texts_parallel(in_file, page_numbers, app_config.get('pdf_workers'))
+        if app_config.get('strip_boilerplate', True):
+            boilerplate = BoilerplateFilter()
+            page_texts = boilerplate.filter(page_texts)
+        texts = iter_clean_pages(page_texts)
+        if app_config.get('normalize_text', True):
+            texts = iter_normalize(texts)
+
+    elif app_config.get('txt', None):
+        src_fn = app_config['txt']
+        app_config['output_extracted_txt_fn'] = src_fn
+        logger.info(f'Picked up text file from {src_fn}')
+        with open(_parse_dir(src_fn)) as fin:
+            for block in iter(lambda: fin.read(1 << 20), ''):
+                yield block
+        return
+
+    else:
+        assert False, "Unknown Text Source type: " + str(app_config.get('txt'))
+
+    out_fn = app_config['output_extracted_txt_fn']
+    chars = 0
+    with open(out_fn, 'w') as fout:
+        for txt in texts:
+            fout.write(txt)
+            chars += len(txt)
+            yield txt
+    if boilerplate is not None:
+        logger.info(boilerplate.summary())
+    logger.info(f'Saved {chars} characters of extracted text at {out_fn}')
+
+
+def _write_trace(out_fn: str):
+    TRACER.write_chrome_trace(out_fn)
+    for name, hist in TRACER.histograms().items():
+        logger.info(f"{name}: n={hist['count']} p50={hist['p50']:.3f}s p90={hist['p90']:.3f}s "
+                    f"p99={hist['p99']:.3f}s max={hist['max']:.3f}s")
+
+
 if __name__ == '__main__':
     logging.basicConfig(
         format="%(asctime)s  %(levelname)s %(message)s", level=logging.INFO
@@ -135,46 +403,125 @@ if __name__ == '__main__':
         description="Generate audio file based on input"
     )
     cli_parser.add_argument('-c', '--cfg', dest='cfg_yml', required=True)
+    cli_parser.add_argument('--langs', nargs='+', metavar='LANG',
+                            help="Generate one output per language/dialect, e.g. '四川 山东', "
+                                 "or 'all' for every voice mapping of the configured language. "
+                                 "Output goes to <theme-word>.<dialect>.mp3")
+    cli_parser.add_argument('--concurrency', type=int, default=8,
+                            help="Max number of synthesis requests in flight, shared by all --langs")
+    cli_parser.add_argument('--stdout', action='store_true',
+                            help="Stream the audio to stdout as it is synthesized, e.g. to pipe it into a player")
+    cli_parser.add_argument('--trace', metavar='OUT_JSON',
+                            help="Write per-stage timings and engine call latencies to this file, "
+                                 "in a format Chrome's trace viewer (chrome://tracing) can open")
+    cli_parser.add_argument('--resume', action='store_true',
+                            help="Continue an interrupted run: finished chunks are not synthesized again, and a "
+                                 "Polly task or Azure long audio job still running is waited for, not resubmitted")
+    cli_parser.add_argument('--submit', metavar='ADDR',
+                            help="Hand the job to a running daemon (src/daemon.py) instead of running it here, "
+                                 "e.g. http://127.0.0.1:8765 or unix:/tmp/reader.sock")
+    cli_parser.add_argument('--priority', type=int, default=0,
+                            help="With --submit: jobs with a higher priority run first")
+    cli_parser.add_argument('--pipeline', action='store_true',
+                            help="Synthesize while the text is still being extracted, holding only a window of "
+                                 "text and audio in memory (same as 'output: pipeline: True')")
+    cli_parser.add_argument('--batch', metavar='MANIFEST',
+                            help="Convert every document listed in this YAML/JSONL file, on top of the settings "
+                                 "of -c; see src/batch.py for the format")
+    cli_parser.add_argument('--plan', action='store_true',
+                            help="Extract the text, then estimate requests, billed characters, cost, synthesis time "
+                                 "and audio length for each engine, from the history of earlier runs, "
+                                 "without calling any engine")
+    cli_parser.add_argument('--preview', action='store_true',
+                            help="Synthesize a few short excerpts of the text (opening, dialogue, mixed script) for "
+                                 "a grid of speeds/pitches/voices, as labelled clips, instead of the whole document")
+    cli_parser.add_argument('--preview-speeds', nargs='+', type=float, metavar='SPEED',
+                            help="With --preview: speeds to try, by default the configured one and +/-0.1")
+    cli_parser.add_argument('--preview-pitches', nargs='+', type=float, metavar='PITCH',
+                            help="With --preview: pitches to try, by default the configured one")
+    cli_parser.add_argument('--preview-voices', nargs='+', metavar='VOICE',
+                            help="With --preview: voices to try, by default all Azure voices of the language")
+    cli_parser.add_argument('--batch-jobs', type=int, default=2,
+                            help="With --batch: number of documents synthesized at the same time")
+    cli_parser.add_argument('--extract-workers', type=int,
+                            help="With --batch: processes extracting PDF pages, the number of CPUs by default")
     cli_opts = cli_parser.parse_args()
+    if cli_opts.trace:
+        # atexit, so early sys.exit()s (inspect_extract_txt, --langs) still leave a trace behind
+        atexit.register(_write_trace, cli_opts.trace)
 
     logger.info('Program Starts')
-    APP_CONFIG = process_config(cli_opts.cfg_yml)
+    with span('config_load', file=cli_opts.cfg_yml):
+        APP_CONFIG = process_config(cli_opts.cfg_yml)
+    APP_CONFIG['resume'] = cli_opts.resume
+    if cli_opts.pipeline:
+        APP_CONFIG['output_pipeline'] = True
+    if cli_opts.stdout:
+        APP_CONFIG['output_audio_fn'] = '-'
+        APP_CONFIG['output_streaming'] = True
+
+    if cli_opts.submit:
+        from daemon import submit_job
+
+        # The daemon may run in another directory
+        for src_key in ['txt', 'pdf']:
+            if APP_CONFIG.get(src_key):
+                APP_CONFIG[src_key] = _parse_dir(APP_CONFIG[src_key])
+        state = None
+        event = {}
+        for event in submit_job(cli_opts.submit, APP_CONFIG, cli_opts.priority):
+            if event['state'] != state:
+                state = event['state']
+                logger.info(f"Job {event['id']}: {state}")
+        if state != 'done':
+            # Also when the stream ended early, e.g. with no events at all
+            logger.error(f"Job failed: {event.get('error') or f'the server stopped reporting, last state {state}'}")
+            sys.exit(1)
+        logger.info(f"Output file is {event['output_audio_fn']}, metrics: {event['metrics']}")
+        sys.exit(0)
+
+    if cli_opts.batch:
+        from batch import run_batch
 
-    out_txt = ''
+        failed = run_batch(APP_CONFIG, cli_opts.batch, extract_workers=cli_opts.extract_workers,
+                           synth_jobs=cli_opts.batch_jobs, concurrency=cli_opts.concurrency)
+        sys.exit(1 if failed else 0)
+
+    if APP_CONFIG.get('output_pipeline') and not APP_CONFIG.get('inspect_extract_txt') and not cli_opts.langs \
+            and not cli_opts.plan and not cli_opts.preview:
+        eng = make_engine(what_engine_to_use(), APP_CONFIG)
+        with span('convert_pipeline', engine=type(eng).__name__), record_run(APP_CONFIG, eng) as run:
+            run['ok'] = eng.convert_pipeline(iter_extract_text(APP_CONFIG))
+        sys.exit(0)
+
+    out_txt = extract_text(APP_CONFIG)
     extracted_txt_fn = APP_CONFIG['output_extracted_txt_fn']
-    if APP_CONFIG.get('url', None):
-        out_txt = extract_from_url(url=APP_CONFIG['url'], out_fn=extracted_txt_fn)
 
-    elif APP_CONFIG.get('pdf', None):
-        out_txt = extract_from_local_pdf(in_file=_parse_dir(APP_CONFIG['pdf']), out_fn=extracted_txt_fn)
+    if cli_opts.plan:
+        with span('plan', chars=len(out_txt)):
+            plans = plan_conversion(APP_CONFIG, out_txt, what_engine_to_use())
+        logger.info('Plan for ' + format_plan(plans, len(out_txt), what_engine_to_use()))
+        sys.exit(0)
 
-    elif APP_CONFIG.get('txt', None):
-        src_fn = APP_CONFIG['txt']
-        APP_CONFIG['output_extracted_txt_fn'] = src_fn
-        out_txt = Path(_parse_dir(src_fn)).read_text()
-        logger.info(f'Picked up text file from {src_fn}')
+    if cli_opts.preview:
+        from preview import run_preview
 
-    else:
-        assert False, "Unknown Text Source type: " + APP_CONFIG.get('txt')
+        run_preview(APP_CONFIG, out_txt, what_engine_to_use(), speeds=cli_opts.preview_speeds,
+                    pitches=cli_opts.preview_pitches, voices=cli_opts.preview_voices, concurrency=cli_opts.concurrency)
+        sys.exit(0)
 
     if APP_CONFIG.get('inspect_extract_txt', False):
         logger.info(f"\nBecause you spec-ed 'inspect_output: True', "
                     f"stopping the program so you can inspect the output file: \n{extracted_txt_fn}\n")
         sys.exit(0)
 
-    use_eng = what_engine_to_use()
-    if use_eng == 'aws':
-        logger.info(f'Using AWS engine')
-        eng = AwsPolly(APP_CONFIG)
-        eng.convert(out_txt)
-
-    elif use_eng == 'azure':
-        logger.info(f'Using Azure engine')
-        eng = AzureBob(APP_CONFIG)
-        eng.convert(out_txt)
-        # assert extracted_txt_fn and os.path.exists(
-        #     extracted_txt_fn), "To use Azure Long Audio service, you need to save the text extraction first"
-        # eng.convert_long(extracted_txt_fn)
+    if cli_opts.langs:
+        convert_langs(APP_CONFIG, resolve_langs(APP_CONFIG, cli_opts.langs), out_txt, cli_opts.concurrency)
+        sys.exit(0)
 
-    else:
-        assert False, f"Unknown Engine specification {use_eng}"
+    eng = make_engine(what_engine_to_use(), APP_CONFIG)
+    with span('convert', engine=type(eng).__name__, chars=len(out_txt)), record_run(APP_CONFIG, eng, out_txt) as run:
+        run['ok'] = eng.convert(out_txt)
+    # assert extracted_txt_fn and os.path.exists(
+    #     extracted_txt_fn), "To use Azure Long Audio service, you need to save the text extraction first"
+    # eng.convert_long(extracted_txt_fn)
@@ -0,0 +1,94 @@
+import logging
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+from typing import Iterator, List, Optional, Container
+
+from pipeline import bounded_map
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def iter_page_texts(in_file: str, page_numbers: Optional[Container[int]] = None) -> Iterator[str]:
+    """
+    Same output as pdfminer's `extract_text`, but handed out one page at a time
+    (each page text ends with the '\f' pdfminer writes after every page)
+    """
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+    from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+    from pdfminer.pdfpage import PDFPage
+
+    with open(in_file, 'rb') as fp, StringIO() as output_string:
+        rsrcmgr = PDFResourceManager(caching=True)
+        device = TextConverter(rsrcmgr, output_string, codec='utf-8', laparams=LAParams())
+        interpreter = PDFPageInterpreter(rsrcmgr, device)
+        for page in PDFPage.get_pages(fp, page_numbers, caching=True):
+            interpreter.process_page(page)
+            yield output_string.getvalue()
+            output_string.seek(0)
+            output_string.truncate(0)
+
+
+def count_pages(in_file: str) -> int:
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdfpage import PDFPage
+    from pdfminer.pdfparser import PDFParser
+
+    with open(in_file, 'rb') as fp:
+        doc = PDFDocument(PDFParser(fp))
+        return sum(1 for _ in PDFPage.create_pages(doc))
+
+
+def parse_page_range(spec, page_cnt: int) -> List[int]:
+    """
+    Turns a 1-based, inclusive page spec like '12-40', '3' or '1-5,8,10-' into 0-based page numbers
+    """
+    retval = []
+    for part in str(spec).replace(' ', '').split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        first = int(first) if first else 1
+        last = (int(last) if last else page_cnt) if '-' in part else first
+        assert 1 <= first <= last <= page_cnt, f"Page range '{part}' is outside of 1-{page_cnt}"
+        retval.extend(range(first - 1, last))
+    # pdfminer hands pages out in document order anyway
+    return sorted(set(retval))
+
+
+def extract_page_batch(in_file: str, page_numbers: List[int]) -> List[str]:
+    return list(iter_page_texts(in_file, set(page_numbers)))
+
+
+def split_page_batches(page_numbers: List[int], workers: int, min_batch: int = 4) -> List[List[int]]:
+    # A few batches per worker keeps every core busy even when some pages are much slower than others
+    batch_size = max(min_batch, math.ceil(len(page_numbers) / (workers * 4)))
+    return [page_numbers[i:i + batch_size] for i in range(0, len(page_numbers), batch_size)]
+
+
+def iter_page_texts_parallel(in_file: str, page_numbers: Optional[List[int]] = None,
+                             workers: Optional[int] = None, min_batch: int = 4) -> Iterator[str]:
+    """
+    `iter_page_texts` spread over a process pool: the pages are cut into batches, each batch is
+    extracted by its own process, and the page texts come back in the original page order.
+    Small documents are not worth the process startup and are extracted serially
+    """
+    workers = workers or os.cpu_count() or 1
+    if page_numbers is None:
+        page_numbers = list(range(count_pages(in_file)))
+
+    if workers < 2 or len(page_numbers) < 2 * min_batch:
+        yield from iter_page_texts(in_file, set(page_numbers))
+        return
+
+    batches = split_page_batches(page_numbers, workers, min_batch)
+    logger.info(f"Extracting {len(page_numbers)} pages in {len(batches)} batches with {workers} processes ...")
+    # Only a couple of batches per process run ahead of the consumer, so the text of pages nobody has
+    # asked for yet does not pile up when the consumer is slower (a pipeline run waiting on synthesis)
+    pool_size = min(workers, len(batches))
+    with ProcessPoolExecutor(max_workers=pool_size) as pool:
+        for page_texts in bounded_map(pool, extract_page_batch, ((in_file, b) for b in batches), 2 * pool_size):
+            yield from page_texts
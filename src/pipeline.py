@@ -0,0 +1,85 @@
+import logging
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, Iterable, Iterator, TypeVar
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+_DONE = object()
+
+
+class _Failed(object):
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def prefetch(items: Iterable[T], size: int, name: str = 'prefetch') -> Iterator[T]:
+    """
+    Runs the `items` generator on a thread of its own, at most `size` items ahead of the consumer.
+    Extraction and chunking keep going while the chunks before are synthesized, and stop when the
+    synthesis falls behind. An exception in the producer is raised in the consumer
+    """
+    assert size > 0, "Prefetch size must be positive"
+    out: queue.Queue = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        # Gives up once the consumer is gone, instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce():
+        try:
+            for item in items:
+                if not _put(item):
+                    return
+        except BaseException as e:
+            _put(_Failed(e))
+            return
+        _put(_DONE)
+
+    producer = threading.Thread(target=_produce, name=name, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = out.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failed):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        producer.join(timeout=1)
+
+
+def bounded_map(pool: Executor, fn: Callable[..., R], items: Iterable, window: int) -> Iterator[R]:
+    """
+    Like pool.map(fn, *zip(*items)) with each item a tuple of arguments, but it takes items only as
+    fast as results are consumed: no more than `window` are submitted and not yet handed out.
+    Executor.map submits everything up front, so results pile up in memory when the consumer
+    is slower than the pool. Results come out in order
+    """
+    assert window > 0, "Window must be positive"
+    pending = deque()
+    try:
+        for args in items:
+            pending.append(pool.submit(fn, *args))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for f in pending:
+            f.cancel()
@@ -0,0 +1,257 @@
+"""
+What a conversion is going to take, worked out before any request is sent (main.py --plan).
+
+For every engine configured for the language: the requests convert() would make, their largest
+size with the SSML wrapper, the billed characters, the expected synthesis time and the length
+of the audio. Time and length come from a model fitted to the earlier runs in the run history,
+a JSONL file each successful conversion appends to (in the 'cache:' directory, or next to the
+output audio when there is none). Prices, when given in the 'plan:' section, turn billed
+characters into a cost:
+
+    plan:
+      prices:             # per million billed characters
+        aws: 16
+        azure: 16
+"""
+import html
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Optional
+
+from audio_assemble import mp3_duration_sec
+from engine_base import VoiceEngine
+from engine_registry import make_engine
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+HISTORY_FN = 'run_history.jsonl'
+# Seconds of audio per character at speed 1.0, until an engine has recorded runs of its own
+DEFAULT_AUDIO_SEC_PER_CHAR = {'english': 1 / 15, 'chinese': 1 / 4.5}
+# The model follows an engine's latest runs only
+FIT_RUNS = 50
+
+_history_lock = threading.Lock()
+
+
+def history_path(app_config: dict) -> str:
+    cache_cfg = app_config.get('cache') or {}
+    audio_fn = app_config.get('output_audio_fn')
+    if cache_cfg.get('directory'):
+        base_dir = os.path.realpath(os.path.expanduser(cache_cfg['directory']))
+    elif audio_fn and audio_fn != '-':
+        # Not next to the extracted text: for txt sources that is the user's own file
+        base_dir = os.path.dirname(os.path.realpath(audio_fn))
+    else:
+        base_dir = os.path.dirname(os.path.realpath(app_config['output_extracted_txt_fn']))
+    return os.path.join(base_dir, HISTORY_FN)
+
+
+def load_history(app_config: dict) -> List[dict]:
+    fn = history_path(app_config)
+    if not os.path.exists(fn):
+        return []
+    runs = []
+    for line in Path(fn).read_text(encoding='utf-8').splitlines():
+        try:
+            runs.append(json.loads(line))
+        except ValueError:
+            # A line cut short by a crash
+            continue
+    return runs
+
+
+def _speed(eng: VoiceEngine) -> float:
+    return float((eng.app_config.get(eng.eng) or {}).get('speed') or 1.0)
+
+
+def _workers(eng: VoiceEngine) -> int:
+    return int(getattr(eng, 'workers', None) or 1)
+
+
+@contextmanager
+def record_run(app_config: dict, eng: VoiceEngine, src_txt: Optional[str] = None):
+    """
+    Times the conversion run in the with-block and, when it succeeds, adds it to the run history.
+    The block sets 'ok' in the yielded dict to what convert() returned; engines report some failures
+    (e.g. a Polly task timing out) that way rather than by raising. Without src_txt (pipeline runs)
+    the size comes from the engine's metrics
+    """
+    hits_before = eng.cache.stats()['hits'] if eng.cache is not None else 0
+    t0 = time.monotonic()
+    status = {'ok': None}
+    yield status
+    synth_sec = time.monotonic() - t0
+    if not status['ok']:
+        logger.info('The conversion did not succeed, not adding it to the run history')
+        return
+
+    try:
+        chars = len(src_txt) if src_txt is not None else eng.metrics.get('chars')
+        if not chars:
+            return
+        audio_sec = eng.metrics.get('audio_sec')
+        out_fn = app_config.get('output_audio_fn')
+        if audio_sec is None and out_fn and out_fn != '-' and os.path.exists(out_fn):
+            audio_sec = mp3_duration_sec(out_fn)
+        run = {
+            'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'engine': type(eng).__name__,
+            'lang': app_config['lang'],
+            'speed': _speed(eng),
+            'workers': _workers(eng),
+            'requests': eng.metrics.get('chunks') or 1,
+            'chars': chars,
+            'billed_chars': eng.request_billed_chars(src_txt) if src_txt is not None else None,
+            'synth_sec': round(synth_sec, 3),
+            'audio_sec': round(audio_sec, 3) if audio_sec else None,
+            # Runs that skipped requests tell nothing about the engine's speed
+            'cache_hits': (eng.cache.stats()['hits'] - hits_before) if eng.cache is not None else 0,
+            'resumed': bool(app_config.get('resume')),
+        }
+        fn = history_path(app_config)
+        Path(os.path.dirname(fn)).mkdir(parents=True, exist_ok=True)
+        with _history_lock, open(fn, 'a', encoding='utf-8') as fout:
+            fout.write(json.dumps(run, ensure_ascii=False) + '\n')
+    except Exception as e:
+        logger.warning(f'Could not add the run to the history for --plan: {e}')
+
+
+def _parallel(workers: int, requests: int) -> int:
+    # No requests (empty text): nothing runs in parallel
+    return max(1, min(workers, requests)) if requests else 0
+
+
+class ThroughputModel(object):
+    """
+    Fitted to the recorded runs of one engine, preferring those in the same language and of the same
+    shape (a single request, or chunks):
+
+        synth_sec = overhead_sec + sec_per_char * chars / parallel requests
+        audio_sec = audio_sec_per_char * chars / speed
+    """
+
+    def __init__(self, runs: List[dict], engine: str, lang: str, single: bool):
+        lang_prefix = lang.split('-')[0]
+
+        def _prefer(rs: List[dict], keep) -> List[dict]:
+            return [r for r in rs if keep(r)] or rs
+
+        timed = [r for r in runs if r.get('engine') == engine and r.get('chars') and r.get('synth_sec')
+                 and r.get('requests', 1) and not r.get('cache_hits') and not r.get('resumed')]
+        timed = _prefer(timed, lambda r: (r.get('requests', 1) == 1) == single)
+        timed = _prefer(timed, lambda r: r['lang'].split('-')[0] == lang_prefix)[-FIT_RUNS:]
+        self.timed_runs = len(timed)
+        self.overhead_sec, self.sec_per_char = self._fit(
+            [r['chars'] / _parallel(r.get('workers', 1), r.get('requests', 1)) for r in timed],
+            [r['synth_sec'] for r in timed])
+
+        # Voices differ too much between engines to borrow each other's speech rate
+        spoken = [r for r in runs if r.get('engine') == engine and r.get('audio_sec') and r.get('chars')
+                  and r['lang'].split('-')[0] == lang_prefix][-FIT_RUNS:]
+        self.spoken_runs = len(spoken)
+        if spoken:
+            self.audio_sec_per_char = sum(r['audio_sec'] * r.get('speed', 1.0) for r in spoken) / \
+                sum(r['chars'] for r in spoken)
+        else:
+            self.audio_sec_per_char = DEFAULT_AUDIO_SEC_PER_CHAR.get(lang_prefix, 1 / 15)
+
+    @staticmethod
+    def _fit(xs: List[float], ys: List[float]):
+        # Least squares; with too few (or too alike) runs for a line, a rate through the origin
+        if not xs:
+            return 0.0, None
+        n = len(xs)
+        mean_x, mean_y = sum(xs) / n, sum(ys) / n
+        var_x = sum((x - mean_x) ** 2 for x in xs)
+        if n >= 2 and var_x > 0:
+            slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+            intercept = mean_y - slope * mean_x
+            if slope > 0 and intercept >= 0:
+                return intercept, slope
+        return 0.0, sum(ys) / sum(xs)
+
+    def synth_sec(self, chars: int, parallel: int) -> Optional[float]:
+        if not chars or not parallel:
+            return 0.0
+        if self.sec_per_char is None:
+            return None
+        return self.overhead_sec + self.sec_per_char * chars / parallel
+
+    def audio_sec(self, chars: int, speed: float) -> float:
+        return self.audio_sec_per_char * chars / speed
+
+
+def plan_engine(name: str, eng: VoiceEngine, src_txt: str, runs: List[dict], prices: dict) -> dict:
+    requests = eng.plan_requests(src_txt)
+    parallel = _parallel(_workers(eng), len(requests))
+    model = ThroughputModel(runs, type(eng).__name__, eng.app_config['lang'], single=len(requests) == 1)
+    synth_sec = model.synth_sec(len(src_txt), parallel)
+    billed = sum(eng.request_billed_chars(r) for r in requests)
+    price = prices.get(name)
+    return {
+        'engine': name,
+        'requests': len(requests),
+        'largest_request_bytes': max((len(eng._build_ssml(html.escape(r)).encode('utf-8')) for r in requests), default=0),
+        'billed_chars': billed,
+        'parallel': parallel,
+        'synth_sec': synth_sec,
+        'timed_runs': model.timed_runs,
+        'audio_sec': model.audio_sec(len(src_txt), _speed(eng)),
+        'spoken_runs': model.spoken_runs,
+        'cost': billed / 1e6 * float(price) if price is not None else None,
+        'warnings': eng.plan_warnings(src_txt, requests, synth_sec),
+    }
+
+
+def _hms(sec: Optional[float]) -> str:
+    if sec is None:
+        return '?'
+    sec = int(round(sec))
+    return f'{sec // 3600}h{sec // 60 % 60:02d}m' if sec >= 3600 else f'{sec // 60}m{sec % 60:02d}s'
+
+
+def plan_conversion(app_config: dict, src_txt: str, chosen: str) -> List[dict]:
+    """
+    Plans the text on the chosen engine and on the other engines configured for the language. The
+    engines are built (clients and all) but send nothing
+    """
+    runs = load_history(app_config)
+    prices = (app_config.get('plan') or {}).get('prices') or {}
+    lang_engines = app_config['engines'].get(app_config['lang_prefix'])
+    choices = lang_engines.get('choices') or [] if isinstance(lang_engines, dict) else []
+    plans = []
+    for name in dict.fromkeys([chosen] + list(choices)):
+        try:
+            eng = make_engine(name, app_config)
+            plans.append(plan_engine(name, eng, src_txt, runs, prices))
+        except Exception as e:
+            plans.append({'engine': name, 'error': f'{type(e).__name__}: {e}'})
+    return plans
+
+
+def format_plan(plans: List[dict], chars: int, chosen: str) -> str:
+    lines = [f"{chars} characters; nothing has been sent to any engine",
+             f"  {'engine':<10} {'requests':>8} {'largest':>9} {'billed chars':>12} {'cost':>8} "
+             f"{'synthesis':>10} {'audio':>8}  based on"]
+    for p in plans:
+        mark = '*' if p['engine'] == chosen else ' '
+        if p.get('error'):
+            lines.append(f"{mark} {p['engine']:<10} cannot plan: {p['error']}")
+            continue
+        basis = (f"{p['timed_runs']} timed runs" if p['timed_runs'] else 'no timed runs') + ', ' + \
+            (f"speech rate of {p['spoken_runs']} runs" if p['spoken_runs'] else 'default speech rate')
+        cost = f"{p['cost']:.2f}" if p['cost'] is not None else '-'
+        lines.append(f"{mark} {p['engine']:<10} {p['requests']:>8} {p['largest_request_bytes']:>8}B "
+                     f"{p['billed_chars']:>12} {cost:>8} {_hms(p['synth_sec']):>10} {_hms(p['audio_sec']):>8}  "
+                     f"{basis}, {p['parallel']} in parallel")
+    for p in plans:
+        for warning in p.get('warnings') or []:
+            lines.append(f"! {p['engine']}: {warning}")
+    return '\n'.join(lines)
@@ -0,0 +1,150 @@
+"""
+Voice tuning without converting the whole document (main.py --preview).
+
+A few short excerpts are picked from the extracted text (the opening, a dialogue passage, a passage
+mixing Latin and CJK script) and synthesized for every combination of the speeds, pitches and
+voices asked for, all at once. The clips go to <output directory>/<theme-word>.preview/, named
+after the excerpt and settings, with a playlist that plays them in order:
+
+    python src/main.py -c my.yml --preview [--preview-speeds 0.85 0.93 1.0] [--preview-pitches 1.0 1.05]
+                                           [--preview-voices zh-CN-YunfengNeural ...]
+
+Without --preview-voices, Azure tries every voice it has for the language (AzureBob.locale_mapping),
+other engines keep their configured voice. Through the segment cache, clips already made are reused
+"""
+import copy
+import itertools
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from engine_registry import load_engine_class
+from text_chunk import split_text
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Characters of text per excerpt, about 20 seconds of speech in English
+EXCERPT_CHARS = 300
+# Where each engine takes its voice from, in its config section
+VOICE_KEYS = {'aws': 'voice_id', 'azure': 'voice_name', 'gcp': 'voice_name'}
+
+_QUOTES = re.compile('[“”「」『』"]')
+_HAN = re.compile('[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]')
+_LATIN_WORD = re.compile('[A-Za-z]{2,}')
+
+
+def _excerpt(paragraph: str, max_chars: int) -> str:
+    # Whole sentences from the start of the paragraph, as many as fit
+    excerpt = ''
+    for piece in split_text(paragraph.strip(), max_chars, measure=len):
+        if excerpt and len(excerpt) + len(piece) > max_chars:
+            break
+        excerpt += piece
+    return excerpt.strip()
+
+
+def pick_excerpts(src_txt: str, max_chars: int = EXCERPT_CHARS) -> List[Tuple[str, str]]:
+    """
+    (label, text) of the excerpts to preview: the opening, the paragraph with the most quoted speech
+    and the one mixing Han characters and Latin words the most. Passages the text does not have are
+    left out. One pass over the paragraphs
+    """
+    opening = dialogue = mixed = None
+    dialogue_score = mixed_score = 0
+    for paragraph in src_txt.split('\n'):
+        if len(paragraph.strip()) < 20:
+            # Headings, page numbers, stray lines
+            continue
+        if opening is None:
+            opening = paragraph
+        quotes = len(_QUOTES.findall(paragraph))
+        if quotes >= 2 and quotes > dialogue_score:
+            dialogue, dialogue_score = paragraph, quotes
+        if _HAN.search(paragraph):
+            score = min(len(_HAN.findall(paragraph)), len(_LATIN_WORD.findall(paragraph)))
+            if score > mixed_score:
+                mixed, mixed_score = paragraph, score
+
+    excerpts = []
+    for label, paragraph in [('opening', opening), ('dialogue', dialogue), ('mixed', mixed)]:
+        if paragraph is not None and paragraph not in [p for _, _, p in excerpts]:
+            excerpts.append((label, _excerpt(paragraph, max_chars), paragraph))
+    return [(label, text) for label, text, _ in excerpts]
+
+
+def voice_choices(app_config: dict, use_eng: str) -> List[Optional[str]]:
+    if use_eng == 'azure':
+        return list(load_engine_class('azure').locale_mapping[app_config['lang']][1])
+    key = VOICE_KEYS.get(use_eng)
+    return [(app_config.get(use_eng) or {}).get(key) if key else None]
+
+
+def _around(value: float) -> List[float]:
+    return [round(value - 0.1, 2), value, round(value + 0.1, 2)]
+
+
+def _label(excerpt: str, voice: Optional[str], speed: float, pitch: float) -> str:
+    return f"{excerpt}.{voice or 'default'}.speed{speed:.2f}.pitch{pitch:.2f}"
+
+
+def run_preview(app_config: dict, src_txt: str, use_eng: str, speeds: Optional[List[float]] = None,
+                pitches: Optional[List[float]] = None, voices: Optional[List[str]] = None,
+                concurrency: int = 8) -> str:
+    """
+    Synthesizes every excerpt for every speed/pitch/voice combination. Returns the clip directory
+    """
+    assert use_eng != 'shard', "Preview one engine at a time: set 'engines/invocation'"
+    eng_cfg = app_config.get(use_eng) or {}
+    speeds = speeds or _around(float(eng_cfg.get('speed') or 1.0))
+    pitches = pitches or [float(eng_cfg.get('pitch') or 1.0)]
+    voices = voices or voice_choices(app_config, use_eng)
+    excerpts = pick_excerpts(src_txt)
+    assert excerpts, "No text long enough to preview"
+
+    out_dir = os.path.join(os.path.dirname(app_config['output_audio_fn']),
+                           app_config['invocation-theme-word'] + '.preview')
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    with open(os.path.join(out_dir, 'excerpts.txt'), 'w') as fout:
+        fout.write(''.join(f'[{label}]\n{text}\n\n' for label, text in excerpts))
+
+    # One engine per setting combination: the voice, rate and pitch are fixed when it is built
+    engines = []
+    for voice, speed, pitch in itertools.product(voices, speeds, pitches):
+        conf = copy.deepcopy(app_config)
+        conf[use_eng] = dict(conf.get(use_eng) or {}, speed=speed, pitch=pitch)
+        if voice and VOICE_KEYS.get(use_eng):
+            conf[use_eng][VOICE_KEYS[use_eng]] = voice
+        conf['output_audio_fn'] = os.path.join(out_dir, 'clip.mp3')
+        # Built directly, not through make_engine: previews need real-time requests, never Azure's long audio API
+        engines.append(((voice, speed, pitch), load_engine_class(use_eng)(conf)))
+    # The clips take the extension of the engine's output (e.g. .ogg)
+    ext = os.path.splitext(engines[0][1].app_config['output_audio_fn'])[1]
+
+    logger.info(f'Previewing {len(excerpts)} excerpts x {len(voices)} voices x {len(speeds)} speeds x '
+                f'{len(pitches)} pitches = {len(excerpts) * len(engines)} clips')
+
+    def _clip(job) -> str:
+        (label, text), ((voice, speed, pitch), eng) = job
+        clip_fn = os.path.join(out_dir, _label(label, voice, speed, pitch) + ext)
+        audio = eng._cached(eng._synthesize_chunk)(text)
+        with open(clip_fn + '.part', 'wb') as fout:
+            fout.write(audio)
+        os.replace(clip_fn + '.part', clip_fn)
+        return clip_fn
+
+    jobs = list(itertools.product(excerpts, engines))
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        clip_fns = list(pool.map(_clip, jobs))
+
+    # Grouped by excerpt, so the settings can be compared on the same words
+    with open(os.path.join(out_dir, 'preview.m3u'), 'w') as fout:
+        fout.write('#EXTM3U\n')
+        for clip_fn in clip_fns:
+            name = os.path.basename(clip_fn)
+            fout.write(f'#EXTINF:-1,{os.path.splitext(name)[0]}\n{name}\n')
+    logger.info(f'{len(clip_fns)} clips and a playlist (preview.m3u) in {out_dir}')
+    return out_dir
@@ -0,0 +1,137 @@
+import logging
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, TypeVar
+
+from instrument import TRACER
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+T = TypeVar('T')
+
+
+class TransientError(RuntimeError):
+    """
+    A failure worth trying again: throttling (HTTP 429, ThrottlingException), a 5xx, a dropped
+    connection. retry_after: seconds the service asked us to wait, if it said
+    """
+
+    def __init__(self, msg: str, retry_after: Optional[float] = None):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # Only the delay-seconds form; services use it for throttling
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        return None
+
+
+class TokenBucket(object):
+    """
+    `rate` tokens per second, up to `burst` saved up. A caller asking for more than is available
+    takes the bucket into debt and sleeps it off, so large requests are not starved by small ones
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        assert rate > 0, "Token bucket rate must be positive"
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RateLimiter(object):
+    """
+    Request and character budgets of one engine, shared by every thread (and every engine instance)
+    of the process, plus its retry policy: jittered exponential backoff, or the service's Retry-After.
+    A throttled call also holds back everyone else until the wait is over
+    """
+
+    def __init__(self, name: str, requests_per_sec: Optional[float] = None, chars_per_sec: Optional[float] = None,
+                 max_retries: int = 5, retry_base_sec: float = 0.5, retry_max_sec: float = 30):
+        self.name = name
+        self.requests = TokenBucket(requests_per_sec) if requests_per_sec else None
+        self.chars = TokenBucket(chars_per_sec) if chars_per_sec else None
+        self.max_retries = max_retries
+        self.retry_base_sec = retry_base_sec
+        self.retry_max_sec = retry_max_sec
+        self.retries = 0
+        self._hold_until = 0.0
+        self._lock = threading.Lock()
+
+    def _wait_for_slot(self, chars: int):
+        with self._lock:
+            hold = self._hold_until - time.monotonic()
+        if hold > 0:
+            time.sleep(hold)
+        if self.requests:
+            self.requests.acquire()
+        if self.chars and chars:
+            self.chars.acquire(chars)
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.retry_max_sec)
+        # "Full jitter": uniformly random up to the exponential ceiling, so throttled threads spread out
+        return random.uniform(0, min(self.retry_max_sec, self.retry_base_sec * 2 ** attempt))
+
+    def call(self, fn: Callable[[], T], chars: int = 0, what: str = '') -> T:
+        """
+        Runs fn once its budget allows, trying again on TransientError (and plain connection
+        errors / timeouts). chars: billed characters of the request, 0 for polls and downloads
+        """
+        attempt = 0
+        while True:
+            self._wait_for_slot(chars)
+            try:
+                return fn()
+            except (TransientError, ConnectionError, TimeoutError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, getattr(e, 'retry_after', None))
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                    self._hold_until = max(self._hold_until, time.monotonic() + delay)
+                    retries = self.retries
+                TRACER.counter(f'{self.name}.retries', value=retries)
+                reason = (str(e).splitlines() or [type(e).__name__])[0]
+                logger.warning(f"{what or self.name} failed ({reason}), retry {attempt}/{self.max_retries} "
+                               f"in {delay:.1f}s")
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(app_config: dict, eng: str) -> RateLimiter:
+    # One per engine and process, so concurrent conversions (--langs, the daemon) share the quota.
+    # The first configuration seen sets the budgets
+    eng_cfg = app_config.get(eng) or {}
+    with _limiters_lock:
+        if eng not in _limiters:
+            _limiters[eng] = RateLimiter(
+                eng,
+                requests_per_sec=float(eng_cfg.get('requests_per_sec') or 0) or None,
+                chars_per_sec=float(eng_cfg.get('chars_per_sec') or 0) or None,
+                max_retries=int(eng_cfg.get('max_retries') if eng_cfg.get('max_retries') is not None else 5),
+                retry_base_sec=float(eng_cfg.get('retry_base_sec') or 0.5),
+                retry_max_sec=float(eng_cfg.get('retry_max_sec') or 30),
+            )
+        return _limiters[eng]
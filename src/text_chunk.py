@@ -0,0 +1,161 @@
+import html
+import re
+import zlib
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+# One sentence: the shortest run of text up to a CJK/western terminator (plus any closing quotes),
+# a full stop followed by white space, a line break, or the end of the text. Trailing white space
+# (including paragraph breaks) stays with the sentence it follows
+_SENTENCE = re.compile(
+    r'.*?(?:[。！？!?；;…]+[”’」』）)\]"\']*|\.+[”’)\]"\']*(?=\s)|(?=\n)|\Z)\s*',
+    re.S,
+)
+
+# The end of a sentence that the next text may still change: a terminator that closing quotes or
+# white space may follow, or full stops waiting for white space
+_SENTENCE_TAIL = re.compile(r'(?:[。！？!?；;…]+[”’」』）)\]"\']*|\.+[”’)\]"\']*)?\s*\Z')
+
+# Fallback for sentences too long for one request: break after clause punctuation or white space
+_CLAUSE = re.compile(r'.*?(?:[，,、：:—]+|\s+|\Z)', re.S)
+
+
+def escaped_utf8_len(txt: str) -> int:
+    # Size of the text once it is html-escaped into an SSML document
+    return len(html.escape(txt).encode('utf-8'))
+
+
+def escaped_len(txt: str) -> int:
+    return len(html.escape(txt))
+
+
+def _hard_split(txt: str, limit: int, measure: Callable[[str], int]) -> Iterator[str]:
+    # html.escape works char by char, so sizes add up and the walk stays linear
+    start = 0
+    size = 0
+    for ci, c in enumerate(txt):
+        c_size = measure(c)
+        if ci > start and size + c_size > limit:
+            yield txt[start:ci]
+            start, size = ci, 0
+        size += c_size
+    if start < len(txt):
+        yield txt[start:]
+
+
+def _split_oversized(sentence: str, limit: int, measure: Callable[[str], int]) -> Iterator[str]:
+    for clause in _CLAUSE.findall(sentence):
+        if not clause:
+            continue
+        if measure(clause) > limit:
+            yield from _hard_split(clause, limit, measure)
+        else:
+            yield clause
+
+
+def _final_head(sentence: str, limit: int, measure: Callable[[str], int]) -> int:
+    # Length of the start of an unfinished sentence that _split_oversized cuts the same way however
+    # the sentence goes on: its pieces but the last one (that one may still grow), and none of the
+    # tail that decides where the sentence ends. 0 if there is no such start
+    tail = _SENTENCE_TAIL.search(sentence).start()
+    head = 0
+    for piece in list(_split_oversized(sentence, limit, measure))[:-1]:
+        if head + len(piece) > tail:
+            break
+        head += len(piece)
+    return head
+
+
+def _iter_sentences(texts: Iterable[str], hold_limit: int, limit: int,
+                    measure: Callable[[str], int]) -> Iterator[Tuple[str, bool]]:
+    # The sentences of the concatenated texts, same as _SENTENCE.findall on the whole text, as
+    # (sentence, True). The last sentence of what has arrived may still grow, so it waits for the
+    # next text. Once it is longer than hold_limit and too long for one chunk, its start goes out
+    # as (part, False), cut where _split_oversized would cut the whole sentence
+    pending = ''
+    for txt in texts:
+        if not txt:
+            continue
+        buf = pending + txt if pending else txt
+        last = None
+        for m in _SENTENCE.finditer(buf):
+            if not m.group():
+                continue
+            if last is not None:
+                yield last.group(), True
+            last = m
+        if last is None:
+            pending = buf
+            continue
+        pending = buf[last.start():]
+        if len(pending) > hold_limit and measure(pending) > limit:
+            # Matching the rest from the cut on finds the same end: the cut is before the tail
+            head = _final_head(pending, limit, measure)
+            if head:
+                yield pending[:head], False
+                pending = pending[head:]
+    for m in _SENTENCE.finditer(pending):
+        if m.group():
+            yield m.group(), True
+
+
+def iter_chunks_from(texts: Iterable[str], limit: int,
+                     measure: Callable[[str], int] = escaped_utf8_len) -> Iterator[str]:
+    """
+    iter_chunks over text that arrives in parts (pages, blocks of a file): a chunk goes out as
+    soon as it is complete, and only the sentence in progress is held. The chunks are the same as
+    those of the joined text
+    """
+    assert limit > 0, f"Chunk size limit must be positive, got {limit}"
+
+    parts = []
+    size = 0
+    # Of the sentence so far, which may come in parts: its hash, and whether it did
+    sentence_crc = 0
+    in_parts = False
+    for sentence, done in _iter_sentences(texts, max(4 * limit, 1 << 16), limit, measure):
+        sentence_crc = zlib.crc32(sentence.encode('utf-8'), sentence_crc)
+        s_size = measure(sentence)
+        pieces = [(sentence, s_size)] if s_size <= limit and done and not in_parts else \
+            [(p, measure(p)) for p in _split_oversized(sentence, limit, measure)]
+
+        for piece, p_size in pieces:
+            if parts and size + p_size > limit:
+                chunk = ''.join(parts)
+                if chunk.strip():
+                    yield chunk
+                parts, size = [], 0
+            parts.append(piece)
+            size += p_size
+
+        if not done:
+            in_parts = True
+            continue
+        if size >= limit // 4 and (sentence.endswith('\n') or sentence_crc & 7 == 0):
+            chunk = ''.join(parts)
+            if chunk.strip():
+                yield chunk
+            parts, size = [], 0
+        sentence_crc = 0
+        in_parts = False
+
+    chunk = ''.join(parts)
+    if chunk.strip():
+        yield chunk
+
+
+def iter_chunks(src_txt: str, limit: int, measure: Callable[[str], int] = escaped_utf8_len) -> Iterator[str]:
+    """
+    Packs whole sentences into chunks whose `measure` (by default: UTF-8 bytes after html.escape)
+    stays within `limit`. Only a sentence that cannot fit on its own is cut at clause boundaries,
+    and only a clause that cannot fit is cut between characters.
+
+    Once a chunk is a quarter full it is also closed after any "anchor" sentence: one that ends a
+    paragraph, or whose hash happens to be 0 mod 8. Anchors depend only on the sentence itself,
+    so an edit moves the boundaries of the chunks around it only, and cached audio for the rest
+    of the document stays valid
+    """
+    return iter_chunks_from([src_txt], limit, measure)
+
+
+def split_text(src_txt: str, limit: int, measure: Callable[[str], int] = escaped_utf8_len) -> List[str]:
+    return list(iter_chunks(src_txt, limit, measure))
@@ -0,0 +1,267 @@
+import math
+import re
+from collections import Counter, deque
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+# Bump whenever a change to the rules below (or anything else that shapes the extracted text)
+# changes the output, so cached extractions are not reused
+CLEAN_RULES_VERSION = 2
+
+# A maximal run of line breaks and form feeds. Everything outside such runs is copied verbatim,
+# so the cleaning rules only ever need to look at one run at a time.
+_BREAK_RUN = re.compile(r'[\n\f]+')
+_BREAK_CHARS = '\n\f'
+
+
+@lru_cache(maxsize=4096)
+def _fold_break_run(run: str) -> str:
+    # Same rules as the original char-by-char loop, applied to one run:
+    # - '\f' is dropped
+    # - a '\n' followed by another '\n' is kept
+    # - any other '\n' becomes a space, unless the last emitted char is already a '\n'
+    # The char before a run is never a line break, so the state always starts as "not a '\n'"
+    out = []
+    last_is_nl = False
+    run_len = len(run)
+    for ci in range(run_len):
+        if run[ci] != '\n':
+            continue
+        if ci < run_len - 1 and run[ci + 1] == '\n':
+            out.append('\n')
+            last_is_nl = True
+        elif not last_is_nl:
+            out.append(' ')
+    return ''.join(out)
+
+
+def _fold_match(m: re.Match) -> str:
+    return _fold_break_run(m.group())
+
+
+def clean_after_pdf_extract(in_text: str) -> str:
+    return _BREAK_RUN.sub(_fold_match, in_text)
+
+
+def iter_clean_pages(pages: Iterable[str]) -> Iterator[str]:
+    """
+    Streaming version of `clean_after_pdf_extract`: takes page texts (e.g. from pdfminer) and yields
+    cleaned text. A run of line breaks that straddles a page boundary is held back until the next
+    page arrives, so the joined output is identical to cleaning the whole text in one go
+    """
+    pending = ''
+    for page in pages:
+        text = pending + page if pending else page
+        body = text.rstrip(_BREAK_CHARS)
+        pending = text[len(body):]
+        if body:
+            yield _BREAK_RUN.sub(_fold_match, body)
+
+    if pending:
+        yield _fold_break_run(pending)
+
+
+# Line fingerprints ignore case, spacing and numbers: "Page 212 — Journal of X" and "Page 213 — Journal of X"
+# are the same line, and so are page numbers in digits or (a line of nothing else) roman numerals
+_DIGITS = re.compile(r'\d+')
+_ROMAN_LINE = re.compile(r'[ivxlcdm]+')
+
+
+def _line_fingerprint(line: str) -> int:
+    key = _DIGITS.sub('#', ' '.join(line.lower().split()))
+    return hash('#' if _ROMAN_LINE.fullmatch(key) else key)
+
+
+class BoilerplateFilter(object):
+    """
+    Drops running headers and footers, page numbers and copyright lines from page texts (pdfminer's,
+    before clean_after_pdf_extract), so they are not read out, and paid for, on every page.
+
+    Only the first and last `edge_lines` non-blank lines of a page are candidates, and only short
+    ones. A candidate goes when its fingerprint is among the candidates of at least `min_share` of
+    the pages within `radius` pages of it (and of `min_pages` pages at least). That takes a header on
+    every page, alternating left and right page headers, and a chapter title running over the pages
+    of its chapter, but not a chapter heading that comes once per chapter.
+
+    Pages come out `radius` pages after they go in, and each line is looked at a fixed number of
+    times, so memory is bounded and time linear in the length of the document
+    """
+
+    def __init__(self, radius: int = 6, edge_lines: int = 3, min_share: float = 0.4, min_pages: int = 3,
+                 max_line_chars: int = 120):
+        self.radius = radius
+        self.edge_lines = edge_lines
+        self.min_share = min_share
+        self.min_pages = min_pages
+        self.max_line_chars = max_line_chars
+        self.pages = 0
+        self.total_chars = 0
+        self.removed_lines = 0
+        self.removed_chars = 0
+        # A few of the lines removed, for the log
+        self.samples: List[str] = []
+
+    def _candidates(self, lines: List[str]) -> Dict[int, int]:
+        # Line index -> fingerprint
+        nonblank = [i for i, line in enumerate(lines) if line.strip()]
+        edges = set(nonblank[:self.edge_lines] + nonblank[-self.edge_lines:])
+        return {i: _line_fingerprint(lines[i]) for i in edges if len(lines[i]) <= self.max_line_chars}
+
+    def _strip(self, page: Tuple[List[str], Dict[int, int]], counts: Counter, window_pages: int) -> str:
+        lines, candidates = page
+        need = max(self.min_pages, math.ceil(self.min_share * window_pages))
+        self.pages += 1
+        self.total_chars += sum(len(line) for line in lines) + len(lines) - 1
+        drop = [i for i, fp in candidates.items() if counts[fp] >= need]
+        if not drop:
+            return '\n'.join(lines)
+        for i in drop:
+            self.removed_lines += 1
+            self.removed_chars += len(lines[i]) + 1
+            if len(self.samples) < 5 and lines[i].strip() not in self.samples:
+                self.samples.append(lines[i].strip())
+            lines[i] = None
+        return '\n'.join(line for line in lines if line is not None)
+
+    def filter(self, pages: Iterable[str]) -> Iterator[str]:
+        # The pages around the next one out, and on how many of them each fingerprint is a candidate
+        window = deque()
+        counts = Counter()
+        out = 0
+        for page in pages:
+            lines = page.split('\n')
+            candidates = self._candidates(lines)
+            counts.update(set(candidates.values()))
+            window.append((lines, candidates))
+            while out + self.radius < len(window):
+                yield self._strip(window[out], counts, len(window))
+                out = self._slide(window, counts, out + 1)
+        while out < len(window):
+            yield self._strip(window[out], counts, len(window))
+            out = self._slide(window, counts, out + 1)
+
+    def _slide(self, window: deque, counts: Counter, out: int) -> int:
+        # Forgets the page that fell more than `radius` pages behind the next one out
+        if out <= self.radius:
+            return out
+        _, old = window.popleft()
+        for fp in set(old.values()):
+            counts[fp] -= 1
+            if not counts[fp]:
+                del counts[fp]
+        return out - 1
+
+    def summary(self) -> str:
+        share = 100 * self.removed_chars / self.total_chars if self.total_chars else 0
+        samples = '; '.join(f"'{s}'" for s in self.samples)
+        return f"Removed {self.removed_lines} repeated header/footer lines from {self.pages} pages, " \
+               f"{self.removed_chars} characters ({share:.1f}% of the text)" + (f", e.g. {samples}" if samples else '')
+
+
+# Character classes of the normalization pass, by code point (BMP; CJK beyond it is handled in _char_class)
+_OTHER, _HAN, _CJK_PUNCT, _LATIN, _BREAK, _SHARED_PUNCT = range(6)
+# Punctuation Chinese and English text share; a space next to it only goes when Han is on the other side
+_SHARED_PUNCT_CHARS = '\u2014\u2018\u2019\u201c\u201d\u2026\u00b7'
+_HAN_RANGES = [(0x3040, 0x30FF), (0x31F0, 0x31FF), (0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0xF900, 0xFAFF)]
+_CJK_PUNCT_RANGES = [(0x3000, 0x303F), (0xFF01, 0xFF0F), (0xFF1A, 0xFF20), (0xFF3B, 0xFF40), (0xFF5B, 0xFF65)]
+
+
+def _build_class_table() -> bytearray:
+    table = bytearray(0x10000)
+    for ranges, cls in [(_HAN_RANGES, _HAN), (_CJK_PUNCT_RANGES, _CJK_PUNCT)]:
+        for lo, hi in ranges:
+            table[lo:hi + 1] = bytes([cls]) * (hi - lo + 1)
+    for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz':
+        table[ord(c)] = _LATIN
+    for c in _SHARED_PUNCT_CHARS:
+        table[ord(c)] = _SHARED_PUNCT
+    table[ord('\n')] = _BREAK
+    return table
+
+
+_CLASS = _build_class_table()
+
+
+def _char_class(c: str) -> int:
+    o = ord(c)
+    if o < 0x10000:
+        return _CLASS[o]
+    # CJK Unified Ideographs extensions B and up
+    return _HAN if 0x20000 <= o < 0x32000 else _OTHER
+
+
+def _ranges_re(ranges) -> str:
+    return ''.join(f'\\u{lo:04x}-\\u{hi:04x}' for lo, hi in ranges)
+
+
+# A run of spaces, or a Han/Latin letter boundary with no space in it. Every match is looked at
+# (and replaced) once, from left to right, so the pass stays linear
+_NORMALIZE = re.compile(
+    rf' +|(?<=[{_ranges_re(_HAN_RANGES)}])(?=[A-Za-z])|(?<=[A-Za-z])(?=[{_ranges_re(_HAN_RANGES)}])'
+)
+
+
+@lru_cache(maxsize=4)
+def _normalize_table(simplify: bool, fold: bool) -> Dict[int, int]:
+    # With fold, full-width letters and digits to ASCII and odd spaces to ' '. With simplify, traditional
+    # to simplified Chinese (chinese_converter's own table, so it matches to_simplified exactly)
+    table = {}
+    if fold:
+        table.update({o: o - 0xFEE0 for o in range(0xFF10, 0xFF1A)})
+        table.update({o: o - 0xFEE0 for o in list(range(0xFF21, 0xFF3B)) + list(range(0xFF41, 0xFF5B))})
+        table.update({ord(c): ord(' ') for c in '\t\u00a0\u2002\u2003\u2009\u3000'})
+    if simplify:
+        from chinese_converter import trad_to_simp
+
+        table.update(trad_to_simp)
+    return table
+
+
+def _normalize_match(m: re.Match) -> str:
+    start, end = m.span()
+    if start == end:
+        # Han next to a Latin letter
+        return ' '
+    txt = m.string
+    before = _char_class(txt[start - 1]) if start else _BREAK
+    after = _char_class(txt[end]) if end < len(txt) else _BREAK
+    # Dropped at line starts and ends, next to full-width punctuation, and between Han characters
+    # (or Han and shared punctuation such as curly quotes)
+    if before in (_BREAK, _CJK_PUNCT) or after in (_BREAK, _CJK_PUNCT) \
+            or (before == _HAN and after in (_HAN, _SHARED_PUNCT)) or (after == _HAN and before == _SHARED_PUNCT):
+        return ''
+    return ' '
+
+
+def normalize_text(in_text: str, simplify: bool = False, spacing: bool = True) -> str:
+    """
+    Does the hand edits the extracted text used to need before synthesis, where every stray space
+    or line break is an audible pause: spaces between Chinese characters and next to full-width
+    punctuation are dropped, English words inside Chinese text get a space on each side, runs of
+    spaces shrink to one, and full-width letters and digits become ASCII. With simplify, traditional
+    characters become simplified in the same pass. spacing=False does nothing but that
+    """
+    txt = in_text.translate(_normalize_table(simplify, spacing))
+    if not spacing:
+        return txt
+    return _NORMALIZE.sub(_normalize_match, txt)
+
+
+def iter_normalize(texts: Iterable[str], simplify: bool = False, spacing: bool = True,
+                   hold_limit: int = 1 << 20) -> Iterator[str]:
+    """
+    Streaming version of `normalize_text`. None of its rules look across a line break, so text is
+    passed on up to the last '\n' that has arrived and the rest waits for the next piece (or, past
+    hold_limit, goes out as it is)
+    """
+    pending = ''
+    for txt in texts:
+        buf = pending + txt if pending else txt
+        cut = buf.rfind('\n') + 1
+        if cut == 0 and len(buf) > hold_limit:
+            cut = len(buf)
+        if cut:
+            yield normalize_text(buf[:cut], simplify, spacing)
+        pending = buf[cut:]
+    if pending:
+        yield normalize_text(pending, simplify, spacing)
@@ -0,0 +1,70 @@
+import logging
+import threading
+from html.parser import HTMLParser
+from typing import Dict, Optional
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from instrument import span
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class PageFetcher(object):
+    """
+    One pooled, keep-alive `requests.Session` for all downloads of a run, with retries
+    (exponential backoff, honouring Retry-After) and a cap on parallel requests per host
+    """
+
+    def __init__(self, workers: int = 8, per_host: int = 4, timeout: tuple = (10, 60)):
+        self.timeout = timeout
+        self.per_host = per_host
+        self._host_slots: Dict[str, threading.Semaphore] = {}
+        self._lock = threading.Lock()
+
+        retry = Retry(total=4, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=['GET', 'HEAD'], respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _slots(self, url: str) -> threading.Semaphore:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.Semaphore(self.per_host)
+            return self._host_slots[host]
+
+    def get(self, url: str, headers: Optional[dict] = None) -> requests.Response:
+        with self._slots(url), span('http_get', cat='net', url=url) as sp:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            sp['http_status'] = response.status_code
+            sp['bytes'] = len(response.content)
+            retries = getattr(response.raw, 'retries', None)
+            sp['retries'] = len(retries.history) if retries else 0
+            return response
+
+
+class _NextLinkParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.next_href = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.next_href or tag not in ['a', 'link']:
+            return
+        attrs = dict(attrs)
+        if 'next' in (attrs.get('rel') or '').lower().split() and attrs.get('href'):
+            self.next_href = attrs['href']
+
+
+def find_next_page(html_doc: bytes, base_url: str) -> Optional[str]:
+    # Paginated articles announce the following page with <link rel="next"> or <a rel="next">
+    parser = _NextLinkParser()
+    parser.feed(html_doc.decode('utf-8', errors='replace'))
+    return urljoin(base_url, parser.next_href) if parser.next_href else None
@@ -0,0 +1,79 @@
+"""
+A local HTTP server standing in for a cloud speech service. The test hands it a function that
+answers each request, and reads back the requests it received (with the client port, to tell
+whether a connection was reused)
+"""
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+SRC_DIR = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+Reply = Tuple[int, Dict[str, str], Union[bytes, str, dict, list]]
+
+
+class Request(object):
+    def __init__(self, handler: BaseHTTPRequestHandler, body: bytes):
+        parts = urlsplit(handler.path)
+        self.method = handler.command
+        self.path = parts.path
+        self.query = parse_qs(parts.query)
+        self.headers = dict(handler.headers.items())
+        self.body = body
+        self.client_port = handler.client_address[1]
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class StandIn(object):
+    def __init__(self, answer: Callable[[Request], Reply]):
+        self.answer = answer
+        self.requests: List[Request] = []
+        self._lock = threading.Lock()
+        stand_in = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            # Keep-alive, as the real services do
+            protocol_version = 'HTTP/1.1'
+
+            def _serve(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                req = Request(self, body)
+                with stand_in._lock:
+                    stand_in.requests.append(req)
+                status, headers, payload = stand_in.answer(req)
+                if isinstance(payload, (dict, list)):
+                    payload = json.dumps(payload)
+                if isinstance(payload, str):
+                    payload = payload.encode('utf-8')
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = _serve
+
+            def log_message(self, fmt: str, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self) -> 'StandIn':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,83 @@
+"""
+The daemon's warm engine pool and what it takes from a submitted job, with the offline fake engine
+"""
+import os
+import sys
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')))
+
+from daemon import EnginePool, SynthesisServer  # noqa: E402
+
+
+def _shard_config(speed: float) -> dict:
+    return {
+        'lang': 'english',
+        'lang_prefix': 'english',
+        'engines': {'invocation': 'shard', 'english': {'choices': ['fake', 'fake']}},
+        'shard': {},
+        'fake': {'speed': speed},
+        'output_audio_fn': os.path.join(tempfile.gettempdir(), 'shard.mp3'),
+    }
+
+
+class EnginePoolTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.pool = EnginePool(self.executor)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_sharded_engine_keyed_by_lane_settings(self):
+        key, eng = self.pool.checkout(_shard_config(1.0))
+        self.pool.checkin(key, eng)
+
+        # A different speed on the lanes' engine: not the warm engine with the old lanes
+        other_key, other = self.pool.checkout(_shard_config(1.2))
+        self.assertNotEqual(key, other_key)
+        self.assertIsNot(eng, other)
+        self.assertEqual({'speed': 1.2}, other.lanes[0].engine.app_config['fake'])
+        self.pool.checkin(other_key, other)
+
+        # The same settings again: the warm one, its lanes pointed at the new job
+        conf = dict(_shard_config(1.0), output_audio_fn=os.path.join(tempfile.gettempdir(), 'next.mp3'))
+        again_key, again = self.pool.checkout(conf)
+        self.assertIs(eng, again)
+        self.assertTrue(all(lane.engine.app_config['output_audio_fn'] == conf['output_audio_fn']
+                            for lane in again.lanes))
+        self.assertEqual({'built': 2, 'reused': 1, 'idle': 1}, self.pool.stats())
+
+
+class JobConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.server = SynthesisServer(self.tmp_dir.name)
+        self.outputs = {'output_audio_fn': os.path.join(self.tmp_dir.name, 'book.mp3'),
+                        'output_extracted_txt_fn': os.path.join(self.tmp_dir.name, 'book.txt')}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_endpoints_not_taken_from_the_job(self):
+        app_config = self.server.job_config(dict(self.outputs, **{
+            'gcp': {'endpoint': 'http://collect.example/v1/text:synthesize', 'speed': 1.1},
+            'azure': {'long_audio_endpoint': 'http://collect.example/longaudio', 'voice_name': 'v'},
+            'aws': {'region_name': 'us-west-2'},
+            'region': 'westeurope',
+        }))
+        self.assertEqual({'speed': 1.1}, app_config['gcp'])
+        self.assertEqual({'voice_name': 'v'}, app_config['azure'])
+        self.assertEqual('westeurope', app_config['region'])
+
+    def test_region_is_a_plain_name(self):
+        # It goes into host names, e.g. https://{region}.customvoice.api.speech.microsoft.com
+        for conf in [{'region': 'collect.example/#'}, {'aws': {'region_name': 'collect.example?'}}]:
+            with self.assertRaisesRegex(AssertionError, 'not a region name'):
+                self.server.job_config(dict(self.outputs, **conf))
+
+
+if __name__ == '__main__':
+    unittest.main()
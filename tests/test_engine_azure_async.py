@@ -0,0 +1,128 @@
+"""
+AzureBobAsync against a stand-in for the long audio synthesis API: submit, poll the Location URL,
+list the result files, stream the zip down and unpack it
+"""
+import io
+import os
+import tempfile
+import time
+import unittest
+import zipfile
+
+# First: puts src/ on the path
+from stand_in import StandIn
+
+import rate_limit
+from engine_azure_async import AzureBobAsync
+
+API = '/api/texttospeech/v3.0/longaudiosynthesis'
+JOB_ID = 'job-1'
+
+
+def _zip_with(audio: bytes) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        zf.writestr('summary.json', '{}')
+        zf.writestr('0001.mp3', audio)
+    return buf.getvalue()
+
+
+class LongAudioService(object):
+    def __init__(self, statuses, audio: bytes, retry_after: str = None):
+        self.statuses = list(statuses)
+        self.zip = _zip_with(audio)
+        self.retry_after = retry_after
+        self.polls = []
+        self.url = None
+
+    def __call__(self, req):
+        if req.method == 'POST' and req.path == API:
+            return 202, {'Location': f'{self.url}{API}/{JOB_ID}'}, {}
+        if req.path == f'{API}/{JOB_ID}':
+            self.polls.append(time.monotonic())
+            status = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+            headers = {'Retry-After': self.retry_after} if self.retry_after is not None else {}
+            return 200, headers, {'id': JOB_ID, 'status': status}
+        if req.path == f'{API}/{JOB_ID}/files':
+            return 200, {}, {'values': [
+                {'kind': 'LongAudioSynthesisAudio', 'links': {'contentUrl': f'{self.url}/elsewhere'}},
+                {'kind': 'LongAudioSynthesisResult', 'links': {'contentUrl': f'{self.url}/results/{JOB_ID}.zip'}},
+            ]}
+        if req.path == f'/results/{JOB_ID}.zip':
+            return 200, {'Content-Type': 'application/zip'}, self.zip
+        return 404, {}, {'error': f'Unknown path {req.path}'}
+
+
+class AzureLongAudioTest(unittest.TestCase):
+    def setUp(self):
+        # Limiters are shared per engine name for the whole process
+        rate_limit._limiters.pop('azure', None)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.out_fn = os.path.join(self.tmp_dir.name, 'book.mp3')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _engine(self, url: str) -> AzureBobAsync:
+        return AzureBobAsync({
+            'lang': 'english',
+            'invocation-theme-word': 'book',
+            'output_audio_fn': self.out_fn,
+            'output_extracted_txt_fn': os.path.join(self.tmp_dir.name, 'book.extracted.txt'),
+            'azure': {'speech_key': 'test-key', 'long_audio_endpoint': url + API,
+                      'poll_min_sec': 0.05, 'poll_max_sec': 0.2, 'poll_deadline_min': 0.5,
+                      'max_retries': 2, 'retry_base_sec': 0.01},
+        })
+
+    def test_submit_poll_download(self):
+        # 2 MB of audio: more than one block of the streamed download
+        audio = bytes(range(256)) * 8192
+        service = LongAudioService(['NotStarted', 'Running', 'Running', 'Succeeded'], audio)
+        with StandIn(service) as stand_in:
+            service.url = stand_in.url
+            self.assertTrue(self._engine(stand_in.url).convert('Hello & welcome. ' * 20))
+
+        submit = stand_in.requests[0]
+        self.assertEqual(('POST', API), (submit.method, submit.path))
+        self.assertEqual('test-key', submit.headers['Ocp-Apim-Subscription-Key'])
+        self.assertIn(b'filename="book.txt"', submit.body)
+        self.assertIn(b'Hello &amp; welcome.', submit.body)
+        self.assertIn(b'concatenateresult', submit.body)
+
+        # Polled until Succeeded, then the file list, then the zip
+        paths = [r.path for r in stand_in.requests[1:]]
+        self.assertEqual([f'{API}/{JOB_ID}'] * 4 + [f'{API}/{JOB_ID}/files', f'/results/{JOB_ID}.zip'], paths)
+
+        with open(self.out_fn, 'rb') as fin:
+            self.assertEqual(audio, fin.read())
+        self.assertEqual(['book.manifest.json', 'book.mp3'], sorted(os.listdir(self.tmp_dir.name)))
+
+    def test_failed_job(self):
+        service = LongAudioService(['NotStarted', 'Failed'], b'')
+        with StandIn(service) as stand_in:
+            service.url = stand_in.url
+            with self.assertRaisesRegex(RuntimeError, f'id={JOB_ID} failed'):
+                self._engine(stand_in.url).convert('Hello.')
+
+        self.assertNotIn(f'{API}/{JOB_ID}/files', [r.path for r in stand_in.requests])
+        self.assertFalse(os.path.exists(self.out_fn))
+
+    def test_retry_after_is_bounded(self):
+        # 'Retry-After: 0' must not turn polling into a tight loop
+        service = LongAudioService(['Running'] * 4 + ['Succeeded'], b'audio', retry_after='0')
+        with StandIn(service) as stand_in:
+            service.url = stand_in.url
+            self._engine(stand_in.url).convert('Hello.')
+
+        gaps = [b - a for a, b in zip(service.polls, service.polls[1:])]
+        self.assertEqual(4, len(gaps))
+        self.assertTrue(all(gap >= 0.045 for gap in gaps), gaps)
+
+        eng = self._engine('http://127.0.0.1:1')
+        self.assertEqual(0.2, eng._next_delay(0.05, 'RUNNING', '86400'))
+        self.assertEqual(0.1, eng._next_delay(0.05, 'RUNNING', '0.1'))
+        self.assertEqual(0.1, eng._next_delay(0.05, 'NOTSTARTED', 'soon'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Streamed output (output_streaming) when a chunk fails, with the offline fake engine
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')))
+
+import engine_base  # noqa: E402
+from audio_sink import OrderedAudioWriter  # noqa: E402
+from engine_fake import FakeEngine  # noqa: E402
+
+
+class _RecordingWriter(OrderedAudioWriter):
+    # Remembers writes that came in after close()
+    instances = []
+
+    def __init__(self, out_fn: str):
+        super().__init__(out_fn)
+        self.closed = False
+        self.late_writes = []
+        _RecordingWriter.instances.append(self)
+
+    def write(self, index: int, data: bytes):
+        if self.closed:
+            self.late_writes.append(index)
+        super().write(index, data)
+
+    def close(self):
+        super().close()
+        self.closed = True
+
+
+class _FailingEngine(FakeEngine):
+    def _stream_chunk(self, chunk: str, emit):
+        if 'boom' in chunk:
+            raise RuntimeError('Synthesis failed')
+        # The others keep writing for a while
+        for _ in range(5):
+            time.sleep(0.04)
+            emit(b'\xff' * 100)
+
+
+class StreamChunksTest(unittest.TestCase):
+    def test_failure_waits_for_running_chunks(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            eng = _FailingEngine({'output_audio_fn': os.path.join(tmp_dir, 'out.mp3'), 'output_streaming': True,
+                                  'fake': {'chunk_chars': 20, 'workers': 4}})
+            src_txt = 'boom went the first. ' + 'Then came the rest. ' * 12
+            with mock.patch.object(engine_base, 'OrderedAudioWriter', _RecordingWriter):
+                with self.assertRaisesRegex(RuntimeError, 'Synthesis failed'):
+                    eng.convert(src_txt)
+
+        writer = _RecordingWriter.instances[-1]
+        self.assertTrue(writer.closed)
+        self.assertEqual([], writer.late_writes)
+
+
+if __name__ == '__main__':
+    unittest.main()
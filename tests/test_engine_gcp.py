@@ -0,0 +1,145 @@
+"""
+GcpTts against a stand-in for the text:synthesize endpoint. The stand-in "synthesizes" a request
+by sending its input text back as the audio, so the output file shows the chunk order
+"""
+import base64
+import os
+import random
+import shlex
+import sys
+import tempfile
+import time
+import unittest
+
+# First: puts src/ on the path
+from stand_in import StandIn
+
+import rate_limit
+from engine_gcp import GcpTts, _audio_content, _utf8_len
+
+PATH = '/v1/text:synthesize'
+
+# Prints token-1, token-2, ... one more each time it runs
+TOKEN_SCRIPT = """
+import sys
+fn = sys.argv[1]
+try:
+    n = int(open(fn).read()) + 1
+except FileNotFoundError:
+    n = 1
+open(fn, 'w').write(str(n))
+print(f'token-{n}')
+"""
+
+
+def _echo(req, delay: bool = True):
+    payload = req.json()
+    if delay:
+        # Later chunks may well be answered first
+        time.sleep(random.uniform(0, 0.02))
+    audio = payload['input']['text'].encode('utf-8')
+    return 200, {'Content-Type': 'application/json'}, {'audioContent': base64.b64encode(audio).decode('ascii')}
+
+
+class GcpTtsTest(unittest.TestCase):
+    def setUp(self):
+        # Limiters are shared per engine name for the whole process
+        rate_limit._limiters.pop('gcp', None)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.out_fn = os.path.join(self.tmp_dir.name, 'book.mp3')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _engine(self, url: str, **gcp_cfg) -> GcpTts:
+        gcp_cfg.setdefault('api_key', 'test-key')
+        return GcpTts({
+            'lang': 'chinese-普通',
+            'output_audio_fn': self.out_fn,
+            'gcp': dict({'endpoint': url + PATH, 'workers': 2, 'max_retries': 3, 'retry_base_sec': 0.01,
+                         'retry_max_sec': 5}, **gcp_cfg),
+        })
+
+    def _output(self) -> str:
+        with open(self.out_fn, 'rb') as fin:
+            return fin.read().decode('utf-8')
+
+    def test_chunks_in_order_over_reused_connections(self):
+        src_txt = ''.join(f'第{i}句话，读者在窗边安静地读信。' for i in range(600))
+        with StandIn(_echo) as stand_in:
+            self.assertTrue(self._engine(stand_in.url, speed=1.25, pitch=1.0).convert(src_txt))
+
+        reqs = stand_in.requests
+        self.assertGreater(len(reqs), 4)
+        self.assertEqual(src_txt, self._output())
+        # 2 workers: never more connections than that, whatever the number of chunks
+        self.assertLessEqual(len({r.client_port for r in reqs}), 2)
+
+        payload = reqs[0].json()
+        self.assertEqual(['test-key'], reqs[0].query['key'])
+        self.assertEqual({'languageCode': 'cmn-CN'}, payload['voice'])
+        self.assertEqual({'audioEncoding': 'MP3', 'speakingRate': 1.25, 'pitch': 0.0}, payload['audioConfig'])
+
+    def test_split_at_5000_bytes(self):
+        for src_txt, requests in [('读' * 1666 + 'ab', 1), ('读' * 1667, 2), ('读' * 4000, 3)]:
+            with StandIn(_echo) as stand_in:
+                self._engine(stand_in.url).convert(src_txt)
+            texts = [r.json()['input']['text'] for r in stand_in.requests]
+            self.assertEqual(requests, len(texts), _utf8_len(src_txt))
+            self.assertTrue(all(_utf8_len(t) <= GcpTts.max_request_bytes for t in texts))
+            self.assertEqual(src_txt, self._output())
+
+    def test_429_retried_after_retry_after(self):
+        def _answer(req):
+            if len(stand_in.requests) == 1:
+                return 429, {'Retry-After': '1'}, {'error': {'code': 429, 'message': 'Quota exceeded'}}
+            return _echo(req, delay=False)
+
+        with StandIn(_answer) as stand_in:
+            t0 = time.monotonic()
+            self._engine(stand_in.url).convert('Hello there.')
+            elapsed = time.monotonic() - t0
+
+        self.assertEqual(2, len(stand_in.requests))
+        self.assertGreaterEqual(elapsed, 0.95)
+        self.assertEqual('Hello there.', self._output())
+
+    def test_client_error_not_retried(self):
+        def _answer(req):
+            return 400, {}, {'error': {'code': 400, 'message': 'Invalid voice'}}
+
+        with StandIn(_answer) as stand_in:
+            with self.assertRaisesRegex(RuntimeError, 'Invalid voice'):
+                self._engine(stand_in.url).convert('Hello there.')
+        self.assertEqual(1, len(stand_in.requests))
+
+    def test_token_refreshed_after_401(self):
+        counter_fn = os.path.join(self.tmp_dir.name, 'tokens')
+        token_cmd = shlex.join([sys.executable, '-c', TOKEN_SCRIPT, counter_fn])
+
+        def _answer(req):
+            if req.headers.get('Authorization') != 'Bearer token-2':
+                return 401, {}, {'error': {'code': 401, 'message': 'Token expired'}}
+            return _echo(req, delay=False)
+
+        with StandIn(_answer) as stand_in:
+            self._engine(stand_in.url, api_key=None, access_token_cmd=token_cmd).convert('Hello there.')
+
+        self.assertEqual(['Bearer token-1', 'Bearer token-2'], [r.headers['Authorization'] for r in stand_in.requests])
+        self.assertNotIn('key', stand_in.requests[0].query)
+        with open(counter_fn) as fin:
+            self.assertEqual('2', fin.read())
+        self.assertEqual('Hello there.', self._output())
+
+    def test_audio_content(self):
+        audio = bytes(range(256)) * 40
+        b64 = base64.b64encode(audio)
+        self.assertEqual(audio, _audio_content(b'{"audioContent": "' + b64 + b'"}'))
+        # Other fields around it, and white space
+        self.assertEqual(audio, _audio_content(b'{\n  "timepoints": [],\n  "audioContent" : "' + b64 + b'",\n  "x": 1\n}'))
+        # JSON may escape the '/' of base64: the slow road
+        self.assertEqual(audio, _audio_content(b'{"audioContent": "' + b64.replace(b'/', b'\\/') + b'"}'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+"""
+Where the resume manifest and its segments live: with the output audio, never with the source text
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')))
+
+from job_manifest import JobManifest  # noqa: E402
+
+
+class JobManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.src_dir = os.path.join(self.tmp_dir.name, 'books')
+        self.out_dir = os.path.join(self.tmp_dir.name, 'audio')
+        os.makedirs(self.src_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_kept_with_the_audio(self):
+        # A txt source: 'output_extracted_txt_fn' is the user's own file. A folder of theirs next to it
+        # with the name segments would get must survive
+        own_dir = os.path.join(self.src_dir, 'book.segments')
+        os.makedirs(own_dir)
+        with open(os.path.join(own_dir, 'notes.txt'), 'w') as fout:
+            fout.write('mine')
+        app_config = {'output_extracted_txt_fn': os.path.join(self.src_dir, 'book.txt'),
+                      'output_audio_fn': os.path.join(self.out_dir, 'book.mp3')}
+
+        manifest = JobManifest.open(app_config, 'Some text.', {'voice': 'v'}, resume=False)
+        manifest.set_chunks(['Some text.'])
+        manifest.save_segment(0, b'audio')
+
+        self.assertEqual(os.path.join(os.path.realpath(self.out_dir), 'book.manifest.json'), manifest.fn)
+        self.assertTrue(os.path.exists(manifest.fn))
+        self.assertTrue(manifest.segment_dir.startswith(os.path.realpath(self.out_dir)))
+        self.assertEqual(['book.segments'], os.listdir(self.src_dir))
+        self.assertEqual(['notes.txt'], os.listdir(own_dir))
+
+        # And it is found again to resume
+        resumed = JobManifest.open(app_config, 'Some text.', {'voice': 'v'}, resume=True)
+        resumed.set_chunks(['Some text.'])
+        self.assertEqual(b'audio', resumed.load_segment(0))
+
+    def test_none_for_stdout(self):
+        self.assertIsNone(JobManifest.path_for({'output_audio_fn': '-', 'output_extracted_txt_fn': 'x.txt'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""
+--plan: the run history it learns from, and plans for edge cases, with the offline fake engine
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')))
+
+from engine_fake import FakeEngine  # noqa: E402
+from plan import format_plan, load_history, plan_conversion, record_run  # noqa: E402
+
+
+class _GivingUp(FakeEngine):
+    # Reports failure the way a Polly task timing out does: by returning False
+    def convert(self, src_txt: str) -> bool:
+        return False
+
+
+class RecordRunTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.app_config = {'lang': 'english', 'lang_prefix': 'english',
+                           'output_audio_fn': os.path.join(self.tmp_dir.name, 'book.mp3'),
+                           'output_extracted_txt_fn': os.path.join(self.tmp_dir.name, 'book.extracted.txt'),
+                           'fake': {}}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_only_successful_runs_recorded(self):
+        src_txt = 'Hello there. ' * 20
+        eng = _GivingUp(self.app_config)
+        with record_run(self.app_config, eng, src_txt) as run:
+            run['ok'] = eng.convert(src_txt)
+        self.assertEqual([], load_history(self.app_config))
+
+        eng = FakeEngine(self.app_config)
+        with record_run(self.app_config, eng, src_txt) as run:
+            run['ok'] = eng.convert(src_txt)
+        history = load_history(self.app_config)
+        self.assertEqual(1, len(history))
+        self.assertEqual(len(src_txt), history[0]['chars'])
+        self.assertEqual('FakeEngine', history[0]['engine'])
+
+    def test_plan_of_empty_text(self):
+        app_config = dict(self.app_config, engines={'invocation': 'fake'})
+        plans = plan_conversion(app_config, '', 'fake')
+        self.assertEqual(1, len(plans))
+        plan = plans[0]
+        self.assertNotIn('error', plan)
+        self.assertEqual((0, 0, 0, 0.0, 0.0), (plan['requests'], plan['largest_request_bytes'], plan['billed_chars'],
+                                               plan['synth_sec'], plan['audio_sec']))
+        self.assertIn('fake', format_plan(plans, 0, 'fake'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+Chunks cut while the text arrives in parts (iter_chunks_from) must be those of the whole text
+(split_text), also around sentences too long to be held until they end
+"""
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')))
+
+from text_chunk import escaped_len, escaped_utf8_len, iter_chunks_from, split_text  # noqa: E402
+
+# Words, clause and sentence punctuation, and what makes a sentence end depend on the next text
+PIECES = ['word', 'mot', '读信', '&', ' ', ' ', ', ', '，', '、', '—', '.', '...', '."', '。', '。」', '!', '\n', '\n\n']
+
+
+def _long_sentence(rnd: random.Random, n_chars: int) -> str:
+    # Clauses without any sentence terminator, and a run with no place to break at all
+    out = []
+    while sum(map(len, out)) < n_chars:
+        out.append(rnd.choice(['word ', 'mot, ', '读信，', 'a&b ', 'x' * rnd.randint(1, 5000)]))
+    return ''.join(out)
+
+
+def _text(rnd: random.Random) -> str:
+    out = []
+    for _ in range(3):
+        out.append(''.join(rnd.choice(PIECES) for _ in range(rnd.randint(0, 3000))))
+        out.append(_long_sentence(rnd, rnd.randint(70000, 150000)))
+        # How it ends: a full stop and quote the next part may be needed to decide on
+        out.append(rnd.choice(['. ', '."  Next', '。」', '...\n', '!"', '']))
+    return ''.join(out)
+
+
+def _parts(rnd: random.Random, txt: str) -> list:
+    cuts = sorted(rnd.sample(range(1, len(txt)), 40))
+    return [txt[i:j] for i, j in zip([0] + cuts, cuts + [len(txt)])]
+
+
+class IterChunksFromTest(unittest.TestCase):
+    def test_same_chunks_as_whole_text(self):
+        rnd = random.Random(20)
+        for limit, measure in [(5000, escaped_utf8_len), (3000, escaped_len), (300, escaped_utf8_len)]:
+            txt = _text(rnd)
+            expected = split_text(txt, limit, measure)
+            self.assertEqual(expected, list(iter_chunks_from(_parts(rnd, txt), limit, measure)))
+            # Small parts: the sentence in progress is cut at nearly every chance
+            small = [txt[i:i + 700] for i in range(0, len(txt), 700)]
+            self.assertEqual(expected, list(iter_chunks_from(small, limit, measure)))
+
+    def test_cut_before_the_end_is_known(self):
+        # The first part ends in '."', with a place _split_oversized cuts between the two: whether
+        # the sentence ends there depends on the white space of the next part
+        long_sentence = 'x' * (10000 * 12 - 1) + '."'
+        for rest in [' Next one. And on.', 'x and on. So.']:
+            parts = [long_sentence, rest]
+            self.assertEqual(split_text(''.join(parts), 12), list(iter_chunks_from(parts, 12)))
+
+    def test_held_sentence_bounded(self):
+        # Most of a sentence that is still going on goes out before it ends
+        taken = []
+
+        def _parts():
+            for i in range(100):
+                taken.append(i)
+                yield 'word ' * 1000
+
+        chunks = iter_chunks_from(_parts(), 5000)
+        self.assertEqual('word ' * 1000, next(chunks))
+        self.assertLess(len(taken), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+"""
+The PDF text cleaner must give byte for byte what the original char-by-char loop gave, whole
+(clean_after_pdf_extract) and page by page (iter_clean_pages)
+"""
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')))
+
+from text_clean import clean_after_pdf_extract, iter_clean_pages  # noqa: E402
+
+
+def original_clean(in_text: str) -> str:
+    # The loop clean_after_pdf_extract replaced, as it was in main.py. One change: it raised
+    # IndexError on a lone '\n' before any other output ([-1] of ''), where the rewrite emits a space
+    cleaned_txt = ''
+    txt_len = len(in_text)
+    for ci in range(txt_len):
+        c = in_text[ci]
+        if c == '\f':
+            continue
+
+        if c == '\n':
+            # Skip the first line return only
+            if ci < txt_len - 1 and in_text[ci + 1] == '\n':
+                cleaned_txt += '\n'
+            elif cleaned_txt[-1:] == '\n':
+                continue
+            else:
+                cleaned_txt += ' '
+            continue
+
+        cleaned_txt += c
+
+    return cleaned_txt
+
+
+# Pieces pdfminer output is made of: words, CJK, and every kind of run of line breaks and form feeds
+_PIECES = ['word', ' ', '读者', '。', '\n', '\n\n', '\n\n\n', '\f', '\n\f', '\f\n', '\n\f\n', '\n\n\f\n\n', '\t']
+
+
+def _corpus(seed: int, count: int = 300):
+    rnd = random.Random(seed)
+    texts = ['', '\n', '\f', '\n\n', 'a\n', '\na', 'a\nb', 'a\n\nb', 'a\n\n\nb', 'a\n\fb', 'a\f\nb', '\f\f\n\n\f',
+             'Page one.\n\n\f', 'end\n\n\n\n']
+    for _ in range(count):
+        texts.append(''.join(rnd.choice(_PIECES) for _ in range(rnd.randint(1, 60))))
+    return texts
+
+
+def _pages(text: str, rnd: random.Random):
+    # Cut anywhere, including inside runs of line breaks, with now and then an empty page
+    cuts = sorted(rnd.sample(range(len(text) + 1), min(len(text) + 1, rnd.randint(0, 6))))
+    pages, start = [], 0
+    for cut in cuts + [len(text)]:
+        pages.append(text[start:cut])
+        start = cut
+    return pages
+
+
+class CleanAfterPdfExtractTest(unittest.TestCase):
+    def test_same_as_original_loop(self):
+        for text in _corpus(seed=1):
+            self.assertEqual(original_clean(text), clean_after_pdf_extract(text), repr(text))
+
+    def test_pages_same_as_whole_text(self):
+        rnd = random.Random(2)
+        for text in _corpus(seed=3):
+            for _ in range(5):
+                pages = _pages(text, rnd)
+                self.assertEqual(original_clean(text), ''.join(iter_clean_pages(pages)), repr(pages))
+
+    def test_break_run_across_pages(self):
+        # pdfminer ends every page with '\n\f'; the run goes on into the next page
+        pages = ['First page line one\nline two\n\n', '\f\n', '\nSecond page\n', '\n\fThird\n', '']
+        text = ''.join(pages)
+        self.assertEqual(original_clean(text), ''.join(iter_clean_pages(pages)))
+        self.assertEqual('First page line one line two\n\nSecond page\nThird ', ''.join(iter_clean_pages(pages)))
+
+
+if __name__ == '__main__':
+    unittest.main()